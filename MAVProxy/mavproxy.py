@@ -17,6 +17,12 @@ import shlex
 from MAVProxy.modules.lib import textconsole
 from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_eventloop
+from MAVProxy.modules.lib import mp_batchio
+from MAVProxy.modules.lib import mp_router
+from MAVProxy.modules.lib import mp_logring
+from MAVProxy.modules.lib import mp_logfile
+from MAVProxy.modules.lib import mp_task
 from MAVProxy.modules.lib import dumpstacks
 
 # adding all this allows pyinstaller to build a working windows executable
@@ -75,6 +81,12 @@ class MPStatus(object):
                 f.write('%s:%s ' % (c, self.counters[c]))
             f.write('\n')
             f.write('MAV Errors: %u\n' % self.mav_error)
+            f.write('Event loop: %s %s\n' % (mpstate.eventloop.backend, mpstate.eventloop.counters))
+            f.write('Batch I/O: %s\n' % mpstate.batch_io)
+            f.write('Tasks: %s\n' % mpstate.tasks)
+            if mpstate.logqueue is not None:
+                f.write('Log: %s\n' % mpstate.logqueue)
+                f.write('Raw log: %s\n' % mpstate.logqueue_raw)
             f.write(str(self.gps)+'\n')
         for m in sorted(self.msgs.keys()):
             if pattern is not None and not fnmatch.fnmatch(str(m).upper(), pattern.upper()):
@@ -109,6 +121,9 @@ class MAVFunctions(object):
         self.param_set = param_set
         self.get_mav_param = get_mav_param
         self.say = say_text
+        # read handlers for registering links with the event loop
+        self.process_master = process_master
+        self.process_mavlink = process_mavlink
         # input handler can be overridden by a module
         self.input_handler = None
 
@@ -132,6 +147,12 @@ class MPState(object):
               MPSetting('baudrate', int, opts.baudrate, 'baudrate for new links', range=(0,10000000), increment=1),
               MPSetting('rtscts', bool, opts.rtscts, 'enable flow control'),
               MPSetting('select_timeout', float, 0.01, 'select timeout'),
+              MPSetting('periodic_rate', int, 200, 'periodic task rate (Hz)', range=(1,1000), increment=10),
+              MPSetting('batch_io', bool, False, 'batch UDP receive and output writes'),
+              MPSetting('batch_size', int, 1400, 'max bytes per batched output write', range=(280,65000), increment=100),
+              MPSetting('router', bool, False, 'forward raw frames without re-parsing'),
+              MPSetting('dedup', bool, False, 'drop duplicate packets from redundant links'),
+              MPSetting('autolink', bool, False, 'choose the primary link by latency and loss'),
 
               MPSetting('altreadout', int, 10, 'Altitude Readout',
                         range=(0,100), increment=1, tab='Announcements'),
@@ -140,6 +161,14 @@ class MPState(object):
               MPSetting('moddebug', int, opts.moddebug, 'Module Debug Level', range=(0,3), increment=1, tab='Debug'),
               MPSetting('compdebug', int, 0, 'Computation Debug Mask', range=(0,3), tab='Debug'),
               MPSetting('flushlogs', bool, False, 'Flush logs on every packet'),
+              MPSetting('logsync', str, 'none', 'Log sync policy', choice=['none', 'flush', 'fsync']),
+              MPSetting('logbuffer', int, 4096, 'Log buffer size (kB), set before logs open', range=(64,1048576), increment=64),
+              MPSetting('logcompress', str, 'none', 'Log block compression, set before logs open',
+                        choice=['none', 'zlib', 'bz2', 'lzma']),
+              MPSetting('logblock', int, 256, 'Compressed log block size (kB)', range=(16,65536), increment=16),
+              MPSetting('logrotate_size', int, 0, 'Rotate logs at this size (MB), 0 to disable', range=(0,1000000), increment=10),
+              MPSetting('logrotate_time', int, 0, 'Rotate logs after this many minutes, 0 to disable', range=(0,100000), increment=10),
+              MPSetting('logrotate_keep', int, 0, 'Number of rotated logs to keep, 0 to keep all', range=(0,10000), increment=1),
               MPSetting('requireexit', bool, False, 'Require exit command'),
               MPSetting('wpupdates', bool, True, 'Announce waypoint updates'),
 
@@ -187,9 +216,17 @@ class MPState(object):
 
         self.mav_param = mavparm.MAVParmDict()
         self.modules = []
+        # changed when modules or their subscriptions change
+        self.module_generation = 0
         self.public_modules = {}
         self.functions = MAVFunctions()
-        self.select_extra = {}
+        # persistent fd->handler registry for the main loop
+        self.eventloop = mp_eventloop.MPEventLoop()
+        self.select_extra = mp_eventloop.MPSelectExtra(self.eventloop, process_select_extra)
+        # coalesced output writes and UDP receive draining
+        self.batch_io = mp_batchio.MPBatchIO()
+        # coroutine tasks started by modules
+        self.tasks = mp_task.MPTaskScheduler()
         self.continue_mode = False
         self.aliases = {}
         import platform
@@ -278,6 +315,7 @@ def load_module(modname, quiet=False):
             module = m.init(mpstate)
             if isinstance(module, mp_module.MPModule):
                 mpstate.modules.append((module, m))
+                mpstate.module_generation += 1
                 if not quiet:
                     print("Loaded module %s" % (modname,))
                 return True
@@ -298,7 +336,9 @@ def unload_module(modname):
         if m.name == modname:
             if hasattr(m, 'unload'):
                 m.unload()
+            mpstate.tasks.cancel_owner(modname)
             mpstate.modules.remove((m,pm))
+            mpstate.module_generation += 1
             print("Unloaded module %s" % modname)
             return True
     print("Unable to find module %s" % modname)
@@ -512,8 +552,12 @@ def process_master(m):
     if (mpstate.settings.compdebug & 1) != 0:
         return
 
+    if mpstate.settings.batch_io and isinstance(m, mavutil.mavudp):
+        # read all pending datagrams in this wakeup
+        s = mpstate.batch_io.drain(m, s)
+
     if mpstate.logqueue_raw:
-        mpstate.logqueue_raw.put(str(s))
+        mpstate.logqueue_raw.put(s)
 
     if mpstate.status.setup_mode:
         if mpstate.system == 'Windows':
@@ -525,6 +569,11 @@ def process_master(m):
 
     if m.first_byte and opts.auto_protocol:
         m.auto_mavlink_version(s)
+    if mpstate.settings.router:
+        # forward raw frames to outputs, only parsing what we need
+        s = mpstate.module('link').route_frames(m, s)
+        if not s:
+            return
     msgs = m.mav.parse_buffer(s)
     if msgs:
         for msg in msgs:
@@ -547,6 +596,9 @@ def process_mavlink(slave):
         buf = slave.recv()
     except socket.error:
         return
+    if mpstate.settings.router and mpstate.status.watch is None:
+        route_slave_frames(slave, buf)
+        return
     try:
         if slave.first_byte and opts.auto_protocol:
             slave.auto_mavlink_version(buf)
@@ -564,6 +616,27 @@ def process_mavlink(slave):
             mpstate.master().write(m.get_msgbuf())
     mpstate.status.counters['Slave'] += 1
 
+def route_slave_frames(slave, buf):
+    '''forward raw frames from a MAVLink slave to the master without parsing'''
+    frames = mp_router.get_framer(slave).frames(buf)
+    if mpstate.settings.mavfwd and not mpstate.status.setup_mode:
+        master = mpstate.master()
+        for (f, sysid, compid, msgid) in frames:
+            if msgid is not None:
+                master.write(f)
+    mpstate.status.counters['Slave'] += 1
+
+def process_select_extra(fd):
+    '''call the read function registered by a module for an extra fd'''
+    try:
+        (fn, args) = mpstate.select_extra[fd]
+        fn(args)
+    except Exception as msg:
+        if mpstate.settings.moddebug == 1:
+            print(msg)
+        # on an exception, remove it from the select list
+        mpstate.select_extra.pop(fd, None)
+
 
 def mkdir_p(dir):
     '''like mkdir -p'''
@@ -577,17 +650,47 @@ def mkdir_p(dir):
     mkdir_p(os.path.dirname(dir))
     os.mkdir(dir)
 
+def log_flush():
+    '''write out everything pending in the log rings'''
+    mpstate.log_lock.acquire()
+    n = mpstate.logqueue_raw.write_to(mpstate.logfile_raw)
+    n += mpstate.logqueue.write_to(mpstate.logfile)
+    policy = mpstate.settings.logsync
+    if mpstate.settings.flushlogs and policy == 'none':
+        policy = 'flush'
+    if n > 0:
+        mp_logring.sync_file(mpstate.logfile, policy)
+        mp_logring.sync_file(mpstate.logfile_raw, policy)
+    mpstate.log_lock.release()
+
 def log_writer():
     '''log writing thread'''
     while True:
-        mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue_raw.empty():
-            mpstate.logfile_raw.write(mpstate.logqueue_raw.get())
-        while not mpstate.logqueue.empty():
-            mpstate.logfile.write(mpstate.logqueue.get())
-        if mpstate.settings.flushlogs:
-            mpstate.logfile.flush()
-            mpstate.logfile_raw.flush()
+        # wake up periodically, or early when a ring is filling up
+        mpstate.log_event.wait(0.1)
+        mpstate.log_event.clear()
+        log_flush()
+
+def highest_flight(dirname):
+    '''return the highest flightN directory number in dirname, or 0 if
+    there are none. The last number used is kept in a marker file so we
+    don't need to look for every directory on each start'''
+    highest = 0
+    try:
+        highest = int(open(os.path.join(dirname, '.lastflight')).read())
+    except (IOError, ValueError):
+        pass
+    if highest > 0 and not os.path.exists(os.path.join(dirname, 'flight%u' % highest)):
+        # stale marker
+        highest = 0
+    if highest == 0:
+        for d in os.listdir(dirname):
+            if d.startswith('flight') and d[6:].isdigit():
+                highest = max(highest, int(d[6:]))
+    # pick up any directories created since the marker was written
+    while os.path.exists(os.path.join(dirname, 'flight%u' % (highest+1))):
+        highest += 1
+    return highest
 
 # If state_basedir is NOT set then paths for logs and aircraft
 # directories are relative to mavproxy's cwd
@@ -604,17 +707,17 @@ def log_paths():
         if mpstate.settings.state_basedir is not None:
             dirname = os.path.join(mpstate.settings.state_basedir,dirname)
         mkdir_p(dirname)
-        highest = None
-        for i in range(1, 10000):
-            fdir = os.path.join(dirname, 'flight%u' % i)
-            if not os.path.exists(fdir):
-                break
-            highest = fdir
-        if mpstate.continue_mode and highest is not None:
-            fdir = highest
-        elif os.path.exists(fdir):
-            print("Flight logs full")
-            sys.exit(1)
+        highest = highest_flight(dirname)
+        if mpstate.continue_mode and highest > 0:
+            fdir = os.path.join(dirname, 'flight%u' % highest)
+        else:
+            fdir = os.path.join(dirname, 'flight%u' % (highest+1))
+            try:
+                f = open(os.path.join(dirname, '.lastflight'), mode='w')
+                f.write('%u\n' % (highest+1))
+                f.close()
+            except IOError:
+                pass
         logname = 'flight.tlog'
         logdir = fdir
     else:
@@ -639,17 +742,31 @@ def open_telemetry_logs(logpath_telem, logpath_telem_raw):
         mode = 'w'
 
     try:
-        mpstate.logfile = open(logpath_telem, mode=mode)
-        mpstate.logfile_raw = open(logpath_telem_raw, mode=mode)
+        logargs = { 'mode' : mode,
+                    'compression' : mpstate.settings.logcompress,
+                    'block_size' : mpstate.settings.logblock*1024,
+                    'rotate_size' : mpstate.settings.logrotate_size*1024*1024,
+                    'rotate_time' : mpstate.settings.logrotate_time*60,
+                    'keep' : mpstate.settings.logrotate_keep }
+        mpstate.logfile = mp_logfile.MPLogFile(logpath_telem, tlog=True, **logargs)
+        mpstate.logfile_raw = mp_logfile.MPLogFile(logpath_telem_raw, tlog=False, **logargs)
+        mpstate.log_event = threading.Event()
+        mpstate.log_lock = threading.Lock()
+        mpstate.logqueue = mp_logring.MPLogRing(mpstate.settings.logbuffer*1024, mpstate.log_event)
+        mpstate.logqueue_raw = mp_logring.MPLogRing(mpstate.settings.logbuffer*1024, mpstate.log_event)
         print("Log Directory: %s" % mpstate.status.logdir)
-        print("Telemetry log: %s" % logpath_telem)
+        print("Telemetry log: %s" % mpstate.logfile.path)
 
         #make sure there's enough free disk space for the logfile (>200Mb)
-        stat = os.statvfs(logpath_telem)
+        stat = os.statvfs(mpstate.logfile.path)
         if stat.f_bfree*stat.f_bsize < 209715200:
-            print("ERROR: Not enough free disk space for logfile")
-            mpstate.status.exit = True
-            return
+            if mpstate.settings.logrotate_keep > 0 and mpstate.settings.logrotate_size > 0:
+                # disk use is bounded by the rotation settings
+                print("WARNING: Low free disk space for logfile")
+            else:
+                print("ERROR: Not enough free disk space for logfile")
+                mpstate.status.exit = True
+                return
 
         # use a separate thread for writing to the logfile to prevent
         # delays during disk writes (important as delays can be long if camera
@@ -703,6 +820,8 @@ def send_heartbeat(master):
 
 def periodic_tasks():
     '''run periodic checks'''
+    mpstate.periodic_timer.period = 1.0 / max(mpstate.settings.periodic_rate, 1)
+
     if mpstate.status.setup_mode:
         return
 
@@ -722,7 +841,7 @@ def periodic_tasks():
 
     set_stream_rates()
 
-    # call optional module idle tasks. These are called at several hundred Hz
+    # call optional module idle tasks. These are called at periodic_rate Hz
     for (m,pm) in mpstate.modules:
         if hasattr(m, 'idle_task'):
             try:
@@ -749,6 +868,9 @@ def main_loop():
                 master.wait_heartbeat()
         set_stream_rates()
 
+    mpstate.periodic_timer = mpstate.eventloop.add_timer(1.0 / max(mpstate.settings.periodic_rate, 1),
+                                                         periodic_tasks)
+
     while True:
         if mpstate is None or mpstate.status.exit:
             return
@@ -761,73 +883,23 @@ def main_loop():
             for c in cmds:
                 process_stdin(c)
 
+        # links without a file descriptor (eg. windows serial ports) are polled
         for master in mpstate.mav_master:
             if master.fd is None:
                 if master.port.inWaiting() > 0:
                     process_master(master)
 
-        periodic_tasks()
+        # run due timers and dispatch any readable masters, outputs and
+        # module fds via their registered handlers
+        mpstate.eventloop.run_once(mpstate.settings.select_timeout)
 
-        rin = []
-        for master in mpstate.mav_master:
-            if master.fd is not None and not master.portdead:
-                rin.append(master.fd)
-        for m in mpstate.mav_outputs:
-            rin.append(m.fd)
-        for sysid in mpstate.sysid_outputs:
-            m = mpstate.sysid_outputs[sysid]
-            rin.append(m.fd)
-        if rin == []:
-            time.sleep(0.0001)
-            continue
-
-        for fd in mpstate.select_extra:
-            rin.append(fd)
-        try:
-            (rin, win, xin) = select.select(rin, [], [], mpstate.settings.select_timeout)
-        except select.error:
-            continue
-
-        if mpstate is None:
-            return
-
-        for fd in rin:
-            if mpstate is None:
-                  return
-            for master in mpstate.mav_master:
-                  if fd == master.fd:
-                        process_master(master)
-                        if mpstate is None:
-                              return
-                        continue
-            for m in mpstate.mav_outputs:
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            for sysid in mpstate.sysid_outputs:
-                m = mpstate.sysid_outputs[sysid]
-                if fd == m.fd:
-                    process_mavlink(m)
-                    if mpstate is None:
-                          return
-                    continue
-
-            # this allow modules to register their own file descriptors
-            # for the main select loop
-            if fd in mpstate.select_extra:
-                try:
-                    # call the registered read function
-                    (fn, args) = mpstate.select_extra[fd]
-                    fn(args)
-                except Exception as msg:
-                    if mpstate.settings.moddebug == 1:
-                        print(msg)
-                    # on an exception, remove it from the select list
-                    mpstate.select_extra.pop(fd)
+        # resume module tasks whose sleep or wait has timed out
+        mpstate.tasks.debug = mpstate.settings.moddebug > 1
+        mpstate.tasks.run()
 
+        # send coalesced output writes once per loop
+        mpstate.batch_io.max_size = mpstate.settings.batch_size
+        mpstate.batch_io.flush()
 
 
 def input_loop():
@@ -947,9 +1019,9 @@ if __name__ == '__main__':
     mpstate.status.exit = False
     mpstate.command_map = command_map
     mpstate.continue_mode = opts.continue_mode
-    # queues for logging
-    mpstate.logqueue = Queue.Queue()
-    mpstate.logqueue_raw = Queue.Queue()
+    # ring buffers for logging, created when the logs are opened
+    mpstate.logqueue = None
+    mpstate.logqueue_raw = None
 
 
     if opts.speech:
@@ -1012,7 +1084,9 @@ if __name__ == '__main__':
 
     # open any mavlink output ports
     for port in opts.output:
-        mpstate.mav_outputs.append(mavutil.mavlink_connection(port, baud=int(opts.baudrate), input=False))
+        conn = mavutil.mavlink_connection(port, baud=int(opts.baudrate), input=False)
+        mpstate.mav_outputs.append(conn)
+        mpstate.eventloop.register(conn.fd, process_mavlink, conn)
 
     if opts.sitl:
         mpstate.sitl_output = mavutil.mavudp(opts.sitl, input=False)
@@ -1124,4 +1198,9 @@ if __name__ == '__main__':
             print("Unloading module %s" % m.name)
             m.unload()
 
+    if mpstate.logqueue is not None:
+        log_flush()
+        mpstate.logfile.close()
+        mpstate.logfile_raw.close()
+
     sys.exit(1)
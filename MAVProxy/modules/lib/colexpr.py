@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+'''
+evaluate graph expressions over the columns of an in-memory log
+
+an expression like "ATT.Roll*2" or a condition like "GPS.Status>=3" is
+parsed once and then evaluated with numpy over every point at once,
+instead of calling eval() for each message. A reference to a message
+field takes the value from the last message of that type at or before
+each point, the same as evaluating against mlog.messages while
+replaying the log. Points where a referenced message has not been seen
+yet, or where there is a division by zero, are marked invalid, matching
+the None that mavutil.evaluate_expression() returns for them.
+
+Expressions using anything else, such as the mavextra helper functions,
+raise UnsupportedExpression so the caller can use the per-message path.
+'''
+
+import ast, math, operator, re
+
+import numpy
+
+re_caps = re.compile('[A-Z_][A-Z0-9_]+')
+
+class UnsupportedExpression(Exception):
+    '''the expression can't be evaluated over columns'''
+    pass
+
+binary_ops = {
+    ast.Add : operator.add,
+    ast.Sub : operator.sub,
+    ast.Mult : operator.mul,
+    ast.Div : lambda a, b: a / b,
+    ast.FloorDiv : operator.floordiv,
+    ast.Mod : operator.mod,
+    ast.Pow : operator.pow,
+}
+
+# operators that fail in python for a zero right hand side
+divide_ops = [ast.Div, ast.FloorDiv, ast.Mod]
+
+compare_ops = {
+    ast.Eq : operator.eq,
+    ast.NotEq : operator.ne,
+    ast.Lt : operator.lt,
+    ast.LtE : operator.le,
+    ast.Gt : operator.gt,
+    ast.GtE : operator.ge,
+}
+
+unary_ops = {
+    ast.USub : operator.neg,
+    ast.UAdd : operator.pos,
+    ast.Not : numpy.logical_not,
+}
+
+# functions with a numpy equivalent, with their number of arguments
+functions = {
+    'sin' : (numpy.sin, 1),
+    'cos' : (numpy.cos, 1),
+    'tan' : (numpy.tan, 1),
+    'asin' : (numpy.arcsin, 1),
+    'acos' : (numpy.arccos, 1),
+    'atan' : (numpy.arctan, 1),
+    'atan2' : (numpy.arctan2, 2),
+    'sqrt' : (numpy.sqrt, 1),
+    'exp' : (numpy.exp, 1),
+    'log' : (numpy.log, 1),
+    'log10' : (numpy.log10, 1),
+    'fabs' : (numpy.fabs, 1),
+    'abs' : (numpy.abs, 1),
+    'floor' : (numpy.floor, 1),
+    'ceil' : (numpy.ceil, 1),
+    'degrees' : (numpy.degrees, 1),
+    'radians' : (numpy.radians, 1),
+    'hypot' : (numpy.hypot, 2),
+    'pow' : (numpy.power, 2),
+    'min' : (numpy.minimum, 2),
+    'max' : (numpy.maximum, 2),
+    'float' : (lambda a: numpy.asarray(a, dtype=float), 1),
+}
+
+constants = {
+    'pi' : math.pi,
+    'e' : math.e,
+    'True' : True,
+    'False' : False,
+}
+
+class ColumnExpression(object):
+    '''an expression compiled for evaluation over log columns'''
+    def __init__(self, expression, types):
+        self.expression = expression
+        self.types = types
+        try:
+            self.tree = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError:
+            raise UnsupportedExpression(expression)
+        self.check(self.tree)
+
+    def check(self, node):
+        '''make sure every part of the expression is supported'''
+        if isinstance(node, ast.Num):
+            return
+        if isinstance(node, ast.Str):
+            return
+        if isinstance(node, ast.Name):
+            if node.id in constants:
+                return
+            raise UnsupportedExpression(node.id)
+        if isinstance(node, ast.Attribute):
+            if not isinstance(node.value, ast.Name):
+                raise UnsupportedExpression(self.expression)
+            mtype = node.value.id
+            if mtype not in self.types and not re_caps.match(mtype):
+                # not a message name, could be a module or function
+                raise UnsupportedExpression(mtype)
+            return
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in binary_ops:
+                raise UnsupportedExpression(self.expression)
+            self.check(node.left)
+            self.check(node.right)
+            return
+        if isinstance(node, ast.UnaryOp):
+            if type(node.op) not in unary_ops:
+                raise UnsupportedExpression(self.expression)
+            self.check(node.operand)
+            return
+        if isinstance(node, ast.BoolOp):
+            for v in node.values:
+                self.check(v)
+            return
+        if isinstance(node, ast.Compare):
+            for op in node.ops:
+                if type(op) not in compare_ops:
+                    raise UnsupportedExpression(self.expression)
+            self.check(node.left)
+            for c in node.comparators:
+                self.check(c)
+            return
+        if isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name) or
+                node.func.id not in functions or
+                len(node.args) != functions[node.func.id][1] or
+                node.keywords or
+                getattr(node, 'starargs', None) is not None or
+                getattr(node, 'kwargs', None) is not None):
+                raise UnsupportedExpression(self.expression)
+            for a in node.args:
+                self.check(a)
+            return
+        raise UnsupportedExpression(self.expression)
+
+    def evaluate(self, mlog, positions):
+        '''evaluate the expression at a sorted array of positions in a
+        mavmemlog, returning an array of values and an array that is True
+        where the expression has no value'''
+        self.mlog = mlog
+        self.positions = positions
+        self.count = len(positions)
+        self.lookups = {}
+        try:
+            with numpy.errstate(all='ignore'):
+                (v, invalid) = self.eval_node(self.tree)
+                v = numpy.asarray(v)
+                if v.shape != (self.count,):
+                    v = numpy.resize(v, self.count)
+        except (TypeError, ValueError, AttributeError):
+            raise UnsupportedExpression(self.expression)
+        finally:
+            self.mlog = None
+            self.positions = None
+            self.lookups = {}
+        return (v, invalid)
+
+    def valid_points(self, mlog, positions):
+        '''return a boolean array, True where a condition holds'''
+        (v, invalid) = self.evaluate(mlog, positions)
+        return numpy.logical_and(v.astype(bool), numpy.logical_not(invalid))
+
+    def lookup(self, mtype):
+        '''return the index of the last message of a type at or before each
+        position, -1 where there is none'''
+        if mtype not in self.lookups:
+            if mtype in self.types:
+                tpos = self.mlog.type_positions(mtype)
+                idx = numpy.searchsorted(tpos, self.positions, side='right') - 1
+            else:
+                idx = numpy.empty(self.count, dtype=numpy.intp)
+                idx.fill(-1)
+            self.lookups[mtype] = idx
+        return self.lookups[mtype]
+
+    def no_value(self):
+        return numpy.zeros(self.count, dtype=bool)
+
+    def eval_node(self, node):
+        if isinstance(node, ast.Num):
+            return (node.n, self.no_value())
+        if isinstance(node, ast.Str):
+            return (node.s, self.no_value())
+        if isinstance(node, ast.Name):
+            return (constants[node.id], self.no_value())
+        if isinstance(node, ast.Attribute):
+            mtype = node.value.id
+            idx = self.lookup(mtype)
+            invalid = idx < 0
+            if mtype not in self.types:
+                return (numpy.zeros(self.count), invalid)
+            column = self.mlog.column(mtype, node.attr)
+            if column is None:
+                # the per-message path raises for a missing field
+                raise UnsupportedExpression(self.expression)
+            if len(column) == 0:
+                return (numpy.zeros(self.count), invalid)
+            return (column[numpy.maximum(idx, 0)], invalid)
+        if isinstance(node, ast.BinOp):
+            (a, inv_a) = self.eval_node(node.left)
+            (b, inv_b) = self.eval_node(node.right)
+            invalid = inv_a | inv_b
+            if type(node.op) in divide_ops:
+                invalid = invalid | (numpy.asarray(b) == 0)
+            return (binary_ops[type(node.op)](a, b), invalid)
+        if isinstance(node, ast.UnaryOp):
+            (a, invalid) = self.eval_node(node.operand)
+            return (unary_ops[type(node.op)](a), invalid)
+        if isinstance(node, ast.BoolOp):
+            # python only evaluates the later values when it needs them, so
+            # they only make the result invalid where they are used
+            (v, invalid) = self.eval_node(node.values[0])
+            for n in node.values[1:]:
+                (b, inv_b) = self.eval_node(n)
+                truth = numpy.asarray(v).astype(bool)
+                if isinstance(node.op, ast.And):
+                    use_b = truth
+                else:
+                    use_b = numpy.logical_not(truth)
+                v = numpy.where(use_b, b, v)
+                invalid = invalid | (use_b & inv_b)
+            return (v, invalid)
+        if isinstance(node, ast.Compare):
+            (left, invalid) = self.eval_node(node.left)
+            result = numpy.ones(self.count, dtype=bool)
+            for i in range(len(node.ops)):
+                (right, inv_right) = self.eval_node(node.comparators[i])
+                invalid = invalid | (result & inv_right)
+                result = result & compare_ops[type(node.ops[i])](left, right)
+                left = right
+            return (result, invalid)
+        if isinstance(node, ast.Call):
+            args = []
+            invalid = self.no_value()
+            for a in node.args:
+                (v, inv) = self.eval_node(a)
+                args.append(v)
+                invalid = invalid | inv
+            return (functions[node.func.id][0](*args), invalid)
+        raise UnsupportedExpression(self.expression)
@@ -8,10 +8,13 @@ import ast
 import sys, struct, time, os, datetime
 import math, re
 import matplotlib
+import numpy
 from math import *
 from pymavlink.mavextra import *
 import pylab
 from pymavlink import mavutil
+from MAVProxy.modules.lib.colexpr import ColumnExpression, UnsupportedExpression
+from MAVProxy.modules.lib import mp_logparse
 
 colors = [ 'red', 'green', 'blue', 'orange', 'olive', 'black', 'grey', 'yellow', 'brown', 'darkcyan',
            'cornflowerblue', 'darkmagenta', 'deeppink', 'darkred']
@@ -268,19 +271,12 @@ class MavGraph(object):
     def add_data(self, t, msg, vars, flightmode):
         '''add some data'''
         mtype = msg.get_type()
-        if self.show_flightmode and (len(self.modes) == 0 or self.modes[-1][1] != flightmode):
+        if self.show_flightmode and self.message_modes and (len(self.modes) == 0 or self.modes[-1][1] != flightmode):
             self.modes.append((t, flightmode))
-        for i in range(0, len(self.fields)):
+        for i in self.message_fields:
             if mtype not in self.field_types[i]:
                 continue
-            f = self.fields[i]
-            if f.endswith(":2"):
-                self.axes[i] = 2
-                f = f[:-2]
-            if f.endswith(":1"):
-                self.first_only[i] = True
-                f = f[:-2]
-            v = mavutil.evaluate_expression(f, vars)
+            v = mavutil.evaluate_expression(self.expressions[i], vars)
             if v is None:
                 continue
             if self.xaxis is None:
@@ -292,15 +288,23 @@ class MavGraph(object):
             self.y[i].append(v)
             self.x[i].append(xv)
 
-
     def process_mav(self, mlog, timeshift):
         '''process one file'''
+        self.message_fields = range(len(self.fields))
+        self.message_modes = True
+        if hasattr(mlog, 'column'):
+            self.message_fields = self.process_columns(mlog, timeshift)
+            if len(self.message_fields) == 0:
+                return
+        msg_types = set()
+        for i in self.message_fields:
+            msg_types = msg_types.union(self.field_types[i])
         self.vars = {}
         while True:
             msg = mlog.recv_msg()
             if msg is None:
                 break
-            if msg.get_type() not in self.msg_types:
+            if msg.get_type() not in msg_types:
                 continue
             if self.condition:
                 if not mavutil.evaluate_condition(self.condition, mlog.messages):
@@ -308,6 +312,87 @@ class MavGraph(object):
             tdays = matplotlib.dates.date2num(datetime.datetime.fromtimestamp(msg._timestamp+timeshift))
             self.add_data(tdays, msg, mlog.messages, mlog.flightmode)
 
+    def positions(self, mlog, types):
+        '''positions in a mavmemlog of the messages of a set of types'''
+        plist = [mlog.type_positions(t) for t in types]
+        if len(plist) == 0:
+            return numpy.zeros(0, dtype=numpy.intp)
+        return numpy.unique(numpy.concatenate(plist))
+
+    def dates(self, timestamps, timeshift):
+        '''convert an array of timestamps to local time matplotlib dates'''
+        def date(t):
+            return matplotlib.dates.date2num(datetime.datetime.fromtimestamp(t+timeshift))
+        if len(timestamps) == 0:
+            return timestamps
+        (t0, t1) = (timestamps[0], timestamps[-1])
+        d0 = date(t0)
+        if abs(d0 + (t1 - t0) / 86400.0 - date(t1)) < 1.0e-6:
+            return d0 + (timestamps - t0) / 86400.0
+        # the UTC offset changes during the log
+        return numpy.array([date(t) for t in timestamps])
+
+    def process_columns(self, mlog, timeshift):
+        '''process one in-memory log by evaluating the expressions over its
+        columns. Returns the fields that need the per-message path'''
+        types = set(mlog.types())
+        try:
+            condition = None
+            if self.condition:
+                condition = ColumnExpression(self.condition, types)
+            xaxis = None
+            if self.xaxis is not None:
+                xaxis = ColumnExpression(self.xaxis, types)
+
+            if self.show_flightmode:
+                pos = self.positions(mlog, self.msg_types.intersection(types))
+                if condition is not None:
+                    pos = pos[condition.valid_points(mlog, pos)]
+                self.add_modes(mlog, pos, timeshift)
+                self.message_modes = False
+        except UnsupportedExpression:
+            return range(len(self.fields))
+
+        message_fields = []
+        for i in range(len(self.fields)):
+            try:
+                expression = ColumnExpression(self.expressions[i], types)
+                pos = self.positions(mlog, self.field_types[i].intersection(types))
+                if condition is not None:
+                    pos = pos[condition.valid_points(mlog, pos)]
+                (v, invalid) = expression.evaluate(mlog, pos)
+                if xaxis is not None:
+                    (xv, xinvalid) = xaxis.evaluate(mlog, pos)
+                    invalid = invalid | xinvalid
+            except UnsupportedExpression:
+                message_fields.append(i)
+                continue
+            valid = numpy.logical_not(invalid)
+            if xaxis is None:
+                xv = self.dates(mlog.timestamps(pos[valid]), timeshift)
+            else:
+                xv = xv[valid]
+            self.x[i] = xv
+            self.y[i] = v[valid]
+        return message_fields
+
+    def add_modes(self, mlog, pos, timeshift):
+        '''add the flight mode changes seen at positions in a mavmemlog'''
+        flightmodes = mlog.flightmode_list()
+        if len(pos) == 0 or len(flightmodes) == 0:
+            return
+        starts = numpy.array([t1 for (mode, t1, t2) in flightmodes], dtype=float)
+        timestamps = mlog.timestamps(pos)
+        idx = numpy.searchsorted(starts, timestamps, side='right') - 1
+        changes = numpy.flatnonzero(idx[1:] != idx[:-1]) + 1
+        for p in [0] + list(changes):
+            if idx[p] < 0:
+                mode = None
+            else:
+                mode = flightmodes[idx[p]][0]
+            if len(self.modes) == 0 or self.modes[-1][1] != mode:
+                self.modes.append((self.dates(timestamps[p:p+1], timeshift)[0], mode))
+
     def process(self, block=True):
         '''process and display graph'''
         self.msg_types = set()
@@ -320,6 +405,7 @@ class MavGraph(object):
         self.modes = []
         self.axes = []
         self.first_only = []
+        self.expressions = []
         re_caps = re.compile('[A-Z_][A-Z0-9_]+')
         for f in self.fields:
             caps = set(re.findall(re_caps, f))
@@ -327,8 +413,17 @@ class MavGraph(object):
             self.field_types.append(caps)
             self.y.append([])
             self.x.append([])
-            self.axes.append(1)
-            self.first_only.append(False)
+            axis = 1
+            first_only = False
+            if f.endswith(":2"):
+                axis = 2
+                f = f[:-2]
+            if f.endswith(":1"):
+                first_only = True
+                f = f[:-2]
+            self.axes.append(axis)
+            self.first_only.append(first_only)
+            self.expressions.append(f)
 
         if self.labels is not None:
             labels = self.labels.split(',')
@@ -395,9 +490,9 @@ if __name__ == "__main__":
     filenames = []
     for f in args.logs_fields:
         if os.path.exists(f):
-            mlog = mavutil.mavlink_connection(f, notimestamps=args.notimestamps,
-                                              zero_time_base=args.zero_time_base,
-                                              dialect=args.dialect)
+            mlog = mp_logparse.parse_log(f, notimestamps=args.notimestamps,
+                                         zero_time_base=args.zero_time_base,
+                                         dialect=args.dialect)
             mg.add_mav(mlog)
         else:
             mg.add_field(f)
@@ -1,16 +1,111 @@
 '''in-memory mavlink log'''
 
-from pymavlink import mavutil
+import array
+import os
+import cPickle as pickle
+
+import numpy
+
+from pymavlink import mavutil, DFReader
+
+# bump when the layout written by mavmemlog.save() changes
+MEMLOG_VERSION = 3
+
+# the raw frame of each MAVLink message and its length are kept in
+# columns named with HEADER_PREFIX, so they can't clash with message
+# fields. Frames are stored as fixed width strings, which drop trailing
+# zero bytes, so the length is needed to restore them
+HEADER_PREFIX = '_header.'
+MSGBUF_COLUMN = HEADER_PREFIX + 'msgbuf'
+MSGLEN_COLUMN = HEADER_PREFIX + 'msglen'
+
+# largest integer a double holds exactly
+MAX_EXACT_INT = 2**53
+
+class ColumnBuilder(object):
+    '''collects the values of one field in a compact array, falling back
+    to a list for values that are not plain numbers'''
+    def __init__(self, v, typecode=None):
+        if typecode is not None:
+            self.values = array.array(typecode)
+        elif isinstance(v, float):
+            self.values = array.array('d')
+        elif isinstance(v, (int, long)):
+            self.values = array.array('l')
+        else:
+            self.values = []
+        self.append(v)
+
+    def append(self, v):
+        values = self.values
+        if isinstance(values, list):
+            values.append(v)
+            return
+        try:
+            if isinstance(v, (int, long)):
+                if values.typecode == 'd' and abs(v) > MAX_EXACT_INT:
+                    raise TypeError(v)
+            elif values.typecode != 'd':
+                if not isinstance(v, float):
+                    raise TypeError(v)
+                self.values = values = array.array('d', values)
+            values.append(v)
+        except OverflowError:
+            # 'l' is only 32 bits on some platforms, too small for
+            # microsecond timestamps
+            if abs(v) > MAX_EXACT_INT:
+                self.values = list(values)
+                self.values.append(v)
+                return
+            self.values = array.array('d', values)
+            self.values.append(v)
+        except TypeError:
+            self.values = list(values)
+            self.values.append(v)
+
+    def column(self):
+        '''the finished column, a numpy array or a list'''
+        if isinstance(self.values, list):
+            return self.values
+        return numpy.frombuffer(self.values, dtype=self.values.typecode)
+
+def has_header(m):
+    '''see if a message is a MAVLink message with a raw frame to keep'''
+    return getattr(m, '_msgbuf', None) is not None and m.get_type() != 'BAD_DATA'
 
 class mavmemlog(mavutil.mavfile):
     '''a MAVLink log in memory. This allows loading a log into
-    memory to make it easier to do multiple sweeps over a log'''
+    memory to make it easier to do multiple sweeps over a log.
+
+    The log is stored by column: for each message type there is one
+    array per field, and for the log as a whole a type, row and
+    timestamp array giving the message order. recv_msg() rebuilds
+    message objects from the columns one at a time'''
     def __init__(self, mav, progress_callback=None):
         mavutil.mavfile.__init__(self, None, 'memlog')
-        self._msgs = []
-        self._count = 0
         self.rewind()
         self._flightmodes = []
+        # message type name and first message of each type, by type index
+        self._type_names = []
+        self._protos = []
+        self._columns = []
+        # directory the columns are mapped from, see load()
+        self.path = None
+        self._msg_type = numpy.zeros(0, dtype=numpy.uint16)
+        self._msg_row = numpy.zeros(0, dtype=numpy.uint32)
+        self._timestamps = numpy.zeros(0, dtype=numpy.float64)
+        if mav is not None:
+            self.parse(mav, progress_callback)
+        self.init_view()
+
+    def parse(self, mav, progress_callback):
+        '''read all messages from a mavlink connection into columns'''
+        type_ids = {}
+        builders = []
+        msg_type = array.array('H')
+        msg_row = array.array('L')
+        timestamps = array.array('d')
+        type_count = []
         last_flightmode = None
         last_timestamp = None
         last_pct = 0
@@ -22,26 +117,297 @@ class mavmemlog(mavutil.mavfile):
             if int(mav.percent) != last_pct and progress_callback:
                 progress_callback(int(mav.percent))
                 last_pct = int(mav.percent)
-            self._msgs.append(m)
+            mtype = m.get_type()
+            tid = type_ids.get(mtype)
+            if tid is None:
+                tid = len(self._type_names)
+                type_ids[mtype] = tid
+                self._type_names.append(mtype)
+                self._protos.append(m)
+                type_count.append(0)
+                fields = [(f, ColumnBuilder(getattr(m, f, None))) for f in m.get_fieldnames()]
+                frames = None
+                if has_header(m):
+                    frames = ([], ColumnBuilder(len(m._msgbuf), 'H'))
+                builders.append((fields, frames))
+            else:
+                (fields, frames) = builders[tid]
+                for (f, b) in fields:
+                    b.append(getattr(m, f, None))
+                if frames is not None:
+                    frames[1].append(len(m._msgbuf))
+            if frames is not None:
+                frames[0].append(str(bytearray(m._msgbuf)))
+            msg_type.append(tid)
+            msg_row.append(type_count[tid])
+            type_count[tid] += 1
+            timestamps.append(m._timestamp)
             if mav.flightmode != last_flightmode:
                 if len(self._flightmodes) > 0:
                     (mode, t1, t2) = self._flightmodes[-1]
                     self._flightmodes[-1] = (mode, t1, m._timestamp)
                 self._flightmodes.append((mav.flightmode, m._timestamp, None))
                 last_flightmode = mav.flightmode
-            self._count += 1
             last_timestamp = m._timestamp
             self.check_param(m)
         if last_timestamp is not None and len(self._flightmodes) > 0:
             (mode, t1, t2) = self._flightmodes[-1]
             self._flightmodes[-1] = (mode, t1, last_timestamp)
 
+        self._msg_type = numpy.frombuffer(msg_type, dtype=numpy.uint16)
+        self._msg_row = numpy.frombuffer(msg_row, dtype='u%u' % msg_row.itemsize)
+        self._timestamps = numpy.frombuffer(timestamps, dtype=numpy.float64)
+        self._columns = []
+        for (fields, frames) in builders:
+            columns = [(f, c.column()) for (f, c) in fields]
+            if frames is not None:
+                columns.append((MSGBUF_COLUMN, numpy.array(frames[0], dtype=str)))
+                columns.append((MSGLEN_COLUMN, frames[1].column()))
+            self._columns.append(columns)
+
+    def init_view(self):
+        '''set up the message order view over all messages'''
+        self._type_ids = {}
+        for i in range(len(self._type_names)):
+            self._type_ids[self._type_names[i]] = i
+        # positions of the selected messages, None for all of them
+        self._selection = None
+        self._count = len(self._msg_type)
+        self._type_positions = {}
+        self._getters = []
+        self._frame_getters = []
+        self._elements = []
+        for tid in range(len(self._columns)):
+            proto = self._protos[tid]
+            getters = {}
+            for (f, c) in self._columns[tid]:
+                if isinstance(c, list):
+                    getters[f] = c.__getitem__
+                else:
+                    getters[f] = c.item
+            frame_getters = None
+            if MSGBUF_COLUMN in getters:
+                frame_getters = (getters.pop(MSGBUF_COLUMN), getters.pop(MSGLEN_COLUMN))
+            self._frame_getters.append(frame_getters)
+            fields = [f for (f, c) in self._columns[tid] if f in getters]
+            self._getters.append([(f, getters[f]) for f in fields])
+            # DF messages hold their fields in _elements, so note where
+            # each field goes and the multiplier to undo
+            elements = None
+            if getattr(proto, '_elements', None) is not None:
+                elements = []
+                for f in fields:
+                    i = proto.fmt.colhash[f]
+                    mult = None
+                    if proto._apply_multiplier and i < len(proto.fmt.msg_mults):
+                        mult = proto.fmt.msg_mults[i]
+                    elements.append((getters[f], i, mult))
+            self._elements.append(elements)
+
+    def chunk(self):
+        '''return the parsed log as a dictionary that can be sent to
+        another process and joined to others with merge()'''
+        return { 'type_names' : self._type_names,
+                 'protos' : self._protos,
+                 'columns' : self._columns,
+                 'msg_type' : self._msg_type,
+                 'msg_row' : self._msg_row,
+                 'timestamps' : self._timestamps,
+                 'flightmodes' : self._flightmodes,
+                 'params' : self.params }
+
+    def merge(self, chunks):
+        '''build the log from consecutive pieces parsed separately and
+        returned by chunk(). Messages at the start of a piece without a
+        timestamp or flight mode of their own take them from the piece
+        before'''
+        type_ids = {}
+        fields = []
+        parts = []
+        counts = []
+        msg_type = []
+        msg_row = []
+        timestamps = []
+        self._flightmodes = []
+        for c in chunks:
+            ntypes = len(c['type_names'])
+            tmap = numpy.zeros(ntypes, dtype=numpy.uint16)
+            row_ofs = numpy.zeros(ntypes, dtype=numpy.uint64)
+            chunk_counts = numpy.bincount(c['msg_type'], minlength=ntypes)
+            for i in range(ntypes):
+                mtype = c['type_names'][i]
+                cfields = [f for (f, col) in c['columns'][i]]
+                tid = type_ids.get(mtype)
+                if tid is None:
+                    tid = len(self._type_names)
+                    type_ids[mtype] = tid
+                    self._type_names.append(mtype)
+                    self._protos.append(c['protos'][i])
+                    fields.append(cfields)
+                    parts.append([])
+                    counts.append(0)
+                elif cfields != fields[tid]:
+                    raise ValueError('fields of %s differ between log pieces' % mtype)
+                tmap[i] = tid
+                row_ofs[i] = counts[tid]
+                counts[tid] += int(chunk_counts[i])
+                parts[tid].append([col for (f, col) in c['columns'][i]])
+            msg_type.append(tmap[c['msg_type']])
+            msg_row.append(row_ofs[c['msg_type']] + c['msg_row'])
+            timestamps.append(c['timestamps'])
+            for (mode, t1, t2) in c['flightmodes']:
+                if len(self._flightmodes) > 0:
+                    (last_mode, last_t1, last_t2) = self._flightmodes[-1]
+                    if numpy.isnan(t1):
+                        t1 = last_t2
+                    if mode == last_mode:
+                        self._flightmodes[-1] = (mode, last_t1, t2)
+                        continue
+                    self._flightmodes[-1] = (last_mode, last_t1, t1)
+                self._flightmodes.append((mode, t1, t2))
+            valid = c['timestamps'][numpy.logical_not(numpy.isnan(c['timestamps']))]
+            if len(self._flightmodes) > 0 and len(valid) > 0:
+                # the current mode runs on to the end of this piece
+                (mode, t1, t2) = self._flightmodes[-1]
+                self._flightmodes[-1] = (mode, t1, valid[-1])
+            self.params.update(c['params'])
+
+        if len(chunks) > 0:
+            self._msg_type = numpy.concatenate(msg_type)
+            self._msg_row = numpy.concatenate(msg_row)
+            self._timestamps = numpy.concatenate(timestamps)
+        # messages that take their time from the previous message
+        missing = numpy.isnan(self._timestamps)
+        if missing.any():
+            idx = numpy.where(missing, 0, numpy.arange(len(self._timestamps)))
+            numpy.maximum.accumulate(idx, out=idx)
+            self._timestamps = self._timestamps[idx]
+        self._columns = []
+        for tid in range(len(parts)):
+            columns = []
+            for i in range(len(fields[tid])):
+                pieces = [p[i] for p in parts[tid]]
+                if any([isinstance(p, list) for p in pieces]):
+                    column = []
+                    for p in pieces:
+                        if isinstance(p, list):
+                            column.extend(p)
+                        else:
+                            column.extend(p.tolist())
+                else:
+                    column = numpy.concatenate(pieces)
+                columns.append((fields[tid][i], column))
+            self._columns.append(columns)
+        self.init_view()
+
+    def save(self, dirname):
+        '''save the log into a directory. Numeric columns go in .npy files
+        that load() can memory map, everything else in a pickle'''
+        numpy.save(os.path.join(dirname, 'msg_type.npy'), self._msg_type)
+        numpy.save(os.path.join(dirname, 'msg_row.npy'), self._msg_row)
+        numpy.save(os.path.join(dirname, 'timestamps.npy'), self._timestamps)
+        columns = []
+        for tid in range(len(self._columns)):
+            cols = []
+            for i in range(len(self._columns[tid])):
+                (f, c) = self._columns[tid][i]
+                if isinstance(c, list):
+                    cols.append((f, c))
+                else:
+                    name = 'c%u_%u.npy' % (tid, i)
+                    numpy.save(os.path.join(dirname, name), c)
+                    cols.append((f, name))
+            columns.append(cols)
+        meta = { 'version' : MEMLOG_VERSION,
+                 'type_names' : self._type_names,
+                 'protos' : self._protos,
+                 'columns' : columns,
+                 'flightmodes' : self._flightmodes,
+                 'params' : self.params }
+        f = open(os.path.join(dirname, 'meta.pck'), 'wb')
+        pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+
+    def load(self, dirname):
+        '''load a log saved with save(), memory mapping the columns'''
+        f = open(os.path.join(dirname, 'meta.pck'), 'rb')
+        meta = pickle.load(f)
+        f.close()
+        if meta.get('version', None) != MEMLOG_VERSION:
+            raise ValueError('bad memlog version in %s' % dirname)
+        def load_array(name):
+            return numpy.load(os.path.join(dirname, name), mmap_mode='r')
+        self._msg_type = load_array('msg_type.npy')
+        self._msg_row = load_array('msg_row.npy')
+        self._timestamps = load_array('timestamps.npy')
+        self._columns = []
+        for cols in meta['columns']:
+            columns = []
+            for (f, c) in cols:
+                if not isinstance(c, list):
+                    c = load_array(c)
+                columns.append((f, c))
+            self._columns.append(columns)
+        self._type_names = meta['type_names']
+        self._protos = meta['protos']
+        self._flightmodes = meta['flightmodes']
+        self.path = dirname
+        self.rewind()
+        self.params = meta['params']
+        self.init_view()
+
+    def message(self, pos):
+        '''rebuild the message at a position in the log'''
+        tid = self._msg_type.item(pos)
+        row = self._msg_row.item(pos)
+        proto = self._protos[tid]
+        elements = self._elements[tid]
+        if elements is not None:
+            e = list(proto._elements)
+            for (get, i, mult) in elements:
+                v = get(row)
+                if mult is not None:
+                    # all the scaled formats are integers
+                    v = int(round(v / mult))
+                e[i] = v
+            m = DFReader.DFMessage(proto.fmt, e, proto._apply_multiplier)
+        else:
+            m = proto.__class__.__new__(proto.__class__)
+            d = m.__dict__
+            d.update(proto.__dict__)
+            for (f, get) in self._getters[tid]:
+                d[f] = get(row)
+            frame_getters = self._frame_getters[tid]
+            if frame_getters is not None:
+                self.set_frame(m, frame_getters[0](row), frame_getters[1](row))
+        m._timestamp = self._timestamps.item(pos)
+        return m
+
+    def set_frame(self, m, msgbuf, msglen):
+        '''give a rebuilt MAVLink message its own frame and header'''
+        if len(msgbuf) < msglen:
+            msgbuf = msgbuf.ljust(msglen, '\0')
+        b = bytearray(msgbuf)
+        if b[0] == mavutil.mavlink.PROTOCOL_MARKER_V1:
+            (hdrlen, incompat_flags, compat_flags, seq, srcSystem, srcComponent) = (6, 0, 0, b[2], b[3], b[4])
+        else:
+            (hdrlen, incompat_flags, compat_flags, seq, srcSystem, srcComponent) = (10, b[2], b[3], b[4], b[5], b[6])
+        mlen = b[1]
+        m._msgbuf = b
+        m._payload = msgbuf[hdrlen:hdrlen+mlen]
+        m._crc = b[hdrlen+mlen] | (b[hdrlen+mlen+1] << 8)
+        m._header = mavutil.mavlink.MAVLink_header(m._header.msgId, incompat_flags, compat_flags,
+                                                   mlen, seq, srcSystem, srcComponent)
 
     def recv_msg(self):
         '''message receive routine'''
         if self._index >= self._count:
             return None
-        m = self._msgs[self._index]
+        if self._selection is None:
+            pos = self._index
+        else:
+            pos = self._selection[self._index]
+        m = self.message(pos)
         type = m.get_type()
         self._index += 1
         self.percent = (100.0 * self._index) / self._count
@@ -79,6 +445,63 @@ class mavmemlog(mavutil.mavfile):
         '''return list of all flightmodes as tuple of mode and start time'''
         return self._flightmodes
 
+    def last_messages(self):
+        '''return the last selected message of each type, like the messages
+        dictionary of a connection that has read the whole log'''
+        ret = {}
+        for mtype in self._type_names:
+            pos = self.type_positions(mtype)
+            if len(pos) > 0:
+                ret[mtype] = self.message(pos[-1])
+        return ret
+
+    def types(self):
+        '''return the message types in the log'''
+        return self._type_names[:]
+
+    def type_positions(self, mtype):
+        '''return the positions in the log of the selected messages of a type'''
+        if mtype in self._type_positions:
+            return self._type_positions[mtype]
+        tid = self._type_ids.get(mtype)
+        if tid is None:
+            ret = numpy.zeros(0, dtype=numpy.intp)
+        else:
+            ret = numpy.flatnonzero(self._msg_type == tid)
+            if self._selection is not None:
+                selected = numpy.zeros(len(self._msg_type), dtype=bool)
+                selected[self._selection] = True
+                ret = ret[selected[ret]]
+        self._type_positions[mtype] = ret
+        return ret
+
+    def type_timestamps(self, mtype):
+        '''return the timestamps of the selected messages of a type'''
+        return self._timestamps[self.type_positions(mtype)]
+
+    def timestamps(self, positions):
+        '''return the timestamps of the messages at positions in the log'''
+        return self._timestamps[positions]
+
+    def column(self, mtype, field):
+        '''return a numpy array of the values of a field for the selected
+        messages of a type, or None if there is no such field'''
+        tid = self._type_ids.get(mtype)
+        if tid is None:
+            return None
+        for (f, c) in self._columns[tid]:
+            if f == field:
+                break
+        else:
+            return None
+        rows = self._msg_row[self.type_positions(mtype)]
+        if isinstance(c, list):
+            ret = numpy.empty(len(rows), dtype=object)
+            for i in range(len(rows)):
+                ret[i] = c[rows[i]]
+            return ret
+        return c[rows]
+
     def reduce_by_flightmodes(self, flightmode_selections):
         '''reduce data using flightmode selections'''
         if len(flightmode_selections) == 0:
@@ -90,13 +513,21 @@ class mavmemlog(mavutil.mavfile):
         if all_false:
             # treat all false as all modes wanted'''
             return
-        new_msgs = []
-        idx = 0
-        for m in self._msgs:
-            while idx < len(self._flightmodes) and m._timestamp >= self._flightmodes[idx][2]:
-                idx += 1
-            if idx < len(flightmode_selections) and flightmode_selections[idx]:
-                new_msgs.append(m)
-        self._msgs = new_msgs
-        self._count = len(new_msgs)
+        # the flight mode of each message is the first mode ending after it
+        ends = numpy.array([t2 for (mode, t1, t2) in self._flightmodes], dtype=float)
+        if len(ends) > 0:
+            # the last mode runs to the end of the log
+            ends[-1] = numpy.inf
+        idx = numpy.searchsorted(ends, self._timestamps, side='right')
+        selected = numpy.zeros(len(ends)+1, dtype=bool)
+        for i in range(min(len(flightmode_selections), len(ends))):
+            selected[i] = bool(flightmode_selections[i])
+        mask = selected[idx]
+        if self._selection is not None:
+            mask[:] = False
+            keep = self._selection[selected[idx[self._selection]]]
+            mask[keep] = True
+        self._selection = numpy.flatnonzero(mask)
+        self._count = len(self._selection)
+        self._type_positions = {}
         self.rewind()
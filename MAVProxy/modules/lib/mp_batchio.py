@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+batched I/O for UDP master links and outputs
+
+on receive all pending datagrams are drained from a link in one
+wakeup of the main loop. On send the writes for each output are
+coalesced and flushed once per loop iteration, packing several MAVLink
+packets into each datagram up to a size limit.
+'''
+
+class MPBatchIO(object):
+    '''batched receive and coalesced send for mavlink connections'''
+    def __init__(self, max_datagrams=64, max_size=1400):
+        self.max_datagrams = max_datagrams
+        self.max_size = max_size
+        # conn -> list of pending buffers, in the order of first write
+        self.pending = {}
+        self.pending_len = {}
+        self.counters = { 'RecvWakeups' : 0, 'RecvDatagrams' : 0,
+                          'SendWrites' : 0, 'SendPackets' : 0 }
+
+    def drain(self, conn, s):
+        '''read any further pending datagrams from conn, returning all of
+        the data (starting with s) joined into one buffer'''
+        bufs = [s]
+        while len(bufs) < self.max_datagrams:
+            try:
+                d = conn.recv(16*1024)
+            except Exception:
+                break
+            if not d:
+                break
+            bufs.append(d)
+        self.counters['RecvWakeups'] += 1
+        self.counters['RecvDatagrams'] += len(bufs)
+        if len(bufs) == 1:
+            return s
+        return ''.join([str(b) for b in bufs])
+
+    def write(self, conn, buf):
+        '''queue buf to be written to conn on the next flush'''
+        self.counters['SendPackets'] += 1
+        if not conn in self.pending:
+            self.pending[conn] = [buf]
+            self.pending_len[conn] = len(buf)
+            return
+        if self.pending_len[conn] + len(buf) > self.max_size:
+            self.flush_conn(conn)
+            self.pending[conn] = [buf]
+            self.pending_len[conn] = len(buf)
+            return
+        self.pending[conn].append(buf)
+        self.pending_len[conn] += len(buf)
+
+    def flush_conn(self, conn):
+        '''write out the pending buffers for one connection'''
+        bufs = self.pending.pop(conn, None)
+        self.pending_len.pop(conn, None)
+        if not bufs:
+            return
+        self.counters['SendWrites'] += 1
+        if len(bufs) == 1:
+            data = bufs[0]
+        else:
+            data = ''.join([str(b) for b in bufs])
+        try:
+            conn.write(data)
+        except Exception:
+            pass
+
+    def flush(self):
+        '''write out everything that is pending'''
+        for conn in self.pending.keys():
+            self.flush_conn(conn)
+
+    def discard(self, conn):
+        '''forget pending data for a connection that is being closed'''
+        self.pending.pop(conn, None)
+        self.pending_len.pop(conn, None)
+
+    def recv_ratio(self):
+        '''average datagrams read per wakeup'''
+        if self.counters['RecvWakeups'] == 0:
+            return 0
+        return self.counters['RecvDatagrams'] / float(self.counters['RecvWakeups'])
+
+    def send_ratio(self):
+        '''average packets sent per write'''
+        if self.counters['SendWrites'] == 0:
+            return 0
+        return self.counters['SendPackets'] / float(self.counters['SendWrites'])
+
+    def __str__(self):
+        return "recv %.1f datagrams/wakeup, send %.1f packets/write %s" % (self.recv_ratio(),
+                                                                          self.send_ratio(),
+                                                                          self.counters)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+'''
+duplicate packet suppression across redundant links
+
+remembers the keys of recently received packets in a fixed size
+sliding window, so a copy of a packet arriving on a second link can
+be recognised and dropped
+'''
+
+class MPDedup(object):
+    '''sliding window of recently seen packet keys'''
+    def __init__(self, window=512):
+        self.window = window
+        self.ring = [None] * window
+        self.pos = 0
+        # key -> (linknum, ring position)
+        self.seen = {}
+        self.counters = { 'Unique' : 0, 'Duplicate' : 0 }
+
+    def check(self, key, linknum):
+        '''return True if this is the first copy of a packet, False if the
+        same packet has already been seen on a different link'''
+        owner = self.seen.get(key)
+        if owner is not None and owner[0] != linknum:
+            self.counters['Duplicate'] += 1
+            return False
+        # the same key on the same link means the sequence number has
+        # wrapped, so it is a new packet
+        old = self.ring[self.pos]
+        if old is not None and self.seen.get(old, (None, None))[1] == self.pos:
+            del self.seen[old]
+        self.ring[self.pos] = key
+        self.seen[key] = (linknum, self.pos)
+        self.pos = (self.pos + 1) % self.window
+        self.counters['Unique'] += 1
+        return True
+
+    def __str__(self):
+        return "%u unique %u duplicate" % (self.counters['Unique'], self.counters['Duplicate'])
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+'''
+event loop core for the mavproxy main loop
+
+file descriptors are registered once with a handler and dispatched
+from epoll (falling back to poll or select where epoll is not
+available). Periodic work is driven by timers rather than by every
+wakeup of the loop.
+'''
+
+import select, time, errno
+
+class MPTimer(object):
+    '''a periodic timer run from the event loop'''
+    def __init__(self, period, fn):
+        self.period = period
+        self.fn = fn
+        self.next_run = time.time()
+
+class MPEventLoop(object):
+    '''a persistent fd->handler registry with O(1) dispatch'''
+    def __init__(self):
+        self.handlers = {}
+        self.timers = []
+        self.counters = { 'Wakeups' : 0, 'Dispatches' : 0, 'Timers' : 0 }
+        if hasattr(select, 'epoll'):
+            self.backend = 'epoll'
+            self.poller = select.epoll()
+            self.read_mask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, 'poll'):
+            self.backend = 'poll'
+            self.poller = select.poll()
+            self.read_mask = select.POLLIN | select.POLLERR | select.POLLHUP
+        else:
+            # windows only has select()
+            self.backend = 'select'
+            self.poller = None
+
+    def register(self, fd, fn, arg=None):
+        '''register a read handler fn(arg) for a file descriptor'''
+        if fd is None:
+            return
+        self.handlers[fd] = (fn, arg)
+        if self.poller is None:
+            return
+        try:
+            self.poller.register(fd, self.read_mask)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EEXIST:
+                self.handlers.pop(fd)
+                raise
+            self.poller.modify(fd, self.read_mask)
+
+    def unregister(self, fd):
+        '''remove the handler for a file descriptor'''
+        if fd is None or self.handlers.pop(fd, None) is None:
+            return
+        if self.poller is None:
+            return
+        try:
+            self.poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            # the fd may already have been closed
+            pass
+
+    def add_timer(self, period, fn):
+        '''add a timer calling fn() every period seconds'''
+        t = MPTimer(period, fn)
+        self.timers.append(t)
+        return t
+
+    def remove_timer(self, t):
+        '''remove a timer'''
+        if t in self.timers:
+            self.timers.remove(t)
+
+    def run_timers(self):
+        '''run any timers which are due'''
+        tnow = time.time()
+        for t in self.timers[:]:
+            if tnow < t.next_run:
+                continue
+            t.next_run += t.period
+            if t.next_run < tnow:
+                # we have fallen behind, don't try to catch up
+                t.next_run = tnow + t.period
+            self.counters['Timers'] += 1
+            t.fn()
+
+    def next_timeout(self, max_timeout):
+        '''return how long we can wait before the next timer is due'''
+        timeout = max_timeout
+        if self.timers:
+            tnow = time.time()
+            for t in self.timers:
+                timeout = min(timeout, t.next_run - tnow)
+        return max(timeout, 0)
+
+    def poll(self, timeout):
+        '''wait for up to timeout seconds, returning the list of ready fds'''
+        try:
+            if self.backend == 'epoll':
+                return [ fd for (fd, ev) in self.poller.poll(timeout) ]
+            if self.backend == 'poll':
+                return [ fd for (fd, ev) in self.poller.poll(int(timeout*1000)) ]
+            (rin, win, xin) = select.select(self.handlers.keys(), [], [], timeout)
+            return rin
+        except (select.error, IOError, OSError):
+            # typically EINTR
+            return []
+
+    def run_once(self, max_timeout):
+        '''run due timers then wait for and dispatch ready fds'''
+        self.run_timers()
+        timeout = self.next_timeout(max_timeout)
+        if not self.handlers:
+            # nothing to wait on, avoid spinning the CPU
+            time.sleep(timeout)
+            return
+        self.counters['Wakeups'] += 1
+        for fd in self.poll(timeout):
+            handler = self.handlers.get(fd)
+            if handler is None:
+                # unregistered by an earlier handler in this batch
+                continue
+            (fn, arg) = handler
+            self.counters['Dispatches'] += 1
+            fn(arg)
+
+class MPSelectExtra(dict):
+    '''
+    dictionary of fd -> (fn, args) used by modules to add their own
+    file descriptors to the main loop. Entries are kept registered
+    with the event loop, calling handler(fd) when the fd is readable
+    '''
+    def __init__(self, eventloop, handler):
+        dict.__init__(self)
+        self.eventloop = eventloop
+        self.handler = handler
+
+    def __setitem__(self, fd, value):
+        dict.__setitem__(self, fd, value)
+        self.eventloop.register(fd, self.handler, fd)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self.eventloop.unregister(fd)
+
+    def pop(self, fd, *args):
+        ret = dict.pop(self, fd, *args)
+        self.eventloop.unregister(fd)
+        return ret
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+'''
+shared memory frame transport for image windows
+
+frames are written into one of two slots of a memory mapped file and
+only a small MPFrame control message goes through the IPC queue. The
+reader maps the same file and copies the pixels out directly. Each slot
+starts with the sequence number of the frame in it, which the writer
+clears while copying, so a reader that falls two frames behind sees a
+changed sequence number and drops the frame instead of showing a torn
+image. The writer never waits for the reader. A producer can also ask
+for a writable view of the next slot and write the pixels straight
+into it, so a frame is only copied once on its way to the reader.
+'''
+
+import ctypes, mmap, os, struct, tempfile
+
+SLOT_HEADER = struct.Struct('<Q')
+
+class MPFrame:
+    '''control message describing a frame in the shared buffer'''
+    def __init__(self, path, size, seq, slot, width, height, format='RGB'):
+        self.path = path
+        self.size = size
+        self.seq = seq
+        self.slot = slot
+        self.width = width
+        self.height = height
+        self.format = format
+
+class MPFrameBuffer(object):
+    '''double buffered frames in a memory mapped file'''
+    def __init__(self):
+        self.path = None
+        self.fd = None
+        self.mm = None
+        self.slot_size = 0
+        self.seq = 0
+        # size of the frame being written by begin_write()
+        self.write_size = 0
+        self.counters = { 'Written' : 0, 'Read' : 0, 'Dropped' : 0, 'Resized' : 0 }
+
+    def slot_offset(self, slot):
+        return slot * (SLOT_HEADER.size + self.slot_size)
+
+    def _map(self, slot_size):
+        '''create a new shared file big enough for two slots of slot_size'''
+        self.close(unlink=True)
+        # keep the frames in memory where there is a RAM backed filesystem
+        tmpdir = None
+        if os.path.isdir('/dev/shm'):
+            tmpdir = '/dev/shm'
+        (self.fd, self.path) = tempfile.mkstemp(prefix='mpframe-', dir=tmpdir)
+        self.slot_size = slot_size
+        total = 2 * (SLOT_HEADER.size + slot_size)
+        os.ftruncate(self.fd, total)
+        self.mm = mmap.mmap(self.fd, total)
+        self.counters['Resized'] += 1
+
+    def begin_write(self, size):
+        '''start a frame of size bytes in the next slot, returning a
+        writable ctypes buffer on the slot. The buffer must not be used
+        after end_write()'''
+        if size > self.slot_size:
+            # leave some room so small size changes don't remap
+            self._map(size + size//4)
+        self.seq += 1
+        ofs = self.slot_offset(self.seq % 2)
+        SLOT_HEADER.pack_into(self.mm, ofs, 0)
+        self.write_size = size
+        return (ctypes.c_char * size).from_buffer(self.mm, ofs+SLOT_HEADER.size)
+
+    def end_write(self, width, height, format='RGB'):
+        '''finish the frame started by begin_write(), returning the MPFrame
+        message to send to the reader'''
+        slot = self.seq % 2
+        SLOT_HEADER.pack_into(self.mm, self.slot_offset(slot), self.seq)
+        self.counters['Written'] += 1
+        return MPFrame(self.path, self.write_size, self.seq, slot, width, height, format)
+
+    def write(self, data, width, height, format='RGB'):
+        '''copy a frame into the next slot, returning the MPFrame message
+        to send to the reader'''
+        buf = self.begin_write(len(data))
+        ctypes.memmove(buf, data, len(data))
+        del buf
+        return self.end_write(width, height, format)
+
+    def read(self, frame):
+        '''return the pixel data for a frame, or None if it has been
+        overwritten or its buffer has gone'''
+        if frame.path != self.path:
+            self.close()
+            try:
+                self.fd = os.open(frame.path, os.O_RDWR)
+                self.mm = mmap.mmap(self.fd, 0)
+            except (OSError, IOError, mmap.error):
+                self.close()
+                self.counters['Dropped'] += 1
+                return None
+            self.path = frame.path
+            self.slot_size = len(self.mm)//2 - SLOT_HEADER.size
+        ofs = self.slot_offset(frame.slot)
+        if SLOT_HEADER.unpack_from(self.mm, ofs)[0] != frame.seq:
+            self.counters['Dropped'] += 1
+            return None
+        data = self.mm[ofs+SLOT_HEADER.size:ofs+SLOT_HEADER.size+frame.size]
+        if SLOT_HEADER.unpack_from(self.mm, ofs)[0] != frame.seq:
+            # overwritten while we were copying
+            self.counters['Dropped'] += 1
+            return None
+        self.counters['Read'] += 1
+        return data
+
+    def close(self, unlink=False):
+        '''unmap the buffer, removing the file if unlink is set'''
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if unlink and self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        self.path = None
@@ -6,6 +6,7 @@ June 2012
 '''
 
 import time
+import numpy
 from wx_loader import wx
 
 try:
@@ -14,6 +15,7 @@ except ImportError:
     import cv
 
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_framebuffer
 from MAVProxy.modules.lib import mp_widgets
 from MAVProxy.modules.lib.mp_menu import *
 
@@ -74,7 +76,8 @@ class MPImage():
                  key_events = False,
                  auto_size = False,
                  report_size_changes = False,
-                 daemon = False):
+                 daemon = False,
+                 shared_memory = True):
         import multiprocessing
 
         self.title = title
@@ -88,6 +91,11 @@ class MPImage():
         self.report_size_changes = report_size_changes
         self.menu = None
         self.popup_menu = None
+        # frames go through a shared memory buffer, with only a small
+        # control message on the queue
+        self.shared_memory = shared_memory
+        self.framebuffer = None
+        self.rgb_img = None
 
         from multiprocessing_queue import makeIPCQueue
         self.in_queue = makeIPCQueue()
@@ -121,10 +129,38 @@ class MPImage():
         '''set the currently displayed image'''
         if not self.is_alive():
             return
+        if self.shared_memory and img.depth == cv.IPL_DEPTH_8U and img.nChannels == 3:
+            self.set_image_shared(img, bgr)
+            return
+        if bgr:
+            # convert into a reused image rather than a new clone per frame
+            if (self.rgb_img is None or self.rgb_img.width != img.width or
+                self.rgb_img.height != img.height or self.rgb_img.depth != img.depth or
+                self.rgb_img.nChannels != img.nChannels):
+                self.rgb_img = cv.CreateImage((img.width, img.height), img.depth, img.nChannels)
+            cv.CvtColor(img, self.rgb_img, cv.CV_BGR2RGB)
+            img = self.rgb_img
+        if not self.shared_memory:
+            self.in_queue.put(MPImageData(img))
+            return
+        if self.framebuffer is None:
+            self.framebuffer = mp_framebuffer.MPFrameBuffer()
+        self.in_queue.put(self.framebuffer.write(img.tostring(), img.width, img.height))
+
+    def set_image_shared(self, img, bgr):
+        '''send an 8 bit 3 channel image by converting or copying it
+        straight into the shared frame buffer, the only copy of the frame'''
+        if self.framebuffer is None:
+            self.framebuffer = mp_framebuffer.MPFrameBuffer()
+        buf = self.framebuffer.begin_write(img.width * img.height * 3)
+        # a matrix header on the shared memory slot
+        slot = cv.fromarray(numpy.frombuffer(buf, dtype=numpy.uint8).reshape(img.height, img.width, 3))
         if bgr:
-            img = cv.CloneImage(img)
-            cv.CvtColor(img, img, cv.CV_BGR2RGB)
-        self.in_queue.put(MPImageData(img))
+            cv.CvtColor(img, slot, cv.CV_BGR2RGB)
+        else:
+            cv.Copy(img, slot)
+        del slot, buf
+        self.in_queue.put(self.framebuffer.end_write(img.width, img.height))
 
     def set_title(self, title):
         '''set the frame title'''
@@ -177,6 +213,8 @@ class MPImage():
         '''terminate child process'''
         self.child.terminate()
         self.child.join()
+        if self.framebuffer is not None:
+            self.framebuffer.close(unlink=True)
 
 class MPImageFrame(wx.Frame):
     """ The main frame of the viewer
@@ -219,6 +257,7 @@ class MPImagePanel(wx.Panel):
         self.popup_pos = None
         self.last_size = None
         self.done_PIL_warning = False
+        self.framebuffer = mp_framebuffer.MPFrameBuffer()
         state.brightness = 1.0
 
         # dragpos is the top left position in image coordinates
@@ -319,19 +358,14 @@ class MPImagePanel(wx.Panel):
         '''the redraw timer ensures we show new map tiles as they
         are downloaded'''
         state = self.state
+        frame = None
         while state.in_queue.qsize():
             obj = state.in_queue.get()
+            if isinstance(obj, mp_framebuffer.MPFrame):
+                # only the latest shared memory frame is shown
+                frame = obj
             if isinstance(obj, MPImageData):
-                img = wx.EmptyImage(obj.width, obj.height)
-                img.SetData(obj.data)
-                self.img = img
-                self.need_redraw = True
-                if state.auto_size:
-                    client_area = state.frame.GetClientSize()
-                    total_area = state.frame.GetSize()
-                    bx = max(total_area.x - client_area.x,0)
-                    by = max(total_area.y - client_area.y,0)
-                    state.frame.SetSize(wx.Size(obj.width+bx, obj.height+by))
+                self.set_image_data(obj.width, obj.height, obj.data)
             if isinstance(obj, MPImageTitle):
                 state.frame.SetTitle(obj.title)
             if isinstance(obj, MPImageMenu):
@@ -345,9 +379,27 @@ class MPImagePanel(wx.Panel):
                 self.full_size()
             if isinstance(obj, MPImageFitToWindow):
                 self.fit_to_window()
+        if frame is not None:
+            data = self.framebuffer.read(frame)
+            if data is not None:
+                self.set_image_data(frame.width, frame.height, data)
         if self.need_redraw:
             self.redraw()
 
+    def set_image_data(self, width, height, data):
+        '''display new RGB image data'''
+        state = self.state
+        if self.img is None or self.img.GetWidth() != width or self.img.GetHeight() != height:
+            self.img = wx.EmptyImage(width, height)
+        self.img.SetData(data)
+        self.need_redraw = True
+        if state.auto_size:
+            client_area = state.frame.GetClientSize()
+            total_area = state.frame.GetSize()
+            bx = max(total_area.x - client_area.x,0)
+            by = max(total_area.y - client_area.y,0)
+            state.frame.SetSize(wx.Size(width+bx, height+by))
+
     def on_size(self, event):
         '''handle window size changes'''
         state = self.state
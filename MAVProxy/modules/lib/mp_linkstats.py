@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''
+per-link statistics
+
+packet loss from MAVLink sequence numbers, inter-arrival jitter and
+relative latency histograms, and byte rates in and out. Updates use
+fixed size arrays so they are cheap enough to run on every packet.
+'''
+
+import array, bisect, time
+
+# upper bounds of the histogram bins, in milliseconds
+jitter_bins = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+latency_bins = [0, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+class MPHistogram(object):
+    '''a histogram with fixed bins'''
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = array.array('L', [0] * (len(bounds)+1))
+
+    def add(self, value):
+        '''add a value, counting it in the first bin it is <= to'''
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+
+    def snapshot(self):
+        '''return a list of (upper bound, count), with None for the last bin'''
+        return zip(self.bounds + [None], self.counts.tolist())
+
+    def __str__(self):
+        ret = []
+        for (bound, count) in self.snapshot():
+            if bound is None:
+                ret.append(">%u:%u" % (self.bounds[-1], count))
+            else:
+                ret.append("<=%u:%u" % (bound, count))
+        return " ".join(ret)
+
+class MPLinkStats(object):
+    '''statistics for one link'''
+    def __init__(self):
+        self.packets_in = 0
+        self.bytes_in = 0
+        self.packets_out = 0
+        self.bytes_out = 0
+        self.lost = 0
+        self.duplicates = 0
+        # (sysid<<8|compid) -> last sequence number seen
+        self.last_seq = {}
+        self.last_arrival = None
+        self.jitter = MPHistogram(jitter_bins)
+        self.latency = MPHistogram(latency_bins)
+        self.latency_ms = 0
+        self.rate_time = time.time()
+        self.rate_bytes_in = 0
+        self.rate_bytes_out = 0
+        self.bytes_in_rate = 0.0
+        self.bytes_out_rate = 0.0
+        self.rate_packets_in = 0
+        self.rate_lost = 0
+        # loss percentage over the last rate interval
+        self.interval_loss = 0.0
+
+    def packet_in(self, m, tnow):
+        '''account for a received message'''
+        self.packets_in += 1
+        self.bytes_in += len(m.get_msgbuf())
+        key = (m.get_srcSystem() << 8) | m.get_srcComponent()
+        seq = m.get_seq()
+        last = self.last_seq.get(key)
+        if last is not None:
+            if seq == last:
+                self.duplicates += 1
+            else:
+                self.lost += (seq - last - 1) & 0xFF
+        self.last_seq[key] = seq
+        if self.last_arrival is not None:
+            self.jitter.add((tnow - self.last_arrival) * 1000)
+        self.last_arrival = tnow
+
+    def packet_out(self, m):
+        '''account for a sent message'''
+        self.packets_out += 1
+        self.bytes_out += len(m.get_msgbuf())
+
+    def latency_update(self, delay_ms):
+        '''record how far this link's time_boot_ms is behind the freshest link'''
+        self.latency_ms = delay_ms
+        self.latency.add(delay_ms)
+
+    def update_rates(self, tnow):
+        '''update byte rates, called about once a second'''
+        dt = tnow - self.rate_time
+        if dt <= 0:
+            return
+        self.bytes_in_rate = (self.bytes_in - self.rate_bytes_in) / dt
+        self.bytes_out_rate = (self.bytes_out - self.rate_bytes_out) / dt
+        self.rate_bytes_in = self.bytes_in
+        self.rate_bytes_out = self.bytes_out
+        self.rate_time = tnow
+        packets = self.packets_in - self.rate_packets_in
+        lost = self.lost - self.rate_lost
+        if packets + lost > 0:
+            self.interval_loss = (100.0 * lost) / (packets + lost)
+        self.rate_packets_in = self.packets_in
+        self.rate_lost = self.lost
+
+    def loss_percent(self):
+        '''packet loss as a percentage'''
+        total = self.packets_in + self.lost
+        if total == 0:
+            return 0.0
+        return (100.0 * self.lost) / total
+
+    def reset(self):
+        '''clear the counters and histograms'''
+        self.__init__()
+
+    def snapshot(self):
+        '''return the statistics as a dictionary'''
+        return { 'packets_in' : self.packets_in,
+                 'bytes_in' : self.bytes_in,
+                 'packets_out' : self.packets_out,
+                 'bytes_out' : self.bytes_out,
+                 'lost' : self.lost,
+                 'duplicates' : self.duplicates,
+                 'loss_percent' : self.loss_percent(),
+                 'interval_loss' : self.interval_loss,
+                 'bytes_in_rate' : self.bytes_in_rate,
+                 'bytes_out_rate' : self.bytes_out_rate,
+                 'latency_ms' : self.latency_ms,
+                 'jitter_hist' : self.jitter.snapshot(),
+                 'latency_hist' : self.latency.snapshot() }
+
+    def __str__(self):
+        return ("in %u pkts %u bytes (%.0f B/s) out %u pkts %u bytes (%.0f B/s)\n"
+                "  lost %u (%.1f%%) dup %u latency %ums\n"
+                "  jitter(ms)  %s\n"
+                "  latency(ms) %s" % (self.packets_in, self.bytes_in, self.bytes_in_rate,
+                                      self.packets_out, self.bytes_out, self.bytes_out_rate,
+                                      self.lost, self.loss_percent(), self.duplicates,
+                                      self.latency_ms, self.jitter, self.latency))
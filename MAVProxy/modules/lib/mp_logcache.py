@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+'''
+cache of parsed logs for MAVExplorer
+
+each log is parsed once into a mavmemlog and saved under
+~/.mavproxy/logcache in a directory named from the path, size and
+modification time of the log and a hash of its first block. Opening the
+same log again reads a small pickle and memory maps the column files
+instead of parsing the log. Entries are written to a temporary
+directory and renamed into place so an interrupted save is never used,
+and the least recently used entries are removed when the cache grows
+past its size limit.
+'''
+
+import hashlib, os, shutil, tempfile, time
+
+from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mavmemlog
+
+HEAD_SIZE = 65536
+
+class MPLogCache(object):
+    '''a directory of saved mavmemlogs'''
+    def __init__(self, cachedir=None, max_size=1024*1024*1024):
+        if cachedir is None:
+            cachedir = mp_util.dot_mavproxy('logcache')
+        self.cachedir = cachedir
+        self.max_size = max_size
+        mp_util.mkdir_p(self.cachedir)
+
+    def key(self, filename):
+        '''return the cache key for a log file'''
+        st = os.stat(filename)
+        h = hashlib.sha1()
+        h.update('%s\n%u\n%f\n' % (os.path.abspath(filename), st.st_size, st.st_mtime))
+        f = open(filename, 'rb')
+        h.update(f.read(HEAD_SIZE))
+        f.close()
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cachedir, key)
+
+    def load(self, filename):
+        '''return the cached mavmemlog for a log file, or None'''
+        path = self.entry_path(self.key(filename))
+        if not os.path.isdir(path):
+            return None
+        try:
+            mlog = mavmemlog.mavmemlog(None)
+            mlog.load(path)
+        except Exception as ex:
+            print("Discarding log cache entry %s: %s" % (path, ex))
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        # mark as recently used
+        os.utime(path, None)
+        return mlog
+
+    def save(self, filename, mlog):
+        '''save a mavmemlog for a log file, returning True on success'''
+        if self.max_size <= 0:
+            return False
+        key = self.key(filename)
+        path = self.entry_path(key)
+        tmp = '%s.tmp%u' % (path, os.getpid())
+        try:
+            mp_util.mkdir_p(tmp)
+            mlog.save(tmp)
+            if os.path.isdir(path):
+                # another process cached it first
+                shutil.rmtree(tmp, ignore_errors=True)
+            else:
+                os.rename(tmp, path)
+        except Exception as ex:
+            # some message types can't be pickled, just don't cache those logs
+            print("Failed to cache %s: %s" % (filename, ex))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        self.prune(keep=key)
+        return True
+
+    def entry_size(self, path):
+        '''size in bytes of a cache entry'''
+        total = 0
+        for f in os.listdir(path):
+            try:
+                total += os.path.getsize(os.path.join(path, f))
+            except OSError:
+                pass
+        return total
+
+    def entries(self):
+        '''return a list of (last used time, size, path) for the cache
+        entries, least recently used first'''
+        ret = []
+        for key in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, key)
+            if not os.path.isdir(path):
+                continue
+            if key.find('.tmp') != -1:
+                # left by a save that was interrupted a while ago
+                if time.time() - os.path.getmtime(path) > 3600:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            ret.append((os.path.getmtime(path), self.entry_size(path), path))
+        ret.sort()
+        return ret
+
+    def prune(self, keep=None):
+        '''remove least recently used entries until the cache fits in
+        max_size, never removing the entry for key keep'''
+        entries = self.entries()
+        total = sum([e[1] for e in entries])
+        for (mtime, size, path) in entries:
+            if total <= self.max_size:
+                break
+            if keep is not None and os.path.basename(path) == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        '''remove all cache entries'''
+        for (mtime, size, path) in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+def share_log(mlog):
+    '''return a copy of a mavmemlog with its columns mapped from files
+    in a new temporary directory, on a RAM backed filesystem where there
+    is one, so other processes can load() it without copying. The caller
+    removes the directory when done'''
+    tmpdir = None
+    if os.path.isdir('/dev/shm'):
+        tmpdir = '/dev/shm'
+    path = tempfile.mkdtemp(prefix='memlog-', dir=tmpdir)
+    try:
+        mlog.save(path)
+        shared = mavmemlog.mavmemlog(None)
+        shared.load(path)
+    except Exception:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    return shared
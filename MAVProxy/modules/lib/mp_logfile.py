@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+'''
+telemetry log files with optional block compression and rotation
+
+a block compressed log is a sequence of independently compressed
+blocks, each with a small header. A sidecar index file holds one line
+per block with its timestamps, file offset and message type counts, so
+readers can pick out a time range without decompressing the whole log.
+Logs can be rotated into numbered segments by size or by time.
+'''
+
+import os, struct, time, json, zlib, bz2, tempfile
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+BLOCK_MAGIC = 'MPLB'
+# magic, codec, compressed length, uncompressed length, first usec, last usec
+BLOCK_HEADER = struct.Struct('>4sBIIQQ')
+BLOCK_SUFFIX = '.blz'
+INDEX_SUFFIX = '.idx'
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+
+codecs = { 'none' : CODEC_NONE, 'zlib' : CODEC_ZLIB, 'bz2' : CODEC_BZ2, 'lzma' : CODEC_LZMA }
+
+def compress(codec, data):
+    '''compress a block of data'''
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 6)
+    if codec == CODEC_BZ2:
+        return bz2.compress(data)
+    if codec == CODEC_LZMA:
+        return lzma.compress(data)
+    return data
+
+def decompress(codec, data):
+    '''decompress a block of data'''
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_BZ2:
+        return bz2.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    return data
+
+def segment_path(path, n):
+    '''return the path of rotated segment n of a log, for example
+    flight.tlog, flight.2.tlog, flight.3.tlog'''
+    if n <= 1:
+        return path
+    (dirname, basename) = os.path.split(path)
+    a = basename.split('.', 1)
+    if len(a) == 1:
+        return os.path.join(dirname, '%s.%u' % (basename, n))
+    return os.path.join(dirname, '%s.%u.%s' % (a[0], n, a[1]))
+
+def tlog_scan(data, counts):
+    '''scan the tlog records at the start of a bytearray, adding to the
+    message ID counts. Returns (first_usec, last_usec, end) where end is
+    the offset just past the last whole record, or None if the data is
+    not tlog records. first_usec and last_usec are None if no whole
+    records were found'''
+    first_usec = None
+    last_usec = None
+    i = 0
+    n = len(data)
+    while i + 10 <= n:
+        stx = data[i+8]
+        plen = data[i+9]
+        if stx == 0xFE:
+            flen = plen + 8
+            if i + 8 + 6 > n:
+                break
+            msgid = data[i+8+5]
+        elif stx == 0xFD:
+            flen = plen + 12
+            if i + 8 + 10 > n:
+                break
+            if data[i+8+2] & 1:
+                flen += 13
+            msgid = data[i+8+7] | (data[i+8+8]<<8) | (data[i+8+9]<<16)
+        else:
+            # not a tlog
+            return (first_usec, last_usec, None)
+        if i + 8 + flen > n:
+            # the rest of this record has not arrived yet
+            break
+        (usec,) = struct.unpack_from('>Q', data, i)
+        if first_usec is None:
+            first_usec = usec
+        last_usec = usec
+        counts[msgid] = counts.get(msgid, 0) + 1
+        i += 8 + flen
+    return (first_usec, last_usec, i)
+
+def msgid_name(msgid):
+    '''return the message name for a message ID, if known'''
+    try:
+        from pymavlink import mavutil
+        return mavutil.mavlink.mavlink_map[msgid].name
+    except Exception:
+        return str(msgid)
+
+class MPLogFile(object):
+    '''a file-like log writer with optional block compression and rotation'''
+    def __init__(self, path, mode='w', compression='none', block_size=256*1024,
+                 rotate_size=0, rotate_time=0, keep=0, tlog=True):
+        self.base_path = path
+        self.mode = mode
+        self.codec = codecs[compression]
+        if self.codec == CODEC_LZMA and lzma is None:
+            raise RuntimeError("lzma compression is not available")
+        self.block_size = block_size
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.keep = keep
+        self.tlog = tlog
+        self.segment = 1
+        self.segments = []
+        self.block = bytearray()
+        # message ID counts and time range of the records in the block
+        self.block_counts = {}
+        self.block_first_usec = None
+        self.block_last_usec = None
+        # the start of a tlog record whose end has not been written yet
+        self.partial = bytearray()
+        self.f = None
+        self.idx = None
+        self.open_segment()
+
+    def file_path(self, n):
+        '''path of segment n on disk'''
+        path = segment_path(self.base_path, n)
+        if self.codec != CODEC_NONE:
+            path += BLOCK_SUFFIX
+        return path
+
+    def open_segment(self):
+        '''open the current segment'''
+        self.path = self.file_path(self.segment)
+        self.f = open(self.path, mode=self.mode + 'b')
+        self.f.seek(0, 2)
+        if self.codec != CODEC_NONE:
+            self.idx = open(self.path + INDEX_SUFFIX, mode=self.mode)
+        self.open_time = time.time()
+        self.segments.append(self.path)
+
+    def close_segment(self):
+        '''finish the current segment'''
+        self.write_block()
+        self.f.close()
+        if self.idx is not None:
+            self.idx.close()
+            self.idx = None
+
+    def rotate(self):
+        '''move on to the next segment, removing old segments if asked to'''
+        self.close_segment()
+        self.segment += 1
+        # don't overwrite segments left from an earlier run
+        while os.path.exists(self.file_path(self.segment)):
+            self.segment += 1
+        self.mode = 'w'
+        self.open_segment()
+        while self.keep > 0 and len(self.segments) > self.keep:
+            old = self.segments.pop(0)
+            for p in [old, old + INDEX_SUFFIX]:
+                try:
+                    os.unlink(p)
+                except OSError:
+                    pass
+
+    def need_rotate(self):
+        '''see if the current segment is due for rotation'''
+        if self.rotate_size > 0 and self.f.tell() + len(self.block) >= self.rotate_size:
+            return True
+        if self.rotate_time > 0 and time.time() >= self.open_time + self.rotate_time:
+            return True
+        return False
+
+    def write_block(self):
+        '''compress and write out the pending block'''
+        if self.codec == CODEC_NONE or len(self.block) == 0:
+            return
+        data = str(self.block)
+        counts = self.block_counts
+        first_usec = self.block_first_usec
+        last_usec = self.block_last_usec
+        self.block = bytearray()
+        self.block_counts = {}
+        self.block_first_usec = None
+        self.block_last_usec = None
+        if first_usec is None:
+            first_usec = last_usec = int(time.time() * 1.0e6)
+        cdata = compress(self.codec, data)
+        offset = self.f.tell()
+        self.f.write(BLOCK_HEADER.pack(BLOCK_MAGIC, self.codec, len(cdata), len(data),
+                                       first_usec, last_usec))
+        self.f.write(cdata)
+        names = {}
+        for msgid in counts:
+            names[msgid_name(msgid)] = counts[msgid]
+        self.idx.write(json.dumps({ 'offset' : offset, 'first_usec' : first_usec,
+                                    'last_usec' : last_usec, 'length' : len(data),
+                                    'counts' : names }) + '\n')
+
+    def write(self, data):
+        '''write data. Writes may end part way through a tlog record, so
+        the end of the data is held back until the rest of the record
+        arrives, keeping blocks and segments on record boundaries'''
+        counts = {}
+        first_usec = None
+        if self.tlog and (self.codec != CODEC_NONE or self.rotate_size > 0 or self.rotate_time > 0):
+            self.partial += data
+            (first_usec, last_usec, end) = tlog_scan(self.partial, counts)
+            if end is None:
+                # not tlog records, so there are no boundaries to keep to
+                end = len(self.partial)
+            if end == 0:
+                return
+            data = self.partial[:end]
+            del self.partial[:end]
+        if self.need_rotate():
+            self.rotate()
+        if self.codec == CODEC_NONE:
+            self.f.write(data)
+            return
+        self.block += data
+        for msgid in counts:
+            self.block_counts[msgid] = self.block_counts.get(msgid, 0) + counts[msgid]
+        if first_usec is not None:
+            if self.block_first_usec is None:
+                self.block_first_usec = first_usec
+            self.block_last_usec = last_usec
+        if len(self.block) >= self.block_size:
+            self.write_block()
+
+    def flush(self):
+        '''flush completed blocks to the OS'''
+        self.f.flush()
+        if self.idx is not None:
+            self.idx.flush()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        if len(self.partial) > 0:
+            # a record cut off at the end of the log
+            if self.codec == CODEC_NONE:
+                self.f.write(self.partial)
+            else:
+                self.block += self.partial
+            self.partial = bytearray()
+        self.close_segment()
+
+def is_block_log(filename):
+    '''see if a file is a block compressed log'''
+    try:
+        f = open(filename, 'rb')
+        magic = f.read(len(BLOCK_MAGIC))
+        f.close()
+    except IOError:
+        return False
+    return magic == BLOCK_MAGIC
+
+def read_index(filename):
+    '''read the index for a block compressed log, building it from the
+    block headers if the sidecar index is missing'''
+    ret = []
+    try:
+        for line in open(filename + INDEX_SUFFIX):
+            ret.append(json.loads(line))
+        return ret
+    except (IOError, ValueError):
+        ret = []
+    f = open(filename, 'rb')
+    while True:
+        offset = f.tell()
+        hdr = f.read(BLOCK_HEADER.size)
+        if len(hdr) < BLOCK_HEADER.size:
+            break
+        (magic, codec, clen, ulen, first_usec, last_usec) = BLOCK_HEADER.unpack(hdr)
+        if magic != BLOCK_MAGIC:
+            break
+        ret.append({ 'offset' : offset, 'first_usec' : first_usec,
+                     'last_usec' : last_usec, 'length' : ulen })
+        f.seek(clen, 1)
+    f.close()
+    return ret
+
+def read_blocks(filename, tstart=None, tend=None):
+    '''generator returning the decompressed data of each block overlapping
+    the time range tstart to tend (in seconds since 1970)'''
+    f = open(filename, 'rb')
+    for block in read_index(filename):
+        if tstart is not None and block['last_usec'] < tstart * 1.0e6:
+            continue
+        if tend is not None and block['first_usec'] > tend * 1.0e6:
+            continue
+        f.seek(block['offset'])
+        (magic, codec, clen, ulen, first_usec, last_usec) = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+        if magic != BLOCK_MAGIC:
+            raise RuntimeError("bad block at offset %u in %s" % (block['offset'], filename))
+        yield decompress(codec, f.read(clen))
+    f.close()
+
+def readable_log(filename, tstart=None, tend=None):
+    '''return the path of a log that pymavlink can read. Block compressed
+    logs are decompressed (only the blocks in the time range, if given)
+    into a temporary file, which the caller should remove when done'''
+    if not is_block_log(filename):
+        return filename
+    base = os.path.basename(filename)
+    if base.endswith(BLOCK_SUFFIX):
+        base = base[:-len(BLOCK_SUFFIX)]
+    (fd, tmpname) = tempfile.mkstemp(prefix='mavlog-', suffix='-' + base)
+    f = os.fdopen(fd, 'wb')
+    for data in read_blocks(filename, tstart, tend):
+        f.write(data)
+    f.close()
+    return tmpname
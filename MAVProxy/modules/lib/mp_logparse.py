@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+'''
+parse large logs on several cores
+
+a binary dataflash log or a telemetry log is split into pieces at
+record boundaries and each piece is parsed into mavmemlog columns by a
+process pool, then the pieces are joined in log order. The boundaries
+are found by looking for a record header followed by several more
+records that chain on from it: for dataflash logs using the lengths of
+the FMT records, which are collected from the whole file first so
+pieces can decode messages defined before them, and for telemetry logs
+using the MAVLink packet length and CRC.
+
+Dataflash pieces share the clock found by a scan from the start of the
+log as usual. Messages at the start of a piece that take their time or
+flight mode from earlier messages get them when the pieces are joined.
+Other logs, small logs and logs with clocks that need the whole message
+history are parsed in this process as before.
+'''
+
+import mmap, multiprocessing, os, struct
+
+from pymavlink import mavutil, DFReader
+from MAVProxy.modules.lib import mavmemlog
+
+# below this a single process is quicker
+MIN_PARALLEL_SIZE = 16*1024*1024
+
+# records that must follow on from a boundary for it to be trusted
+SYNC_RECORDS = 4
+
+# how far past a split point to look for a boundary
+SYNC_WINDOW = 1024*1024
+
+DF_HEAD = '\xa3\x95'
+DF_FMT_TYPE = 0x80
+DF_FMT_LEN = 89
+DF_FMT = struct.Struct('<BB4s16s64s')
+
+MAVLINK_STX_V1 = 0xFE
+MAVLINK_STX_V2 = 0xFD
+TLOG_TIMESTAMP_LEN = 8
+
+def log_kind(filename):
+    '''return 'df' for binary dataflash logs, 'tlog' for telemetry logs or
+    None for logs that are always parsed in one piece'''
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ['.bin', '.px4log']:
+        return 'df'
+    if ext == '.tlog':
+        return 'tlog'
+    return None
+
+def splittable(filename):
+    '''see if a log is worth parsing in pieces'''
+    if log_kind(filename) is None or multiprocessing.cpu_count() < 2:
+        return False
+    return os.path.getsize(filename) >= MIN_PARALLEL_SIZE
+
+def x25crc(data, crc=0xFFFF):
+    '''the MAVLink packet checksum'''
+    for c in data:
+        tmp = ord(c) ^ (crc & 0xFF)
+        tmp = (tmp ^ (tmp << 4)) & 0xFF
+        crc = ((crc >> 8) ^ (tmp << 8) ^ (tmp << 3) ^ (tmp >> 4)) & 0xFFFF
+    return crc
+
+def df_formats(data):
+    '''find the FMT records anywhere in a dataflash log, returning a
+    dictionary of (type, name, length, format, columns) by type'''
+    formats = {}
+    ofs = data.find(DF_HEAD + chr(DF_FMT_TYPE))
+    while ofs != -1:
+        if ofs + DF_FMT_LEN > len(data):
+            break
+        (mtype, length, name, format, columns) = DF_FMT.unpack(data[ofs+3:ofs+DF_FMT_LEN])
+        format = DFReader.null_term(format)
+        if mtype not in formats and df_format_length(format) == length:
+            formats[mtype] = (mtype, DFReader.null_term(name), length, format,
+                              DFReader.null_term(columns))
+        ofs = data.find(DF_HEAD + chr(DF_FMT_TYPE), ofs+1)
+    return formats
+
+def df_format_length(format):
+    '''record length for a dataflash format string, or None if it is not
+    a valid format'''
+    s = '<'
+    for c in format:
+        if c not in DFReader.FORMAT_TO_STRUCT:
+            return None
+        s += DFReader.FORMAT_TO_STRUCT[c][0]
+    return struct.calcsize(s) + 3
+
+def df_record_length(data, ofs, lengths):
+    '''length of the dataflash record at ofs, or None if there isn't one'''
+    if data[ofs:ofs+2] != DF_HEAD or ofs+2 >= len(data):
+        return None
+    return lengths.get(ord(data[ofs+2]), None)
+
+def tlog_record_length(data, ofs, crc_extras):
+    '''length of the telemetry log record at ofs, including the
+    timestamp, or None if there isn't a valid packet there'''
+    p = ofs + TLOG_TIMESTAMP_LEN
+    if p + 3 > len(data):
+        return None
+    stx = ord(data[p])
+    if stx == MAVLINK_STX_V1:
+        hlen = 6
+    elif stx == MAVLINK_STX_V2:
+        hlen = 10
+    else:
+        return None
+    if p + hlen > len(data):
+        return None
+    if stx == MAVLINK_STX_V1:
+        msgid = ord(data[p+5])
+        signed = False
+    else:
+        (msgid,) = struct.unpack('<I', data[p+7:p+10] + '\0')
+        signed = (ord(data[p+2]) & 1) != 0
+    plen = ord(data[p+1])
+    if msgid not in crc_extras or p + hlen + plen + 2 > len(data):
+        return None
+    crc = x25crc(data[p+1:p+hlen+plen])
+    crc = x25crc(chr(crc_extras[msgid]), crc)
+    if struct.unpack('<H', data[p+hlen+plen:p+hlen+plen+2])[0] != crc:
+        return None
+    length = TLOG_TIMESTAMP_LEN + hlen + plen + 2
+    if signed:
+        length += 13
+    return length
+
+def find_boundary(data, ofs, end, record_length, heads, head_offset=0):
+    '''find the first record at or after ofs that is followed by enough
+    valid records, returning its offset or None. Records are found by
+    searching for the heads strings head_offset bytes into the record'''
+    limit = min(ofs + SYNC_WINDOW, end)
+    while ofs < limit:
+        candidates = []
+        for h in heads:
+            c = data.find(h, ofs+head_offset, limit+head_offset)
+            if c != -1:
+                candidates.append(c - head_offset)
+        if len(candidates) == 0:
+            return None
+        ofs = min(candidates)
+        p = ofs
+        for i in range(SYNC_RECORDS):
+            if p == end:
+                break
+            length = record_length(data, p)
+            if length is None:
+                break
+            p += length
+        else:
+            return ofs
+        if p == end:
+            return ofs
+        ofs += 1
+    return None
+
+class DFChunkReader(DFReader.DFReader_binary):
+    '''read the records of a binary dataflash log between two offsets,
+    without reading the whole file into memory'''
+    def __init__(self, filename, start=0, end=None, formats=None, clock=None, mav_type=None):
+        DFReader.DFReader.__init__(self)
+        self.f = open(filename, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        if end is None:
+            end = len(self.data)
+        self.start = start
+        self.data_len = end
+        self.HEAD1 = 0xA3
+        self.HEAD2 = 0x95
+        self.formats = {
+            DF_FMT_TYPE : DFReader.DFFormat(DF_FMT_TYPE, 'FMT', DF_FMT_LEN, 'BBnNZ',
+                                            "Type,Length,Name,Format,Columns")
+        }
+        if formats is not None:
+            for (mtype, name, length, format, columns) in formats.values():
+                self.formats[mtype] = DFReader.DFFormat(mtype, name, length, format, columns)
+        self._zero_time_base = False
+        if clock is None:
+            self.init_clock()
+        else:
+            self.clock = clock
+            self.mav_type = mav_type
+        self._rewind()
+
+    def _rewind(self):
+        '''rewind to start of the piece'''
+        DFReader.DFReader_binary._rewind(self)
+        self.offset = self.start
+        self.remaining = self.data_len - self.start
+
+    def close(self):
+        self.data.close()
+        self.f.close()
+
+class TlogChunkReader(mavutil.mavlogfile):
+    '''read the records of a telemetry log between two offsets'''
+    def __init__(self, filename, start, end):
+        mavutil.mavlogfile.__init__(self, filename)
+        self.f.seek(start)
+        self.end = end
+
+    def recv_msg(self):
+        if self.f.tell() >= self.end:
+            return None
+        return mavutil.mavlogfile.recv_msg(self)
+
+def parse_chunk(args):
+    '''parse one piece of a log in a pool process, returning its size and
+    columns'''
+    (filename, kind, start, end, setup) = args
+    if kind == 'df':
+        (formats, clock, mav_type) = setup
+        if start != 0:
+            # taken from the previous piece when they are joined
+            clock.timestamp = float('nan')
+        reader = DFChunkReader(filename, start, end, formats, clock, mav_type)
+    else:
+        reader = TlogChunkReader(filename, start, end)
+    if start != 0:
+        reader.flightmode = None
+    mlog = mavmemlog.mavmemlog(reader)
+    reader.close()
+    return (end - start, mlog.chunk())
+
+def split_log(filename, kind, pieces):
+    '''work out the pieces of a log, returning a list of
+    (start, end) offsets and the setup information for the parsers'''
+    f = open(filename, 'rb')
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    size = len(data)
+    try:
+        if kind == 'df':
+            formats = df_formats(data)
+            lengths = {}
+            for (mtype, name, length, format, columns) in formats.values():
+                lengths[mtype] = length
+            record_length = lambda d, ofs: df_record_length(d, ofs, lengths)
+            heads = [DF_HEAD]
+            head_offset = 0
+            reader = DFChunkReader(filename, 0, size, formats)
+            clock = reader.clock
+            mav_type = reader.mav_type
+            reader.close()
+            if not isinstance(clock, (DFReader.DFReaderClock_usec, DFReader.DFReaderClock_msec)):
+                # this clock depends on the messages before each one
+                return None
+            setup = (formats, clock, mav_type)
+        else:
+            crc_extras = {}
+            for (msgid, cls) in mavutil.mavlink.mavlink_map.items():
+                crc_extras[msgid] = cls.crc_extra
+            record_length = lambda d, ofs: tlog_record_length(d, ofs, crc_extras)
+            heads = [chr(MAVLINK_STX_V1), chr(MAVLINK_STX_V2)]
+            head_offset = TLOG_TIMESTAMP_LEN
+            setup = None
+        starts = [0]
+        for i in range(1, pieces):
+            ofs = find_boundary(data, max(size * i // pieces, starts[-1]+1), size, record_length,
+                                heads, head_offset)
+            if ofs is not None and ofs > starts[-1]:
+                starts.append(ofs)
+        ends = starts[1:] + [size]
+        return ([(starts[i], ends[i]) for i in range(len(starts))], setup)
+    finally:
+        data.close()
+        f.close()
+
+def parse_log(filename, progress_callback=None, processes=None,
+              notimestamps=False, zero_time_base=False, dialect=None):
+    '''load a log into a mavmemlog, parsing large logs in parallel.
+    progress_callback is called with the percentage done'''
+    if (splittable(filename) and not notimestamps and not zero_time_base and
+        dialect in [None, 'ardupilotmega']):
+        try:
+            mlog = parse_parallel(filename, progress_callback, processes)
+            if mlog is not None:
+                return mlog
+        except Exception as ex:
+            print("Parallel parse of %s failed: %s" % (filename, ex))
+    conn = mavutil.mavlink_connection(filename, notimestamps=notimestamps,
+                                      zero_time_base=zero_time_base,
+                                      dialect=dialect)
+    return mavmemlog.mavmemlog(conn, progress_callback)
+
+def parse_parallel(filename, progress_callback=None, processes=None):
+    '''parse a log in pieces with a process pool, returning None if the
+    log can't be split'''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    kind = log_kind(filename)
+    # several pieces per process keeps the processes busy and gives
+    # progress updates
+    split = split_log(filename, kind, processes * 4)
+    if split is None:
+        return None
+    (pieces, setup) = split
+    if len(pieces) < 2:
+        return None
+    size = os.path.getsize(filename)
+    tasks = [(filename, kind, start, end, setup) for (start, end) in pieces]
+    pool = multiprocessing.Pool(processes)
+    chunks = []
+    done = 0
+    last_pct = 0
+    try:
+        for (length, chunk) in pool.imap(parse_chunk, tasks):
+            chunks.append(chunk)
+            done += length
+            pct = (100 * done) // size
+            if progress_callback:
+                for p in range(last_pct+1, pct+1):
+                    progress_callback(p)
+            last_pct = pct
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    mlog = mavmemlog.mavmemlog(None)
+    mlog.merge(chunks)
+    return mlog
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+preallocated ring buffer for telemetry logging
+
+producers copy each record straight into a fixed size bytearray. A
+writer thread drains the ring to the log file in large contiguous
+chunks. When the ring is full new records are dropped and counted
+rather than letting memory grow without bound.
+'''
+
+import os, struct, threading
+
+class MPLogRing(object):
+    '''a fixed size byte ring written by producers and drained by a writer thread'''
+    def __init__(self, size, event=None):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.size = size
+        # head and tail are total byte counts, position is modulo size
+        self.head = 0
+        self.tail = 0
+        self.lock = threading.Lock()
+        # set when the ring is filling up, to wake the writer early
+        self.event = event
+        self.counters = { 'Records' : 0, 'Bytes' : 0, 'Dropped' : 0,
+                          'DroppedBytes' : 0, 'HighWater' : 0, 'Writes' : 0 }
+
+    def _copy_in(self, pos, data):
+        '''copy data into the ring at pos, wrapping at the end'''
+        n = len(data)
+        end = pos + n
+        if end <= self.size:
+            self.buf[pos:end] = data
+        else:
+            first = self.size - pos
+            self.buf[pos:] = data[:first]
+            self.buf[:n-first] = data[first:]
+
+    def put(self, data, usec=None):
+        '''append a record, optionally prefixed with a big endian 64 bit
+        usec timestamp as used in tlogs. Returns False if it was dropped'''
+        if usec is not None:
+            header = struct.pack('>Q', usec)
+        else:
+            header = ''
+        n = len(header) + len(data)
+        self.lock.acquire()
+        used = self.head - self.tail
+        if used + n > self.size:
+            self.lock.release()
+            self.counters['Dropped'] += 1
+            self.counters['DroppedBytes'] += n
+            return False
+        pos = self.head % self.size
+        if header:
+            self._copy_in(pos, header)
+            pos = (pos + len(header)) % self.size
+        self._copy_in(pos, data)
+        self.head += n
+        self.lock.release()
+        used += n
+        self.counters['Records'] += 1
+        self.counters['Bytes'] += n
+        if used > self.counters['HighWater']:
+            self.counters['HighWater'] = used
+        if self.event is not None and used > self.size // 4:
+            self.event.set()
+        return True
+
+    def pending(self):
+        '''number of bytes waiting to be written'''
+        return self.head - self.tail
+
+    def write_to(self, f):
+        '''write all pending data to f, in at most two contiguous chunks'''
+        head = self.head
+        n = head - self.tail
+        if n == 0:
+            return 0
+        start = self.tail % self.size
+        if start + n <= self.size:
+            f.write(self.view[start:start+n])
+        else:
+            f.write(self.view[start:])
+            f.write(self.view[:n-(self.size-start)])
+        self.lock.acquire()
+        self.tail = head
+        self.lock.release()
+        self.counters['Writes'] += 1
+        return n
+
+    def __str__(self):
+        return "%u/%u bytes used %s" % (self.pending(), self.size, self.counters)
+
+def sync_file(f, policy):
+    '''apply a log sync policy of none, flush or fsync to a file'''
+    if policy == 'none':
+        return
+    f.flush()
+    if policy == 'fsync':
+        os.fsync(f.fileno())
@@ -13,6 +13,8 @@ class MPModule(object):
         self.mpstate = mpstate
         self.name = name
         self.needs_unloading = False
+        # message types passed to mavlink_packet(), None means all types
+        self.mavlink_types = None
 
         if description is None:
             self.description = name + " handling"
@@ -111,6 +113,22 @@ class MPModule(object):
     def add_completion_function(self, name, callback):
         self.mpstate.completion_functions[name] = callback
 
+    def subscribe(self, mtypes):
+        '''only pass messages of the given types to mavlink_packet()'''
+        if self.mavlink_types is None:
+            self.mavlink_types = set()
+        self.mavlink_types.update(mtypes)
+        self.mpstate.module_generation += 1
+
+    def start_task(self, gen, name=None):
+        '''run a generator as a task, resumed when the messages it waits
+        for arrive. See mp_task for details'''
+        return self.mpstate.tasks.start(gen, name=name, owner=self.name)
+
+    def wants_mavlink_packet(self):
+        '''return True if this module overrides mavlink_packet()'''
+        return self.mavlink_packet.__func__ is not MPModule.mavlink_packet.__func__
+
     def dist_string(self, val_meters):
         '''return a distance as a string'''
         if self.settings.dist_unit == 'nm':
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+'''
+MAVLink framing for the router fast path
+
+splits a byte stream into MAVLink v1/v2 frames using only the header,
+length and CRC, so raw frames can be forwarded to outputs without
+creating a message object or re-serialising them. The CRC is left to
+the full parser for frames which are parsed but never forwarded
+'''
+
+from pymavlink import mavutil
+
+MAVLINK_STX_V1 = 0xFE
+MAVLINK_STX_V2 = 0xFD
+MAVLINK_IFLAG_SIGNED = 0x01
+MAVLINK_SIGNATURE_LEN = 13
+
+class MAVFramer(object):
+    '''frame a MAVLink byte stream by header, length and CRC'''
+    def __init__(self):
+        self.buf = bytearray()
+        self.crc_extra = {}
+        for msgid in mavutil.mavlink.mavlink_map:
+            self.crc_extra[msgid] = mavutil.mavlink.mavlink_map[msgid].crc_extra
+        self.counters = { 'Frames' : 0, 'BadCRC' : 0, 'Noise' : 0 }
+
+    def check_crc(self, frame, hdrlen, plen, msgid):
+        '''check the CRC of a frame. Frames for unknown messages can't be
+        checked, so are treated as noise just as the full parser would'''
+        if not msgid in self.crc_extra:
+            return False
+        crc = mavutil.mavlink.x25crc(frame[1:hdrlen+plen])
+        crc.accumulate(bytearray([self.crc_extra[msgid]]))
+        return crc.crc == (frame[hdrlen+plen] | (frame[hdrlen+plen+1] << 8))
+
+    def frame_crc_ok(self, f):
+        '''check the CRC of a whole frame returned by frames()'''
+        frame = bytearray(f)
+        if frame[0] == MAVLINK_STX_V1:
+            (hdrlen, msgid) = (6, frame[5])
+        else:
+            (hdrlen, msgid) = (10, frame[7] | (frame[8] << 8) | (frame[9] << 16))
+        return self.check_crc(frame, hdrlen, frame[1], msgid)
+
+    def frames(self, s, unchecked=None):
+        '''
+        add data s to the stream, returning a list of (data, sysid, compid, msgid)
+        tuples in stream order. Data which is not a valid frame (noise or a
+        bad CRC) is returned with msgid None so it can be passed on to the
+        full parser for reporting. Incomplete frames are held until more data
+        arrives.
+
+        The CRC is not checked for message IDs in the set unchecked when the
+        frame is followed by the start of another frame. Only use this for
+        frames the caller doesn't forward, as the parser checks those
+        '''
+        self.buf.extend(s)
+        buf = self.buf
+        ret = []
+        i = 0
+        noise_start = None
+        n = len(buf)
+        while i < n:
+            stx = buf[i]
+            if stx == MAVLINK_STX_V1:
+                hdrlen = 6
+            elif stx == MAVLINK_STX_V2:
+                hdrlen = 10
+            else:
+                if noise_start is None:
+                    noise_start = i
+                i += 1
+                continue
+            if i + 2 > n:
+                break
+            plen = buf[i+1]
+            if stx == MAVLINK_STX_V1:
+                flen = plen + 8
+            else:
+                flen = plen + 12
+                if i + 3 > n:
+                    break
+                if buf[i+2] & MAVLINK_IFLAG_SIGNED:
+                    flen += MAVLINK_SIGNATURE_LEN
+            if i + flen > n:
+                break
+            frame = buf[i:i+flen]
+            if stx == MAVLINK_STX_V1:
+                (sysid, compid, msgid) = (frame[3], frame[4], frame[5])
+            else:
+                (sysid, compid) = (frame[5], frame[6])
+                msgid = frame[7] | (frame[8] << 8) | (frame[9] << 16)
+            if (unchecked is not None and msgid in unchecked and
+                (i + flen == n or buf[i+flen] in (MAVLINK_STX_V1, MAVLINK_STX_V2))):
+                # the parser checks this one
+                pass
+            elif not self.check_crc(frame, hdrlen, plen, msgid):
+                self.counters['BadCRC'] += 1
+                if noise_start is None:
+                    noise_start = i
+                i += 1
+                continue
+            if noise_start is not None:
+                self.counters['Noise'] += i - noise_start
+                ret.append((str(buf[noise_start:i]), None, None, None))
+                noise_start = None
+            self.counters['Frames'] += 1
+            ret.append((str(frame), sysid, compid, msgid))
+            i += flen
+        if noise_start is not None:
+            # pass noise on now, keeping any partial frame after it
+            self.counters['Noise'] += i - noise_start
+            ret.append((str(buf[noise_start:i]), None, None, None))
+        del buf[:i]
+        return ret
+
+def get_framer(conn):
+    '''return the framer for a connection, creating it on first use'''
+    framer = getattr(conn, 'mav_framer', None)
+    if framer is None:
+        framer = MAVFramer()
+        conn.mav_framer = framer
+    return framer
+
+def msgids_for_types(types):
+    '''return the set of message IDs for a collection of message type names'''
+    ret = set()
+    for t in types:
+        msgid = getattr(mavutil.mavlink, 'MAVLINK_MSG_ID_' + t, None)
+        if msgid is not None:
+            ret.add(msgid)
+    return ret
+
+def frame_key(f, sysid, compid, msgid):
+    '''return a key identifying a frame for duplicate detection:
+    (sysid, compid, seq, msgid, crc)'''
+    if ord(f[0]) == MAVLINK_STX_V1:
+        seq = ord(f[2])
+        crcofs = 6 + ord(f[1])
+    else:
+        seq = ord(f[4])
+        crcofs = 10 + ord(f[1])
+    return (sysid, compid, seq, msgid, f[crcofs:crcofs+2])
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+'''
+generator based coroutines for modules
+
+a task is a generator which yields what it is waiting for, either
+sleep(seconds) or wait_message(types, condition, timeout). The scheduler
+resumes it from the main loop when a matching message arrives or the
+time is up, so request/response exchanges can be written as straight
+line code without blocking packet processing. The value of a
+wait_message() yield is the message, or None on timeout.
+
+for example:
+
+    def fetch_point(self, i):
+        for retry in range(3):
+            self.master.mav.fence_fetch_point_send(self.target_system,
+                                                   self.target_component, i)
+            p = yield wait_message('FENCE_POINT', lambda m: m.idx == i, timeout=1)
+            if p is not None:
+                break
+'''
+
+import time, sys, traceback
+
+class sleep(object):
+    '''yielded by a task to sleep for a number of seconds'''
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class wait_message(object):
+    '''yielded by a task to wait for a message of one of the given types
+    for which condition(m) is true, giving up after timeout seconds'''
+    def __init__(self, mtypes, condition=None, timeout=None):
+        if isinstance(mtypes, str):
+            mtypes = [mtypes]
+        self.mtypes = set(mtypes)
+        self.condition = condition
+        self.timeout = timeout
+
+class MPTask(object):
+    '''a running task'''
+    def __init__(self, gen, name, owner):
+        self.gen = gen
+        self.name = name
+        self.owner = owner
+        # what the task is waiting for, a sleep or wait_message
+        self.waiting = None
+        self.deadline = None
+        self.done = False
+
+class MPTaskScheduler(object):
+    '''run tasks, resuming them on messages and timeouts'''
+    def __init__(self, debug=False):
+        self.tasks = []
+        # message type -> tasks waiting for it
+        self.waiting = {}
+        self.debug = debug
+        self.counters = { 'Started' : 0, 'Finished' : 0, 'Failed' : 0, 'Resumed' : 0 }
+
+    def start(self, gen, name=None, owner=None):
+        '''start a task, running it up to its first wait'''
+        if name is None:
+            name = getattr(gen, '__name__', 'task')
+        task = MPTask(gen, name, owner)
+        self.tasks.append(task)
+        self.counters['Started'] += 1
+        self.step(task, None)
+        return task
+
+    def step(self, task, value):
+        '''resume a task with a value until it next waits or finishes'''
+        self.clear_wait(task)
+        self.counters['Resumed'] += 1
+        try:
+            w = task.gen.send(value)
+        except StopIteration:
+            self.finish(task)
+            self.counters['Finished'] += 1
+            return
+        except Exception as msg:
+            self.finish(task)
+            self.counters['Failed'] += 1
+            print("task %s failed: %s" % (task.name, msg))
+            if self.debug:
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                          limit=2, file=sys.stdout)
+            return
+        task.waiting = w
+        if isinstance(w, sleep):
+            task.deadline = time.time() + w.seconds
+        elif isinstance(w, wait_message):
+            if w.timeout is not None:
+                task.deadline = time.time() + w.timeout
+            for mtype in w.mtypes:
+                self.waiting.setdefault(mtype, []).append(task)
+        else:
+            # anything else just gives other work a chance to run
+            task.deadline = time.time()
+
+    def clear_wait(self, task):
+        '''remove a task from the message wait lists'''
+        w = task.waiting
+        if isinstance(w, wait_message):
+            for mtype in w.mtypes:
+                lst = self.waiting.get(mtype)
+                if lst is not None and task in lst:
+                    lst.remove(task)
+                    if len(lst) == 0:
+                        del self.waiting[mtype]
+        task.waiting = None
+        task.deadline = None
+
+    def finish(self, task):
+        '''remove a finished task'''
+        self.clear_wait(task)
+        task.done = True
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def cancel(self, task):
+        '''stop a task'''
+        if task.done:
+            return
+        self.finish(task)
+        task.gen.close()
+
+    def cancel_owner(self, owner):
+        '''stop all tasks started by an owner, such as a module being unloaded'''
+        for task in self.tasks[:]:
+            if task.owner == owner:
+                self.cancel(task)
+
+    def mavlink_packet(self, m):
+        '''resume tasks waiting for this message'''
+        lst = self.waiting.get(m.get_type())
+        if lst is None:
+            return
+        for task in lst[:]:
+            if task.done or not task in lst:
+                continue
+            w = task.waiting
+            if w.condition is not None and not w.condition(m):
+                continue
+            self.step(task, m)
+
+    def run(self):
+        '''resume tasks whose sleep or timeout has expired'''
+        if len(self.tasks) == 0:
+            return
+        tnow = time.time()
+        for task in self.tasks[:]:
+            if task.deadline is not None and tnow >= task.deadline and not task.done:
+                self.step(task, None)
+
+    def __str__(self):
+        return "%u tasks %s" % (len(self.tasks), self.counters)
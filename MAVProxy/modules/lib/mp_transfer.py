@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''
+windowed transfer of numbered points, such as fence and rally points
+
+several requests are kept outstanding at once and requests which get
+no reply are retried. The transfer runs as a module task waiting for
+the replies, so it never blocks the main loop
+'''
+
+import time
+
+from MAVProxy.modules.lib import mp_task
+
+class MPPointTransfer(object):
+    '''track a transfer of points by index'''
+    def __init__(self, indexes, request, window=5, timeout=1.0, retries=3):
+        self.indexes = list(indexes)
+        # request(idx) sends the request for one point
+        self.request = request
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.points = {}
+        # idx -> time of last request
+        self.requested = {}
+        self.tries = {}
+        # index of the point which ran out of retries
+        self.failed = None
+        self.tstart = time.time()
+
+    def send_requests(self):
+        '''request missing points, keeping at most window requests
+        outstanding and repeating requests which have timed out'''
+        tnow = time.time()
+        outstanding = 0
+        for idx in self.indexes:
+            if idx in self.points:
+                continue
+            if outstanding >= self.window:
+                break
+            outstanding += 1
+            t = self.requested.get(idx)
+            if t is not None and tnow - t < self.timeout:
+                continue
+            tries = self.tries.get(idx, 0)
+            if tries >= self.retries:
+                self.failed = idx
+                return
+            self.tries[idx] = tries + 1
+            self.requested[idx] = tnow
+            self.request(idx)
+
+    def wanted(self, idx):
+        '''see if a point is still wanted'''
+        return idx in self.requested and not idx in self.points
+
+    def add(self, idx, p):
+        '''add a received point'''
+        if not self.wanted(idx):
+            return
+        self.points[idx] = p
+        self.requested.pop(idx)
+
+    def reject(self, idx):
+        '''a reply was wrong, request the point again'''
+        self.requested.pop(idx, None)
+
+    def complete(self):
+        return len(self.points) == len(self.indexes)
+
+    def run(self, mtype, check=None, done=None):
+        '''a task for MPModule.start_task() which runs the transfer. Replies
+        are messages of type mtype with an idx field. check(m) can return
+        False to request a point again, and done(xfer) is called when the
+        transfer completes or fails'''
+        self.send_requests()
+        while self.failed is None and not self.complete():
+            m = yield mp_task.wait_message(mtype, lambda m: self.wanted(m.idx),
+                                           timeout=self.timeout)
+            if m is not None:
+                if check is not None and not check(m):
+                    self.reject(m.idx)
+                else:
+                    self.add(m.idx, m)
+            self.send_requests()
+        if done is not None:
+            done(self)
+
+    def point_list(self):
+        '''return the received points in index order'''
+        return [self.points[idx] for idx in self.indexes]
+
+    def __str__(self):
+        return "%u/%u points" % (len(self.points), len(self.indexes))
@@ -129,6 +129,18 @@ def polygon_bounds(points):
         maxy = max(maxy, p[1])
     return (minx, miny, maxx-minx, maxy-miny)
 
+def polygon_inside(point, points):
+    '''return true if a (lat,lon) point is inside a polygon'''
+    (x, y) = (point[0], point[1])
+    inside = False
+    n = len(points)
+    for i in range(n):
+        (x1, y1) = (points[i][0], points[i][1])
+        (x2, y2) = (points[i-1][0], points[i-1][1])
+        if (y1 > y) != (y2 > y) and x < (x2-x1) * (y-y1) / (y2-y1) + x1:
+            inside = not inside
+    return inside
+
 def bounds_overlap(bound1, bound2):
     '''return true if two bounding boxes overlap'''
     (x1,y1,w1,h1) = bound1
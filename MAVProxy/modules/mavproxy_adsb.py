@@ -39,6 +39,7 @@ class ADSBModule(mp_module.MPModule):
 
     def __init__(self, mpstate):
         super(ADSBModule, self).__init__(mpstate, "adsb", "ADS-B data support")
+        self.subscribe(['ADSB_VEHICLE', 'GLOBAL_POSITION_INT'])
         self.threat_vehicles = {}
         self.active_threat_ids = []  # holds all threat ids the vehicle is evading
 
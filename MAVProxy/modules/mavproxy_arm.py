@@ -21,6 +21,7 @@ arming_masks = {
 class ArmModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(ArmModule, self).__init__(mpstate, "arm", "arm/disarm handling")
+        self.subscribe(['HEARTBEAT'])
         self.add_command('arm', self.cmd_arm,      'arm motors', ['check <all|baro|compass|gps|ins|params|rc|voltage|battery>',
                                       'uncheck <all|baro|compass|gps|ins|params|rc|voltage|battery>',
                                       'list',
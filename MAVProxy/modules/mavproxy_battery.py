@@ -11,6 +11,7 @@ class BatteryModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(BatteryModule, self).__init__(mpstate, "battery", "battery commands")
         self.add_command('bat', self.cmd_bat, "show battery information")
+        self.subscribe(['SYS_STATUS', 'BATTERY2', 'POWER_STATUS'])
         self.last_battery_announce = 0
         self.last_battery_announce_time = 0
         self.last_battery_cell_announce_time = 0
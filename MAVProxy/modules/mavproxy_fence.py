@@ -1,16 +1,18 @@
 """
     MAVProxy geofence module
 """
-import os, time, platform
+import os, platform
 from pymavlink import mavwp, mavutil
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
+from MAVProxy.modules.lib import mp_transfer
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
 
 class FenceModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(FenceModule, self).__init__(mpstate, "fence", "geo-fence management", public = True)
+        self.subscribe(['FENCE_STATUS', 'SYS_STATUS'])
         self.fenceloader = mavwp.MAVFenceLoader()
         self.last_fence_breach = 0
         self.last_fence_status = 0
@@ -24,6 +26,13 @@ class FenceModule(mp_module.MPModule):
 
         self.have_list = False
 
+        # current fence point transfer, if any
+        self.xfer = None
+        self.xfer_op = None
+        self.xfer_filename = None
+        self.xfer_action = None
+        self.xfer_success = None
+
         if self.continue_mode and self.logdir != None:
             fencetxt = os.path.join(self.logdir, 'fence.txt')
             if os.path.exists(fencetxt):
@@ -101,11 +110,20 @@ class FenceModule(mp_module.MPModule):
             mavutil.mavlink.MAV_CMD_DO_FENCE_ENABLE, 0,
             do_enable, 0, 0, 0, 0, 0, 0)
 
+    def transfer_busy(self):
+        '''see if a transfer is running, which is using fenceloader'''
+        if self.xfer is not None:
+            print("Fence transfer already in progress (%s)" % self.xfer)
+            return True
+        return False
+
     def cmd_fence_move(self, args):
         '''handle fencepoint move'''
         if len(args) < 1:
             print("Usage: fence move FENCEPOINTNUM")
             return
+        if self.transfer_busy():
+            return
         if not self.have_list:
             print("Please list fence points first")
             return
@@ -126,14 +144,15 @@ class FenceModule(mp_module.MPModule):
 
         # note we don't subtract 1, as first fence point is the return point
         self.fenceloader.move(idx, latlon[0], latlon[1])
-        if self.send_fence():
-            print("Moved fence point %u" % idx)
+        self.send_fence(success="Moved fence point %u" % idx)
 
     def cmd_fence_remove(self, args):
         '''handle fencepoint remove'''
         if len(args) < 1:
             print("Usage: fence remove FENCEPOINTNUM")
             return
+        if self.transfer_busy():
+            return
         if not self.have_list:
             print("Please list fence points first")
             return
@@ -145,10 +164,7 @@ class FenceModule(mp_module.MPModule):
 
         # note we don't subtract 1, as first fence point is the return point
         self.fenceloader.remove(idx)
-        if self.send_fence():
-            print("Removed fence point %u" % idx)
-        else:
-            print("Failed to remove fence point %u" % idx)
+        self.send_fence(success="Removed fence point %u" % idx)
 
     def cmd_fence(self, args):
         '''fence commands'''
@@ -180,6 +196,8 @@ class FenceModule(mp_module.MPModule):
             if len(args) != 2:
                 print("usage: fence show <filename>")
                 return
+            if self.transfer_busy():
+                return
             self.fenceloader.load(args[1])
             self.have_list = True
         elif args[0] == "draw":
@@ -195,6 +213,8 @@ class FenceModule(mp_module.MPModule):
 
     def load_fence(self, filename):
         '''load fence points from a file'''
+        if self.transfer_busy():
+            return
         try:
             self.fenceloader.target_system = self.target_system
             self.fenceloader.target_component = self.target_component
@@ -205,50 +225,69 @@ class FenceModule(mp_module.MPModule):
         print("Loaded %u geo-fence points from %s" % (self.fenceloader.count(), filename))
         self.send_fence()
 
-    def send_fence(self):
-        '''send fence points from fenceloader'''
+    def send_fence(self, success=None):
+        '''send fence points from fenceloader, reading each one back to
+        check it. success is printed when all points are verified'''
+        if self.transfer_busy():
+            return
         # must disable geo-fencing when loading
         self.fenceloader.target_system = self.target_system
         self.fenceloader.target_component = self.target_component
         self.fenceloader.reindex()
-        action = self.get_mav_param('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE)
+        self.xfer_action = self.get_mav_param('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE)
         self.param_set('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE, 3)
         self.param_set('FENCE_TOTAL', self.fenceloader.count(), 3)
-        for i in range(self.fenceloader.count()):
-            p = self.fenceloader.point(i)
-            self.master.mav.send(p)
-            p2 = self.fetch_fence_point(i)
-            if p2 is None:
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-            if (p.idx != p2.idx or
-                abs(p.lat - p2.lat) >= 0.00003 or
-                abs(p.lng - p2.lng) >= 0.00003):
-                print("Failed to send fence point %u" % i)
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-        self.param_set('FENCE_ACTION', action, 3)
-        return True
-
-    def fetch_fence_point(self ,i):
-        '''fetch one fence point'''
+        self.xfer_success = success
+        self.start_transfer('send', self.fenceloader.count(), self.send_fence_point)
+
+    def send_fence_point(self, i):
+        '''send one fence point and ask for it back'''
+        self.master.mav.send(self.fenceloader.point(i))
+        self.fetch_fence_point(i)
+
+    def fetch_fence_point(self, i):
+        '''request one fence point'''
         self.master.mav.fence_fetch_point_send(self.target_system,
-                                                    self.target_component, i)
-        tstart = time.time()
-        p = None
-        while time.time() - tstart < 3:
-            p = self.master.recv_match(type='FENCE_POINT', blocking=False)
-            if p is not None:
-                break
-            time.sleep(0.1)
-            continue
-        if p is None:
-            self.console.error("Failed to fetch point %u" % i)
-            return None
-        return p
+                                               self.target_component, i)
+
+    def start_transfer(self, op, count, request):
+        '''start a windowed transfer of count fence points as a task'''
+        self.xfer_op = op
+        self.xfer = mp_transfer.MPPointTransfer(range(count), request)
+        if op == 'send':
+            check = self.check_fence_point
+        else:
+            check = None
+        self.start_task(self.xfer.run('FENCE_POINT', check, self.transfer_done),
+                        name='fence %s' % op)
+
+    def check_fence_point(self, m):
+        '''see if a fence point read back after sending it matches'''
+        p = self.fenceloader.point(m.idx)
+        return (abs(p.lat - m.lat) < 0.00003 and
+                abs(p.lng - m.lng) < 0.00003)
+
+    def transfer_done(self, xfer):
+        '''finish a transfer which is complete or has failed'''
+        if xfer.failed is not None:
+            if self.xfer_op == 'send':
+                print("Failed to send fence point %u" % xfer.failed)
+            else:
+                self.console.error("Failed to fetch point %u" % xfer.failed)
+        self.xfer = None
+        if self.xfer_op == 'send':
+            self.param_set('FENCE_ACTION', self.xfer_action, 3)
+            if xfer.failed is None and self.xfer_success is not None:
+                print(self.xfer_success)
+        elif xfer.failed is None:
+            for p in xfer.point_list():
+                self.fenceloader.add(p)
+            self.list_complete(self.xfer_filename)
 
     def fence_draw_callback(self, points):
         '''callback from drawing a fence'''
+        if self.transfer_busy():
+            return
         self.fenceloader.clear()
         if len(points) < 3:
             return
@@ -267,17 +306,18 @@ class FenceModule(mp_module.MPModule):
 
     def list_fence(self, filename):
         '''list fence points, optionally saving to a file'''
+        if self.transfer_busy():
+            return
         self.fenceloader.clear()
         count = self.get_mav_param('FENCE_TOTAL', 0)
         if count == 0:
             print("No geo-fence points")
             return
-        for i in range(int(count)):
-            p = self.fetch_fence_point(i)
-            if p is None:
-                return
-            self.fenceloader.add(p)
+        self.xfer_filename = filename
+        self.start_transfer('list', int(count), self.fetch_fence_point)
 
+    def list_complete(self, filename):
+        '''show or save the fence once all points are fetched'''
         if filename is not None:
             try:
                 self.fenceloader.save(filename)
@@ -96,46 +96,18 @@ class KmlReadModule(mp_module.MPModule):
                 self.send_fence()
 
     def send_fence(self):
-        '''send fence points from fenceloader. Taken from fence module'''
-        # must disable geo-fencing when loading
-        self.fenceloader.target_system = self.target_system
-        self.fenceloader.target_component = self.target_component
-        self.fenceloader.reindex()
-        action = self.get_mav_param('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE)
-        self.param_set('FENCE_ACTION', mavutil.mavlink.FENCE_ACTION_NONE, 3)
-        self.param_set('FENCE_TOTAL', self.fenceloader.count(), 3)
+        '''send fence points from fenceloader using the fence module'''
+        fence = self.module('fence')
+        if fence is None:
+            print("fence module not loaded")
+            return
+        if fence.transfer_busy():
+            return
+        fence.fenceloader.clear()
         for i in range(self.fenceloader.count()):
-            p = self.fenceloader.point(i)
-            self.master.mav.send(p)
-            p2 = self.fetch_fence_point(i)
-            if p2 is None:
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-            if (p.idx != p2.idx or
-                abs(p.lat - p2.lat) >= 0.00003 or
-                abs(p.lng - p2.lng) >= 0.00003):
-                print("Failed to send fence point %u" % i)
-                self.param_set('FENCE_ACTION', action, 3)
-                return False
-        self.param_set('FENCE_ACTION', action, 3)
-        return True
-
-    def fetch_fence_point(self ,i):
-        '''fetch one fence point. Taken from fence module'''
-        self.master.mav.fence_fetch_point_send(self.target_system,
-                                                    self.target_component, i)
-        tstart = time.time()
-        p = None
-        while time.time() - tstart < 3:
-            p = self.master.recv_match(type='FENCE_POINT', blocking=False)
-            if p is not None:
-                break
-            time.sleep(0.1)
-            continue
-        if p is None:
-            self.console.error("Failed to fetch point %u" % i)
-            return None
-        return p
+            fence.fenceloader.add(self.fenceloader.point(i))
+        fence.send_fence()
+        fence.have_list = True
                                     
     def togglekml(self, layername):
         '''toggle the display of a kml'''
@@ -7,10 +7,13 @@
 '''
 
 from pymavlink import mavutil
-import time, struct, math, sys, fnmatch, traceback
+import time, math, sys, fnmatch, traceback
 
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_router
+from MAVProxy.modules.lib import mp_linkstats
+from MAVProxy.modules.lib import mp_dedup
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -27,10 +30,16 @@ class LinkModule(mp_module.MPModule):
         super(LinkModule, self).__init__(mpstate, "link", "link control", public=True)
         self.add_command('link', self.cmd_link, "link control",
                          ["<list|ports>",
+                          'stats <json|reset>',
                           'add (SERIALPORT)',
                           'remove (LINKS)'])
         self.no_fwd_types = set()
         self.no_fwd_types.add("BAD_DATA")
+        self.delayed_msgids = mp_router.msgids_for_types(delayedPackets)
+        # message type -> modules wanting it, rebuilt when modules change
+        self.packet_handlers = {}
+        self.packet_handlers_all = []
+        self.packet_handlers_generation = -1
         self.add_completion_function('(SERIALPORT)', self.complete_serial_ports)
         self.add_completion_function('(LINKS)', self.complete_links)
 
@@ -45,6 +54,10 @@ class LinkModule(mp_module.MPModule):
                                              MPMenuItem('List', 'List', '# link list'),
                                              MPMenuItem('Status', 'Status', '# link')])
             self.last_menu_update = 0
+        self.stats_period = mavutil.periodic_event(1)
+        # duplicate suppression for decoded messages and for raw frames
+        self.dedup = mp_dedup.MPDedup()
+        self.frame_dedup = mp_dedup.MPDedup()
 
     def idle_task(self):
         '''called on idle'''
@@ -54,10 +67,56 @@ class LinkModule(mp_module.MPModule):
             self.menu_add.items = [ MPMenuItem(p, p, '# link add %s' % p) for p in self.complete_serial_ports('') ]
             self.menu_rm.items = [ MPMenuItem(p, p, '# link remove %s' % p) for p in self.complete_links('') ]
             self.module('console').add_menu(self.menu)
+        update_rates = self.stats_period.trigger()
+        tnow = time.time()
         for m in self.mpstate.mav_master:
             m.source_system = self.settings.source_system
             m.mav.srcSystem = m.source_system
             m.mav.srcComponent = self.settings.source_component
+            self.update_eventloop_fd(m)
+            if update_rates:
+                m.stats.update_rates(tnow)
+        if update_rates and self.settings.autolink:
+            self.select_best_link()
+
+    def link_score(self, master):
+        '''score a link for auto selection, lower is better. Each percent
+        of packet loss counts as 20ms of latency'''
+        return master.stats.latency_ms + 20 * master.stats.interval_loss
+
+    def select_best_link(self):
+        '''switch the primary link to the best working link, with some
+        hysteresis to avoid flapping between similar links'''
+        if len(self.mpstate.mav_master) < 2:
+            return
+        if self.settings.link > len(self.mpstate.mav_master):
+            self.settings.link = 1
+        current = self.mpstate.mav_master[self.settings.link-1]
+        best = None
+        for m in self.mpstate.mav_master:
+            if m.linkerror:
+                continue
+            if best is None or self.link_score(m) < self.link_score(best):
+                best = m
+        if best is None or best is current:
+            return
+        if not current.linkerror and self.link_score(best) + 50 > self.link_score(current):
+            return
+        self.settings.link = best.linknum+1
+        self.say("using link %u" % (best.linknum+1))
+
+    def update_eventloop_fd(self, conn):
+        '''keep the event loop registration for a master link in step with
+        its fd, which changes when a serial port is reopened and is not
+        polled while the port is dead'''
+        fd = conn.fd
+        if conn.portdead:
+            fd = None
+        if fd == conn.eventloop_fd:
+            return
+        self.mpstate.eventloop.unregister(conn.eventloop_fd)
+        self.mpstate.eventloop.register(fd, self.mpstate.functions.process_master, conn)
+        conn.eventloop_fd = fd
 
     def complete_serial_ports(self, text):
         '''return list of serial ports'''
@@ -81,13 +140,15 @@ class LinkModule(mp_module.MPModule):
             self.cmd_link_add(args[1:])
         elif args[0] == "ports":
             self.cmd_link_ports()
+        elif args[0] == "stats":
+            self.cmd_link_stats(args[1:])
         elif args[0] == "remove":
             if len(args) != 2:
                 print("Usage: link remove LINK")
                 return
             self.cmd_link_remove(args[1:])
         else:
-            print("usage: link <list|add|remove>")
+            print("usage: link <list|add|remove|stats>")
 
     def show_link(self):
         '''show link information'''
@@ -109,6 +170,29 @@ class LinkModule(mp_module.MPModule):
                                                                                     master.mav_loss,
                                                                                     master.packet_loss(),
                                                                                     sign_string))
+    def cmd_link_stats(self, args):
+        '''show link statistics'''
+        if len(args) > 0 and args[0] == "json":
+            import json
+            print(json.dumps(self.stats_snapshot()))
+        elif len(args) > 0 and args[0] == "reset":
+            for master in self.mpstate.mav_master:
+                master.stats.reset()
+        else:
+            for master in self.mpstate.mav_master:
+                print("link %u %s" % (master.linknum+1, master.stats))
+            print("dedup %s frames %s" % (self.dedup, self.frame_dedup))
+
+    def stats_snapshot(self):
+        '''return a machine readable snapshot of the statistics for all links'''
+        ret = {}
+        for master in self.mpstate.mav_master:
+            snapshot = master.stats.snapshot()
+            snapshot['address'] = master.address
+            snapshot['linkerror'] = master.linkerror
+            ret[master.linknum+1] = snapshot
+        return ret
+
     def cmd_link_list(self):
         '''list links'''
         print("%u links" % len(self.mpstate.mav_master))
@@ -139,7 +223,10 @@ class LinkModule(mp_module.MPModule):
         conn.last_heartbeat = 0
         conn.last_message = 0
         conn.highest_msec = 0
+        conn.eventloop_fd = None
+        conn.stats = mp_linkstats.MPLinkStats()
         self.mpstate.mav_master.append(conn)
+        self.update_eventloop_fd(conn)
         self.status.counters['MasterIn'].append(0)
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
@@ -169,6 +256,7 @@ class LinkModule(mp_module.MPModule):
             conn = self.mpstate.mav_master[i]
             if str(i) == device or conn.address == device:
                 print("Removing link %s" % conn.address)
+                self.mpstate.eventloop.unregister(conn.eventloop_fd)
                 try:
                     try:
                         mp_util.child_fd_list_remove(conn.port.fileno())
@@ -196,11 +284,89 @@ class LinkModule(mp_module.MPModule):
             if fnmatch.fnmatch(m.get_type().upper(), self.status.watch.upper()):
                 self.mpstate.console.writeln('> '+ str(m))
 
+        master.stats.packet_out(m)
+
         mtype = m.get_type()
         if mtype != 'BAD_DATA' and self.mpstate.logqueue:
             usec = self.get_usec()
             usec = (usec & ~3) | 3 # linknum 3
-            self.mpstate.logqueue.put(str(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put(m.get_msgbuf(), usec=usec)
+
+    def output_write(self, conn, buf):
+        '''write a message to an output, coalescing writes when batch_io is set'''
+        if self.settings.batch_io:
+            self.mpstate.batch_io.write(conn, buf)
+        else:
+            conn.write(buf)
+
+    def route_frames(self, master, s):
+        '''forward raw frames from a master to the outputs without parsing
+        them, returning the data which still needs to be parsed. Every
+        frame is still parsed for the message state and link statistics,
+        so the CRC is only left to the parser for frames which are never
+        forwarded'''
+        no_fwd = mp_router.msgids_for_types(self.no_fwd_types)
+        if not self.mpstate.settings.mavfwd_rate:
+            no_fwd.add(mavutil.mavlink.MAVLINK_MSG_ID_REQUEST_DATA_STREAM)
+        if master.link_delayed:
+            # don't forward delayed packets that cause double reporting
+            no_fwd.update(self.delayed_msgids)
+        framer = mp_router.get_framer(master)
+        map_wanted = self.module('map') is not None
+        dedup = self.settings.dedup and len(self.mpstate.mav_master) > 1
+        ret = []
+        for (f, sysid, compid, msgid) in framer.frames(s, no_fwd):
+            if msgid is None:
+                # noise or bad CRC, leave it to the parser to report
+                ret.append(f)
+                continue
+            if sysid in self.mpstate.sysid_outputs:
+                # handled by a specialised sysid connection, only the map
+                # needs to see the secondary vehicle position
+                if msgid in no_fwd and not framer.frame_crc_ok(f):
+                    ret.append(f)
+                    continue
+                if dedup and not self.frame_dedup.check(mp_router.frame_key(f, sysid, compid, msgid),
+                                                        master.linknum):
+                    continue
+                self.output_write(self.mpstate.sysid_outputs[sysid], f)
+                if msgid == mavutil.mavlink.MAVLINK_MSG_ID_GLOBAL_POSITION_INT and map_wanted:
+                    ret.append(f)
+                continue
+            if dedup and not self.frame_dedup.check(mp_router.frame_key(f, sysid, compid, msgid),
+                                                    master.linknum):
+                # already forwarded from another link
+                pass
+            elif (msgid == mavutil.mavlink.MAVLINK_MSG_ID_HEARTBEAT and
+                  compid == mavutil.mavlink.MAV_COMP_ID_GIMBAL):
+                # silence gimbal heartbeat packets for now
+                pass
+            elif not msgid in no_fwd:
+                for r in self.mpstate.mav_outputs:
+                    self.output_write(r, f)
+            ret.append(f)
+        return ''.join(ret)
+
+    def update_packet_handlers(self):
+        '''rebuild the index of which modules want each message type,
+        keeping module load order for each type'''
+        handlers = {}
+        handlers_all = []
+        for (mod,pm) in self.mpstate.modules:
+            if not mod.wants_mavlink_packet():
+                continue
+            if mod.mavlink_types is None:
+                handlers_all.append(mod)
+                for mtype in handlers:
+                    handlers[mtype].append(mod)
+                continue
+            for mtype in mod.mavlink_types:
+                if not mtype in handlers:
+                    handlers[mtype] = handlers_all[:]
+                handlers[mtype].append(mod)
+        self.packet_handlers = handlers
+        self.packet_handlers_all = handlers_all
+        self.packet_handlers_generation = self.mpstate.module_generation
 
     def handle_msec_timestamp(self, m, master):
         '''special handling for MAVLink packets with a time_boot_ms field'''
@@ -227,6 +393,7 @@ class LinkModule(mp_module.MPModule):
             master.link_delayed = True
         else:
             master.link_delayed = False
+        master.stats.latency_update(self.status.highest_msec - msec)
 
     def colors_for_severity(self, severity):
         severity_colors = {
@@ -268,11 +435,22 @@ class LinkModule(mp_module.MPModule):
     def master_callback(self, m, master):
         '''process mavlink message m on master, sending any messages to recipients'''
 
+        mtype = m.get_type()
+
+        # see if this is a copy of a packet already received on another link
+        duplicate = False
+        if self.settings.dedup and len(self.mpstate.mav_master) > 1 and mtype != 'BAD_DATA':
+            key = (m.get_srcSystem(), m.get_srcComponent(), m.get_seq(), m.get_msgId(), getattr(m, '_crc', None))
+            duplicate = not self.dedup.check(key, master.linknum)
+
         # see if it is handled by a specialised sysid connection
         sysid = m.get_srcSystem()
         if sysid in self.mpstate.sysid_outputs:
-            self.mpstate.sysid_outputs[sysid].write(m.get_msgbuf())
-            if m.get_type() == "GLOBAL_POSITION_INT" and self.module('map') is not None:
+            if duplicate:
+                return
+            if not self.settings.router:
+                self.output_write(self.mpstate.sysid_outputs[sysid], m.get_msgbuf())
+            if mtype == "GLOBAL_POSITION_INT" and self.module('map') is not None:
                 self.module('map').set_secondary_vehicle_position(m)
             return
 
@@ -280,7 +458,8 @@ class LinkModule(mp_module.MPModule):
             master.post_message(m)
         self.status.counters['MasterIn'][master.linknum] += 1
 
-        mtype = m.get_type()
+        if mtype != 'BAD_DATA':
+            master.stats.packet_in(m, time.time())
 
         # and log them
         if mtype not in dataPackets and self.mpstate.logqueue:
@@ -288,13 +467,14 @@ class LinkModule(mp_module.MPModule):
             # delay in saved logs
             usec = self.get_usec()
             usec = (usec & ~3) | master.linknum
-            self.mpstate.logqueue.put(str(struct.pack('>Q', usec) + m.get_msgbuf()))
+            self.mpstate.logqueue.put(m.get_msgbuf(), usec=usec)
 
         # keep the last message of each type around
-        self.status.msgs[m.get_type()] = m
-        if not m.get_type() in self.status.msg_count:
-            self.status.msg_count[m.get_type()] = 0
-        self.status.msg_count[m.get_type()] += 1
+        if not duplicate:
+            self.status.msgs[m.get_type()] = m
+            if not m.get_type() in self.status.msg_count:
+                self.status.msg_count[m.get_type()] = 0
+            self.status.msg_count[m.get_type()] += 1
 
         if m.get_srcComponent() == mavutil.mavlink.MAV_COMP_ID_GIMBAL and m.get_type() == 'HEARTBEAT':
             # silence gimbal heartbeat packets for now
@@ -311,6 +491,10 @@ class LinkModule(mp_module.MPModule):
             self.status.last_message = time.time()
             master.last_message = self.status.last_message
 
+        if duplicate:
+            # the first copy has already been processed and forwarded
+            return
+
         if master.link_delayed:
             # don't process delayed packets that cause double reporting
             if mtype in delayedPackets:
@@ -443,15 +627,22 @@ class LinkModule(mp_module.MPModule):
             # pass messages along to listeners, except for REQUEST_DATA_STREAM, which
             # would lead a conflict in stream rate setting between mavproxy and the other
             # GCS
-            if self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
+            if self.settings.router:
+                # already forwarded by route_frames()
+                pass
+            elif self.mpstate.settings.mavfwd_rate or mtype != 'REQUEST_DATA_STREAM':
                 if not mtype in self.no_fwd_types:
                     for r in self.mpstate.mav_outputs:
-                        r.write(m.get_msgbuf())
+                        self.output_write(r, m.get_msgbuf())
 
-            # pass to modules
-            for (mod,pm) in self.mpstate.modules:
-                if not hasattr(mod, 'mavlink_packet'):
-                    continue
+            # resume module tasks waiting for this message
+            if self.mpstate.tasks.waiting:
+                self.mpstate.tasks.mavlink_packet(m)
+
+            # pass to modules which want this message type
+            if self.packet_handlers_generation != self.mpstate.module_generation:
+                self.update_packet_handlers()
+            for mod in self.packet_handlers.get(mtype, self.packet_handlers_all):
                 try:
                     mod.mavlink_packet(m)
                 except Exception as msg:
@@ -49,19 +49,27 @@ class MapModule(mp_module.MPModule):
               ('showahrs2pos', int, 0),
               ('showahrs3pos', int, 0),
               ('brightness', float, 1),
+              ('maxfps', float, 10),
               ('rallycircle', bool, False),
               ('loitercircle',bool, False)])
         service='OviHybrid'
         if 'MAP_SERVICE' in os.environ:
             service = os.environ['MAP_SERVICE']
+        self.map_service = service
+        # background tile cache seeding
+        self.seeder = None
+        self.seed_period = mavutil.periodic_event(0.2)
         import platform
         from MAVProxy.modules.mavproxy_map import mp_slipmap
-        mpstate.map = mp_slipmap.MPSlipMap(service=service, elevation=True, title='Map')
+        mpstate.map = mp_slipmap.MPSlipMap(service=service, elevation=True, title='Map',
+                                           max_fps=self.map_settings.maxfps)
         mpstate.map_functions = { 'draw_lines' : self.draw_lines }
 
         mpstate.map.add_callback(functools.partial(self.map_callback))
         self.add_command('map', self.cmd_map, "map control", ['icon',
-                                      'set (MAPSETTING)'])
+                                      'set (MAPSETTING)',
+                                      'seed <status|stop>',
+                                      'stats'])
         self.add_completion_function('(MAPSETTING)', self.map_settings.completion)
 
         self.default_popup = MPMenuSubMenu('Popup', items=[])
@@ -128,10 +136,96 @@ class MapModule(mp_module.MPModule):
         elif args[0] == "set":
             self.map_settings.command(args[1:])
             self.mpstate.map.add_object(mp_slipmap.SlipBrightness(self.map_settings.brightness))
+            self.mpstate.map.add_object(mp_slipmap.SlipFrameRate(self.map_settings.maxfps))
         elif args[0] == "sethome":
             self.cmd_set_home(args)
+        elif args[0] == "seed":
+            self.cmd_seed(args[1:])
+        elif args[0] == "stats":
+            print(self.mpstate.map.stats())
         else:
-            print("usage: map <icon|set>")
+            print("usage: map <icon|set|seed|stats>")
+
+    def seed_points(self, args):
+        '''return (points, polygon) for the area to seed'''
+        if args[0] == "box" and len(args) == 5:
+            try:
+                return ([(float(args[1]), float(args[2])), (float(args[3]), float(args[4]))], False)
+            except ValueError:
+                print("Invalid box corners")
+                return ([], False)
+        if args[0] == "wp":
+            if self.module('wp') is None:
+                print("wp module not loaded")
+                return ([], False)
+            wploader = self.module('wp').wploader
+            points = []
+            for i in range(wploader.count()):
+                w = wploader.wp(i)
+                if w.x != 0 or w.y != 0:
+                    points.append((w.x, w.y))
+            # a mission is a path rather than an area, so seed its bounding box
+            return (points, False)
+        if args[0] == "fence":
+            if self.module('fence') is None:
+                print("fence module not loaded")
+                return ([], False)
+            fenceloader = self.module('fence').fenceloader
+            # skip the return point
+            points = [(p.lat, p.lng) for p in fenceloader.points[1:]]
+            return (points, True)
+        if args[0] == "kml" and len(args) == 2:
+            kml = self.module('kmlread')
+            if kml is None:
+                print("kmlread module not loaded")
+                return ([], False)
+            for layer in kml.allayers:
+                if layer.key == args[1]:
+                    return (layer.points, True)
+            print("No kml layer %s" % args[1])
+            return ([], False)
+        print("usage: map seed ZOOM_MIN ZOOM_MAX <box LAT1 LON1 LAT2 LON2|wp|fence|kml LAYER>")
+        return ([], False)
+
+    def cmd_seed(self, args):
+        '''seed the tile cache for an area'''
+        from MAVProxy.modules.mavproxy_map import mp_tile, mp_tileseed
+        if len(args) == 1 and args[0] == "status":
+            if self.seeder is None:
+                print("No tile seeding in progress")
+            else:
+                print(self.seeder.status())
+            return
+        if len(args) == 1 and args[0] == "stop":
+            if self.seeder is not None:
+                self.seeder.stop()
+                print(self.seeder.status())
+                self.seeder = None
+            return
+        if len(args) < 3:
+            print("usage: map seed ZOOM_MIN ZOOM_MAX <box LAT1 LON1 LAT2 LON2|wp|fence|kml LAYER>")
+            print("       map seed <status|stop>")
+            return
+        if self.seeder is not None:
+            print("Tile seeding already in progress")
+            return
+        try:
+            zoom_min = int(args[0])
+            zoom_max = int(args[1])
+        except ValueError:
+            print("usage: map seed ZOOM_MIN ZOOM_MAX <box LAT1 LON1 LAT2 LON2|wp|fence|kml LAYER>")
+            return
+        (points, polygon) = self.seed_points(args[2:])
+        if len(points) == 0:
+            print("No points to seed")
+            return
+        mt = mp_tile.MPTile(service=self.map_service)
+        if zoom_min < mt.min_zoom or zoom_max > mt.max_zoom or zoom_min > zoom_max:
+            print("Zoom levels must be from %u to %u" % (mt.min_zoom, mt.max_zoom))
+            return
+        tiles = mp_tileseed.seed_tiles(mt, points, zoom_min, zoom_max, polygon=polygon)
+        self.seeder = mp_tileseed.MPTileSeeder(mt, tiles)
+        print(self.seeder.status())
 
     def display_waypoints(self):
         '''display the waypoints'''
@@ -355,6 +449,10 @@ class MapModule(mp_module.MPModule):
             self.last_unload_check_time = now
             if not self.mpstate.map.is_alive():
                 self.needs_unloading = True
+        if self.seeder is not None and self.seed_period.trigger():
+            print(self.seeder.status())
+            if self.seeder.done():
+                self.seeder = None
 
     def create_vehicle_icon(self, name, colour, follow=False, vehicle_type=None):
         '''add a vehicle to the map'''
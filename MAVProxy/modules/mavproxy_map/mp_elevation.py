@@ -5,6 +5,7 @@ It will grab the altitude of a long,lat pair from the SRTM database
 Created by Stephen Dade (stephen_dade@hotmail.com)
 '''
 
+import math
 import os
 import sys
 import time
@@ -23,7 +24,6 @@ class ElevationModel():
         if self.database == 'srtm':
             self.downloader = srtm.SRTMDownloader(offline=offline, debug=debug)
             self.downloader.loadFileList()
-            self.tileDict = dict()
 
         '''Use the Geoscience Australia database instead - watch for the correct database path'''
         if self.database == 'geoscience':
@@ -36,26 +36,49 @@ class ElevationModel():
         if latitude is None or longitude is None:
             return None
         if self.database == 'srtm':
-            TileID = (numpy.floor(latitude), numpy.floor(longitude))
-            if TileID in self.tileDict:
-                alt = self.tileDict[TileID].getAltitudeFromLatLon(latitude, longitude)
-            else:
-                tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                if tile == 0:
-                    if timeout > 0:
-                        t0 = time.time()
-                        while time.time() < t0+timeout and tile == 0:
-                            tile = self.downloader.getTile(numpy.floor(latitude), numpy.floor(longitude))
-                            if tile == 0:
-                                time.sleep(0.1)
-                if tile == 0:
-                    return None
-                self.tileDict[TileID] = tile
-                alt = tile.getAltitudeFromLatLon(latitude, longitude)
+            tile = self.getTile(int(math.floor(latitude)), int(math.floor(longitude)), timeout)
+            if tile == 0:
+                return None
+            alt = tile.getAltitudeFromLatLon(latitude, longitude)
         if self.database == 'geoscience':
              alt = self.mappy.getAltitudeAtPoint(latitude, longitude)
         return alt
 
+    def getTile(self, lat, lon, timeout=0):
+        '''get a SRTM tile from the downloader's cache, waiting up to timeout
+        seconds for it to be downloaded. Returns 0 if it is not available'''
+        tile = self.downloader.getTile(lat, lon)
+        if tile == 0 and timeout > 0:
+            t0 = time.time()
+            while time.time() < t0+timeout and tile == 0:
+                time.sleep(0.1)
+                tile = self.downloader.getTile(lat, lon)
+        return tile
+
+    def GetElevationArray(self, lats, lons, timeout=0):
+        '''Returns a numpy array of altitudes (m ASL) for arrays of lat/long
+        points, with NaN where the altitude is unknown'''
+        lats = numpy.asarray(lats, dtype=float)
+        lons = numpy.asarray(lons, dtype=float)
+        alts = numpy.empty(lats.shape)
+        alts.fill(numpy.nan)
+        if self.database == 'geoscience':
+            for i in numpy.ndindex(lats.shape):
+                alt = self.mappy.getAltitudeAtPoint(lats[i], lons[i])
+                if alt is not None:
+                    alts[i] = alt
+            return alts
+        # look up each SRTM tile once for all the points in it
+        tile_lats = numpy.floor(lats).astype(int)
+        tile_lons = numpy.floor(lons).astype(int)
+        for (tlat, tlon) in set(zip(tile_lats.flat, tile_lons.flat)):
+            tile = self.getTile(tlat, tlon, timeout)
+            if tile == 0:
+                continue
+            sel = (tile_lats == tlat) & (tile_lons == tlon)
+            alts[sel] = tile.getAltitudeArray(lats[sel], lons[sel])
+        return alts
+
 
 if __name__ == "__main__":
 
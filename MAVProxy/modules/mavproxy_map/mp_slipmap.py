@@ -9,6 +9,7 @@ June 2012
 import functools
 import math
 import os, sys
+import threading
 import time
 
 try:
@@ -33,13 +34,15 @@ class MPSlipMap():
                  width=800,
                  height=600,
                  ground_width=1000,
-                 tile_delay=0.3,
+                 tile_delay=0.1,
                  service="MicrosoftSat",
                  max_zoom=19,
                  debug=False,
                  brightness=1.0,
                  elevation=False,
-                 download=True):
+                 download=True,
+                 max_fps=10,
+                 batch_period=0.05):
         import multiprocessing
 
         self.lat = lat
@@ -55,6 +58,7 @@ class MPSlipMap():
         self.elevation = elevation
         self.oldtext = None
         self.brightness = brightness
+        self.max_fps = max_fps
 
         self.drag_step = 10
 
@@ -68,6 +72,16 @@ class MPSlipMap():
         self.child.start()
         self._callbacks = set()
 
+        # objects for the child are batched, with superseded updates for
+        # the same key coalesced, and sent every batch_period seconds
+        self.batch_period = batch_period
+        self._pending = []
+        self._pending_objects = {}
+        self._pending_positions = {}
+        self._pending_lock = threading.Lock()
+        self._flush_thread = None
+        self.counters = { 'Queued' : 0, 'Coalesced' : 0, 'Batches' : 0, 'Sent' : 0, 'MaxDepth' : 0 }
+
 
     def child_task(self):
         '''child process - this holds all the GUI elements'''
@@ -96,6 +110,7 @@ class MPSlipMap():
 
     def close(self):
         '''close the window'''
+        self.flush()
         self.close_window.release()
         count=0
         while self.child.is_alive() and count < 30: # 3 seconds to die...
@@ -111,21 +126,93 @@ class MPSlipMap():
         '''check if graph is still going'''
         return self.child.is_alive()
 
+    def queue_object(self, obj):
+        '''queue an object for the child. A SlipObject or SlipPosition
+        replaces a pending update of the same kind for its key, as long as
+        nothing else that could depend on the order has been queued since'''
+        if self.batch_period <= 0:
+            self.object_queue.put(obj)
+            self.counters['Sent'] += 1
+            return
+        self._pending_lock.acquire()
+        self.counters['Queued'] += 1
+        if isinstance(obj, SlipPosition):
+            self._pending_objects.pop(obj.key, None)
+            idx = self._pending_positions.get(obj.key)
+            if idx is not None and self._pending[idx].layer == obj.layer:
+                self._pending[idx] = obj
+                self.counters['Coalesced'] += 1
+            else:
+                self._pending_positions[obj.key] = len(self._pending)
+                self._pending.append(obj)
+        elif isinstance(obj, SlipObject):
+            self._pending_positions.pop(obj.key, None)
+            idx = self._pending_objects.get(obj.key)
+            if idx is not None and self._pending[idx].layer == obj.layer:
+                self._pending[idx] = obj
+                self.counters['Coalesced'] += 1
+            else:
+                self._pending_objects[obj.key] = len(self._pending)
+                self._pending.append(obj)
+        else:
+            # anything else keeps its place relative to all earlier updates
+            self._pending_objects = {}
+            self._pending_positions = {}
+            self._pending.append(obj)
+        self._pending_lock.release()
+        if self._flush_thread is None:
+            self._flush_thread = threading.Thread(target=self._flush_loop)
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
+
+    def flush(self):
+        '''send any pending objects to the child as one batch'''
+        self._pending_lock.acquire()
+        pending = self._pending
+        self._pending = []
+        self._pending_objects = {}
+        self._pending_positions = {}
+        self._pending_lock.release()
+        if len(pending) == 0:
+            return
+        self.object_queue.put(SlipBatch(pending))
+        self.counters['Batches'] += 1
+        self.counters['Sent'] += len(pending)
+        self.counters['MaxDepth'] = max(self.counters['MaxDepth'], self.queue_depth())
+
+    def _flush_loop(self):
+        '''thread sending batches to the child'''
+        while self.child.is_alive():
+            time.sleep(self.batch_period)
+            self.flush()
+
+    def queue_depth(self):
+        '''number of messages waiting for the child'''
+        try:
+            return self.object_queue.qsize()
+        except NotImplementedError:
+            return 0
+
+    def stats(self):
+        '''return a string describing the update traffic to the child'''
+        return "Map updates: %u pending, queue depth %u, %s" % (len(self._pending), self.queue_depth(),
+                                                                 self.counters)
+
     def add_object(self, obj):
         '''add or update an object on the map'''
-        self.object_queue.put(obj)
+        self.queue_object(obj)
 
     def remove_object(self, key):
         '''remove an object on the map by key'''
-        self.object_queue.put(SlipRemoveObject(key))
+        self.queue_object(SlipRemoveObject(key))
 
     def hide_object(self, key, hide=True):
         '''hide an object on the map by key'''
-        self.object_queue.put(SlipHideObject(key, hide))
+        self.queue_object(SlipHideObject(key, hide))
 
     def set_position(self, key, latlon, layer=None, rotation=0):
         '''move an object on the map'''
-        self.object_queue.put(SlipPosition(key, latlon, layer, rotation))
+        self.queue_object(SlipPosition(key, latlon, layer, rotation))
 
     def event_count(self):
         '''return number of events waiting to be processed'''
@@ -163,7 +250,7 @@ if __name__ == "__main__":
     parser.add_option("--lon", type='float', default=151.840113, help="start longitude")
     parser.add_option("--service", default="MicrosoftSat", help="tile service")
     parser.add_option("--offline", action='store_true', default=False, help="no download")
-    parser.add_option("--delay", type='float', default=0.3, help="tile download delay")
+    parser.add_option("--delay", type='float', default=0.1, help="tile download delay")
     parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
     parser.add_option("--debug", action='store_true', default=False, help="show debug info")
     parser.add_option("--boundary", default=None, help="show boundary")
@@ -3,6 +3,7 @@ from ..lib.wx_loader import wx
 import mp_elevation
 import os
 import functools
+import inspect
 from mp_slipmap_util import *
 
 try:
@@ -24,6 +25,20 @@ class MPSlipMapFrame(wx.Frame):
         state.popup_latlon = None
         state.popup_started = False
         state.default_popup = None
+        # handlers for objects sent by the parent
+        self.handlers = {
+            SlipBatch : self.on_batch,
+            SlipObject : self.add_object,
+            SlipPosition : self.on_position,
+            SlipDefaultPopup : self.on_default_popup,
+            SlipInformation : self.on_information,
+            SlipCenter : self.on_center,
+            SlipBrightness : self.on_brightness,
+            SlipFrameRate : self.on_frame_rate,
+            SlipClearLayer : self.on_clear_layer,
+            SlipRemoveObject : self.on_remove_object,
+            SlipHideObject : self.on_hide_object,
+            }
         state.panel = MPSlipMapPanel(self, state)
         self.Bind(wx.EVT_IDLE, self.on_idle)
         self.Bind(wx.EVT_SIZE, state.panel.on_size)
@@ -133,6 +148,85 @@ class MPSlipMapFrame(wx.Frame):
             state.layers[layer].pop(key, None)
         state.need_redraw = True
 
+    def on_position(self, obj):
+        '''move an object'''
+        state = self.state
+        object = self.find_object(obj.key, obj.layer)
+        if object is not None:
+            object.update_position(obj)
+            if getattr(object, 'follow', False):
+                self.follow(object)
+            state.need_redraw = True
+
+    def on_default_popup(self, obj):
+        self.state.default_popup = obj
+
+    def on_information(self, obj):
+        '''see if its a existing information object or a new one'''
+        state = self.state
+        if obj.key in state.info:
+            state.info[obj.key].update(obj)
+        else:
+            state.info[obj.key] = obj
+        state.need_redraw = True
+
+    def on_center(self, obj):
+        '''move center'''
+        state = self.state
+        (lat,lon) = obj.latlon
+        state.panel.re_center(state.width/2, state.height/2, lat, lon)
+        state.need_redraw = True
+
+    def on_brightness(self, obj):
+        '''set map brightness'''
+        state = self.state
+        state.brightness = obj.brightness
+        state.need_redraw = True
+
+    def on_frame_rate(self, obj):
+        '''set maximum redraw rate'''
+        state = self.state
+        state.max_fps = max(obj.max_fps, 1)
+        state.panel.redraw_timer.Start(max(int(1000/state.max_fps), 20))
+
+    def on_clear_layer(self, obj):
+        '''remove all objects from a layer'''
+        state = self.state
+        if obj.layer in state.layers:
+            state.layers.pop(obj.layer)
+        state.need_redraw = True
+
+    def on_remove_object(self, obj):
+        self.remove_object(obj.key)
+
+    def on_hide_object(self, obj):
+        '''hide an object by key'''
+        state = self.state
+        for layer in state.layers:
+            if obj.key in state.layers[layer]:
+                state.layers[layer][obj.key].set_hidden(obj.hide)
+        state.need_redraw = True
+
+    def on_batch(self, obj):
+        '''handle a batch of objects from the parent'''
+        for o in obj.objects:
+            self.handle_object(o)
+
+    def handle_object(self, obj):
+        '''dispatch an object from the parent to its handler, looking
+        handlers up by class and then by base class'''
+        cls = obj.__class__
+        handler = self.handlers.get(cls)
+        if handler is None:
+            for base in inspect.getmro(cls):
+                if base in self.handlers:
+                    handler = self.handlers[base]
+                    break
+            # remember the lookup, including misses
+            self.handlers[cls] = handler
+        if handler is not None:
+            handler(obj)
+
     def on_idle(self, event):
         '''prevent the main loop spinning too fast'''
         state = self.state
@@ -145,62 +239,7 @@ class MPSlipMapFrame(wx.Frame):
 
         while not state.object_queue.empty():
             obj = state.object_queue.get()
-
-            if isinstance(obj, SlipObject):
-                self.add_object(obj)
-
-            if isinstance(obj, SlipPosition):
-                # move an object
-                object = self.find_object(obj.key, obj.layer)
-                if object is not None:
-                    object.update_position(obj)
-                    if getattr(object, 'follow', False):
-                        self.follow(object)
-                    state.need_redraw = True
-
-            if isinstance(obj, SlipDefaultPopup):
-                state.default_popup = obj
-
-            if isinstance(obj, SlipInformation):
-                # see if its a existing one or a new one
-                if obj.key in state.info:
-#                    print('update %s' % str(obj.key))
-                    state.info[obj.key].update(obj)
-                else:
-#                    print('add %s' % str(obj.key))
-                    state.info[obj.key] = obj
-                state.need_redraw = True
-
-            if isinstance(obj, SlipCenter):
-                # move center
-                (lat,lon) = obj.latlon
-                state.panel.re_center(state.width/2, state.height/2, lat, lon)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipBrightness):
-                # set map brightness
-                state.brightness = obj.brightness
-                state.need_redraw = True
-
-            if isinstance(obj, SlipClearLayer):
-                # remove all objects from a layer
-                if obj.layer in state.layers:
-                    state.layers.pop(obj.layer)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipRemoveObject):
-                # remove an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer].pop(obj.key)
-                state.need_redraw = True
-
-            if isinstance(obj, SlipHideObject):
-                # hide an object by key
-                for layer in state.layers:
-                    if obj.key in state.layers[layer]:
-                        state.layers[layer][obj.key].set_hidden(obj.hide)
-                state.need_redraw = True
+            self.handle_object(obj)
 
         if obj is None:
             time.sleep(0.05)
@@ -219,7 +258,7 @@ class MPSlipMapPanel(wx.Panel):
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.Bind(wx.EVT_SET_FOCUS, self.on_focus)
-        self.redraw_timer.Start(200)
+        self.redraw_timer.Start(max(int(1000/state.max_fps), 20))
         self.mouse_pos = None
         self.mouse_down = None
         self.click_pos = None
@@ -265,8 +304,9 @@ class MPSlipMapPanel(wx.Panel):
         # a function to convert from (lat,lon) to (px,py) on the map
         self.pixmapper = functools.partial(self.pixel_coords)
 
-        self.last_view = None
-        self.redraw_map()
+        self.last_base = None
+        self.last_redraw = 0
+        self.redraw_map(force=True)
         state.frame.Fit()
 
     def on_focus(self, event):
@@ -380,32 +420,57 @@ class MPSlipMapPanel(wx.Panel):
             if bounds2 is None or mp_util.bounds_overlap(bounds, bounds2):
                 obj.draw(img, self.pixmapper, bounds)
 
-    def redraw_map(self):
-        '''redraw the map with current settings'''
+    def base_view(self):
+        '''return a tuple representing everything drawn in the base layer'''
         state = self.state
+        return self.current_view() + (state.mt.service, state.brightness, state.grid)
 
-        view_same = (self.last_view and self.map_img and self.last_view == self.current_view())
-
-        if view_same and not state.need_redraw:
-            return
-
-        # get the new map
+    def redraw_base(self):
+        '''rebuild the base layer of map tiles and grid for the current view'''
+        state = self.state
         self.map_img = state.mt.area_to_image(state.lat, state.lon,
                                               state.width, state.height, state.ground_width)
         if state.brightness != 1.0:
             cv.ConvertScale(self.map_img, self.map_img, scale=state.brightness)
 
+        # possibly draw a grid
+        if state.grid:
+            SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(self.map_img, self.pixmapper,
+                                                                           self.view_bounds())
+        self.last_base = self.base_view()
 
-        # find display bounding box
+    def view_bounds(self):
+        '''find display bounding box'''
+        state = self.state
         (lat2,lon2) = self.coordinates(state.width-1, state.height-1)
-        bounds = (lat2, state.lon, state.lat-lat2, lon2-state.lon)
+        return (lat2, state.lon, state.lat-lat2, lon2-state.lon)
 
-        # get the image
-        img = cv.CloneImage(self.map_img)
+    def redraw_map(self, force=False):
+        '''redraw the map with current settings. The tiles are only
+        composed again when the view changes, otherwise the objects are
+        drawn over a copy of the cached base layer. Redraws are limited to
+        state.max_fps unless force is set'''
+        state = self.state
 
-        # possibly draw a grid
-        if state.grid:
-            SlipGrid('grid', layer=3, linewidth=1, colour=(255,255,0)).draw(img, self.pixmapper, bounds)
+        base_same = (self.map_img is not None and self.last_base == self.base_view())
+
+        if base_same and not state.need_redraw:
+            return
+
+        now = time.time()
+        if not force and now - self.last_redraw < 1.0 / state.max_fps:
+            # the redraw timer will pick this up in the next frame
+            return
+        self.last_redraw = now
+
+        # get the new map if the view has changed
+        if not base_same:
+            self.redraw_base()
+
+        bounds = self.view_bounds()
+
+        # draw the objects over a copy of the base layer
+        img = cv.CloneImage(self.map_img)
 
         # draw layer objects
         keys = state.layers.keys()
@@ -417,16 +482,17 @@ class MPSlipMapPanel(wx.Panel):
         for key in state.info:
             state.info[key].draw(state.panel, state.panel.information)
 
-        # display the image
-        self.img = wx.EmptyImage(state.width,state.height)
+        # display the image, reusing the wx image if the size is unchanged
+        if self.img is None or self.img.GetWidth() != state.width or self.img.GetHeight() != state.height:
+            self.img = wx.EmptyImage(state.width,state.height)
         self.img.SetData(img.tostring())
         self.imagePanel.set_image(self.img)
 
         self.update_position()
 
-        self.mainSizer.Fit(self)
+        if not base_same:
+            self.mainSizer.Fit(self)
         self.Refresh()
-        self.last_view = self.current_view()
         self.SetFocus()
         state.need_redraw = False
 
@@ -442,7 +508,7 @@ class MPSlipMapPanel(wx.Panel):
         size = event.GetSize()
         state.width = size.width
         state.height = size.height
-        self.redraw_map()
+        self.redraw_map(force=True)
 
     def on_mouse_wheel(self, event):
         '''handle mouse wheel zoom changes'''
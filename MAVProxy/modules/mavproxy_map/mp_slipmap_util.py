@@ -409,6 +409,16 @@ class SlipBrightness:
     def __init__(self, brightness):
         self.brightness = brightness
 
+class SlipFrameRate:
+    '''an object to change the maximum map redraw rate'''
+    def __init__(self, max_fps):
+        self.max_fps = max_fps
+
+class SlipBatch:
+    '''a list of objects sent to the child in one message'''
+    def __init__(self, objects):
+        self.objects = objects
+
 class SlipClearLayer:
     '''remove all objects in a layer'''
     def __init__(self, layer):
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+'''
+terrain grid blocks for answering TERRAIN_REQUEST
+
+a TERRAIN_REQUEST covers a block of 8x7 4x4 grids, 32x28 points in
+all. The heights for the whole block are looked up in one vectorised
+pass and kept in memory and on disk in the ArduPilot terrain DAT
+layout, one N/S??E/W???.DAT file per degree and grid spacing, so a
+block is only computed once.
+'''
+
+import collections
+import math
+import os
+import struct
+import tempfile
+
+import numpy
+
+from MAVProxy.modules.lib import mp_util
+
+# sizes from AP_Terrain
+GRID_MAVLINK_SIZE = 4
+GRID_BLOCK_MUL_X = 7
+GRID_BLOCK_MUL_Y = 8
+GRID_BLOCK_SIZE_X = GRID_MAVLINK_SIZE * GRID_BLOCK_MUL_X
+GRID_BLOCK_SIZE_Y = GRID_MAVLINK_SIZE * GRID_BLOCK_MUL_Y
+# blocks overlap by one 4x4 grid
+GRID_BLOCK_SPACING_X = GRID_BLOCK_SIZE_X - GRID_MAVLINK_SIZE
+GRID_BLOCK_SPACING_Y = GRID_BLOCK_SIZE_Y - GRID_MAVLINK_SIZE
+GRID_FORMAT_VERSION = 1
+IO_BLOCK_SIZE = 2048
+ALL_BITS = (1 << (GRID_BLOCK_MUL_X * GRID_BLOCK_MUL_Y)) - 1
+
+LOCATION_SCALING_FACTOR = 0.011131884502145034
+# how far in degrees*1e7 a requested block corner may be from the one
+# block_corner() gives, for rounding differences with the autopilot
+CORNER_TOLERANCE = 10
+
+# struct grid_block: bitmap, lat, lon, crc, version, spacing, height[28][32],
+# grid_idx_x, grid_idx_y, lon_degrees, lat_degrees
+BLOCK_HEADER = struct.Struct('<QiiHHH')
+BLOCK_TRAILER = struct.Struct('<HHhb')
+BLOCK_SIZE = BLOCK_HEADER.size + 2*GRID_BLOCK_SIZE_X*GRID_BLOCK_SIZE_Y + BLOCK_TRAILER.size
+
+def crc16_ccitt(buf, crc=0):
+    '''CRC16 CCITT as used by AP_Terrain'''
+    for c in bytearray(buf):
+        crc ^= c << 8
+        for i in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+def longitude_scale(lat_e7):
+    '''scaling of longitude distances at a latitude, as in ArduPilot'''
+    scale = math.cos(math.radians(lat_e7 * 1.0e-7))
+    return min(max(scale, 0.01), 1.0)
+
+def gps_offset_array(lat, lon, east, north):
+    '''numpy version of mp_util.gps_offset'''
+    bearing = numpy.arctan2(east, north)
+    dr = numpy.sqrt(east**2 + north**2) / mp_util.radius_of_earth
+    lat1 = numpy.radians(lat)
+    lon1 = numpy.radians(lon)
+    lat2 = numpy.arcsin(numpy.sin(lat1)*numpy.cos(dr) +
+                        numpy.cos(lat1)*numpy.sin(dr)*numpy.cos(bearing))
+    lon2 = lon1 + numpy.arctan2(numpy.sin(bearing)*numpy.sin(dr)*numpy.cos(lat1),
+                                numpy.cos(dr)-numpy.sin(lat1)*numpy.sin(lat2))
+    lon2 = ((numpy.degrees(lon2) + 180.0) % 360.0) - 180.0
+    return (numpy.degrees(lat2), lon2)
+
+def grid_points(lat, lon, spacing):
+    '''return the lat and lon arrays of the 28x32 points of a block with
+    its south west corner at lat/lon, indexed [north][east]. The points
+    are placed the same way as 16 separate gps_offset calls from the
+    corner of each 4x4 grid'''
+    (row, col) = numpy.mgrid[0:GRID_BLOCK_SIZE_X, 0:GRID_BLOCK_SIZE_Y]
+    bit_spacing = spacing * GRID_MAVLINK_SIZE
+    (grid_x, grid_y) = numpy.mgrid[0:GRID_BLOCK_MUL_X, 0:GRID_BLOCK_MUL_Y]
+    (corner_lat, corner_lon) = gps_offset_array(numpy.array(lat), numpy.array(lon),
+                                                east=bit_spacing * grid_y.astype(float),
+                                                north=bit_spacing * grid_x.astype(float))
+    corner_lat = corner_lat[row // GRID_MAVLINK_SIZE, col // GRID_MAVLINK_SIZE]
+    corner_lon = corner_lon[row // GRID_MAVLINK_SIZE, col // GRID_MAVLINK_SIZE]
+    return gps_offset_array(corner_lat, corner_lon,
+                            east=spacing * (col % GRID_MAVLINK_SIZE).astype(float),
+                            north=spacing * (row % GRID_MAVLINK_SIZE).astype(float))
+
+def location_offset(lat, lon, north, east):
+    '''move a degrees*1e7 position by north/east meters, as in ArduPilot'''
+    dlat = north / LOCATION_SCALING_FACTOR
+    dlon = (east / LOCATION_SCALING_FACTOR) / longitude_scale(lat)
+    return (int(lat + dlat), int(lon + dlon))
+
+def block_corner(lat, lon, spacing):
+    '''return the south west corner in degrees*1e7 of the block the
+    autopilot would request for a position, as in AP_Terrain
+    calculate_grid_info()'''
+    lat_e7 = int(lat * 1.0e7)
+    lon_e7 = int(lon * 1.0e7)
+    ref_lat = int(math.floor(lat_e7 * 1.0e-7)) * 10000000
+    ref_lon = int(math.floor(lon_e7 * 1.0e-7)) * 10000000
+    north = (lat_e7 - ref_lat) * LOCATION_SCALING_FACTOR
+    east = (lon_e7 - ref_lon) * LOCATION_SCALING_FACTOR * longitude_scale(lat_e7)
+    grid_idx_x = int(north / spacing) // GRID_BLOCK_SPACING_X
+    grid_idx_y = int(east / spacing) // GRID_BLOCK_SPACING_Y
+    return location_offset(ref_lat, ref_lon,
+                           grid_idx_x * GRID_BLOCK_SPACING_X * float(spacing),
+                           grid_idx_y * GRID_BLOCK_SPACING_Y * float(spacing))
+
+def block_grid(lat, lon, spacing):
+    '''return (lat_degrees, lon_degrees, grid_idx_x, grid_idx_y) for a
+    block corner from block_corner(), or None if it is not on the block
+    grid. The last blocks of a degree reach into the next one, so the
+    degree below is tried too'''
+    lat_degrees = int(math.floor(lat * 1.0e-7))
+    lon_degrees = int(math.floor(lon * 1.0e-7))
+    for (dlat, dlon) in [(0, 0), (-1, 0), (0, -1), (-1, -1)]:
+        ref_lat = (lat_degrees + dlat) * 10000000
+        ref_lon = (lon_degrees + dlon) * 10000000
+        # undo location_offset() in block_corner(), which scales east
+        # distances at ref_lat
+        north = (lat - ref_lat) * LOCATION_SCALING_FACTOR
+        east = (lon - ref_lon) * LOCATION_SCALING_FACTOR * longitude_scale(ref_lat)
+        grid_idx_x = int(round(north / (spacing * GRID_BLOCK_SPACING_X)))
+        grid_idx_y = int(round(east / (spacing * GRID_BLOCK_SPACING_Y)))
+        (corner_lat, corner_lon) = location_offset(ref_lat, ref_lon,
+                                                   grid_idx_x * GRID_BLOCK_SPACING_X * float(spacing),
+                                                   grid_idx_y * GRID_BLOCK_SPACING_Y * float(spacing))
+        if abs(corner_lat - lat) <= CORNER_TOLERANCE and abs(corner_lon - lon) <= CORNER_TOLERANCE:
+            return (lat_degrees + dlat, lon_degrees + dlon, grid_idx_x, grid_idx_y)
+    return None
+
+def corridor_blocks(path, spacing, width, max_blocks=1000):
+    '''return the corners of the blocks covering a corridor of width
+    meters along a path of (lat,lon) points, in order along the path'''
+    # sample at half the smallest block size so no block is skipped
+    step = spacing * GRID_BLOCK_SPACING_X * 0.5
+    across = int(math.ceil(width * 0.5 / step))
+    ret = []
+    seen = set()
+    def add(lat, lon):
+        corner = block_corner(lat, lon, spacing)
+        if not corner in seen:
+            seen.add(corner)
+            ret.append(corner)
+    for i in range(len(path)):
+        (lat1, lon1) = path[i]
+        if i+1 < len(path):
+            (lat2, lon2) = path[i+1]
+            distance = mp_util.gps_distance(lat1, lon1, lat2, lon2)
+            bearing = mp_util.gps_bearing(lat1, lon1, lat2, lon2)
+        else:
+            distance = 0
+            bearing = 0
+        d = 0
+        while d <= distance:
+            (lat, lon) = mp_util.gps_newpos(lat1, lon1, bearing, d)
+            add(lat, lon)
+            for j in range(1, across+1):
+                for side in (90, -90):
+                    add(*mp_util.gps_newpos(lat, lon, bearing+side, j*step))
+            if len(ret) >= max_blocks:
+                return ret[:max_blocks]
+            d += step
+    return ret
+
+class MPTerrainBlock(object):
+    '''heights for one TERRAIN_REQUEST block'''
+    def __init__(self, lat, lon, spacing, heights, bitmap):
+        # lat/lon are the south west corner in degrees*1e7
+        self.lat = lat
+        self.lon = lon
+        self.spacing = spacing
+        # int16 array indexed [north][east]
+        self.heights = heights
+        # which 4x4 grids have valid heights
+        self.bitmap = bitmap
+
+    def complete(self):
+        return self.bitmap == ALL_BITS
+
+    def bit_data(self, bit):
+        '''the 16 heights for a TERRAIN_DATA message'''
+        x = (bit // GRID_BLOCK_MUL_Y) * GRID_MAVLINK_SIZE
+        y = (bit % GRID_BLOCK_MUL_Y) * GRID_MAVLINK_SIZE
+        return self.heights[x:x+GRID_MAVLINK_SIZE, y:y+GRID_MAVLINK_SIZE].flatten().tolist()
+
+class MPTerrainGrid(object):
+    '''compute and cache terrain blocks'''
+    def __init__(self, elevation_model, cachedir=None, max_blocks=64):
+        if cachedir is None:
+            try:
+                cachedir = os.path.join(os.environ['HOME'], '.tilecache/terrain')
+            except Exception:
+                cachedir = os.path.join(tempfile.gettempdir(), 'MAVProxyTerrain')
+        self.elevation_model = elevation_model
+        self.cachedir = cachedir
+        self.max_blocks = max_blocks
+        self.blocks = collections.OrderedDict()
+        self.counters = { 'MemHits' : 0, 'DiskHits' : 0, 'Computed' : 0, 'Incomplete' : 0 }
+
+    def get_block(self, lat, lon, spacing):
+        '''return a MPTerrainBlock for a block with its south west corner
+        at lat/lon in degrees*1e7. Blocks with missing SRTM data are not
+        cached, and have bits clear in their bitmap'''
+        key = (lat, lon, spacing)
+        block = self.blocks.pop(key, None)
+        if block is not None:
+            self.blocks[key] = block
+            self.counters['MemHits'] += 1
+            return block
+        block = self.read_block(lat, lon, spacing)
+        if block is not None:
+            self.counters['DiskHits'] += 1
+        else:
+            block = self.compute_block(lat, lon, spacing)
+            if not block.complete():
+                self.counters['Incomplete'] += 1
+                return block
+            self.counters['Computed'] += 1
+            self.write_block(block)
+        self.blocks[key] = block
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return block
+
+    def compute_block(self, lat, lon, spacing):
+        '''look up all the heights for a block in one pass'''
+        (lats, lons) = grid_points(lat*1.0e-7, lon*1.0e-7, spacing)
+        alts = self.elevation_model.GetElevationArray(lats, lons)
+        valid = ~numpy.isnan(alts)
+        bitmap = 0
+        for bit in range(GRID_BLOCK_MUL_X * GRID_BLOCK_MUL_Y):
+            x = (bit // GRID_BLOCK_MUL_Y) * GRID_MAVLINK_SIZE
+            y = (bit % GRID_BLOCK_MUL_Y) * GRID_MAVLINK_SIZE
+            if valid[x:x+GRID_MAVLINK_SIZE, y:y+GRID_MAVLINK_SIZE].all():
+                bitmap |= 1 << bit
+        alts[~valid] = 0
+        return MPTerrainBlock(lat, lon, spacing, alts.astype(numpy.int16), bitmap)
+
+    def block_location(self, lat, lon, spacing):
+        '''return the DAT file name and block offset for a block, following
+        AP_Terrain calculate_grid_info() and east_blocks(), or None if
+        lat/lon is not a block corner from block_corner()'''
+        grid = block_grid(lat, lon, spacing)
+        if grid is None:
+            return None
+        (lat_degrees, lon_degrees, grid_idx_x, grid_idx_y) = grid
+        ref_lat = lat_degrees * 10000000
+        ref_lon = lon_degrees * 10000000
+        # number of blocks across the degree, with room for two more
+        lon2 = ref_lon + 10000000
+        lon2 += (2 * spacing * GRID_BLOCK_SIZE_Y / LOCATION_SCALING_FACTOR) / longitude_scale(ref_lat)
+        east_blocks = int(((lon2 - ref_lon) * LOCATION_SCALING_FACTOR * longitude_scale(ref_lat)) /
+                          (spacing * GRID_BLOCK_SPACING_Y))
+        fname = "%c%02u%c%03u.DAT" % ('S' if lat_degrees < 0 else 'N', abs(lat_degrees),
+                                      'W' if lon_degrees < 0 else 'E', abs(lon_degrees))
+        path = os.path.join(self.cachedir, str(spacing), fname)
+        offset = (grid_idx_x * east_blocks + grid_idx_y) * IO_BLOCK_SIZE
+        return (path, offset, grid_idx_x, grid_idx_y, lat_degrees, lon_degrees)
+
+    def pack_block(self, block, grid_idx_x, grid_idx_y, lat_degrees, lon_degrees, crc=0):
+        '''pack a block as a struct grid_block'''
+        return (BLOCK_HEADER.pack(block.bitmap, block.lat, block.lon, crc,
+                                  GRID_FORMAT_VERSION, block.spacing) +
+                block.heights.astype('<i2').tostring() +
+                BLOCK_TRAILER.pack(grid_idx_x, grid_idx_y, lon_degrees, lat_degrees))
+
+    def read_block(self, lat, lon, spacing):
+        '''read a block from the DAT cache, or None if it is not there'''
+        location = self.block_location(lat, lon, spacing)
+        if location is None:
+            return None
+        (path, offset, grid_idx_x, grid_idx_y, lat_degrees, lon_degrees) = location
+        try:
+            f = open(path, 'rb')
+            f.seek(offset)
+            buf = f.read(BLOCK_SIZE)
+            f.close()
+        except IOError:
+            return None
+        if len(buf) < BLOCK_SIZE:
+            return None
+        (bitmap, blat, blon, crc, version, bspacing) = BLOCK_HEADER.unpack_from(buf, 0)
+        if (blat != lat or blon != lon or bspacing != spacing or
+            version != GRID_FORMAT_VERSION or bitmap != ALL_BITS):
+            return None
+        # the crc is taken with the crc field zeroed
+        if crc16_ccitt(buf[:16] + '\0\0' + buf[18:]) != crc:
+            return None
+        heights = numpy.frombuffer(buf, dtype='<i2', count=GRID_BLOCK_SIZE_X*GRID_BLOCK_SIZE_Y,
+                                   offset=BLOCK_HEADER.size)
+        heights = heights.astype(numpy.int16).reshape((GRID_BLOCK_SIZE_X, GRID_BLOCK_SIZE_Y))
+        return MPTerrainBlock(lat, lon, spacing, heights, bitmap)
+
+    def write_block(self, block):
+        '''write a complete block to the DAT cache'''
+        location = self.block_location(block.lat, block.lon, block.spacing)
+        if location is None:
+            return
+        (path, offset, grid_idx_x, grid_idx_y, lat_degrees, lon_degrees) = location
+        buf = self.pack_block(block, grid_idx_x, grid_idx_y, lat_degrees, lon_degrees)
+        buf = self.pack_block(block, grid_idx_x, grid_idx_y, lat_degrees, lon_degrees,
+                              crc=crc16_ccitt(buf))
+        buf += '\0' * (IO_BLOCK_SIZE - len(buf))
+        try:
+            mp_util.mkdir_p(os.path.dirname(path))
+            if os.path.exists(path):
+                f = open(path, 'r+b')
+            else:
+                f = open(path, 'w+b')
+            f.seek(offset)
+            f.write(buf)
+            f.close()
+        except (IOError, OSError):
+            pass
+
+    def __str__(self):
+        return "%u blocks in memory %s" % (len(self.blocks), self.counters)
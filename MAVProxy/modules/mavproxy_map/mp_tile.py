@@ -9,12 +9,9 @@ May 2012
 released under GNU GPL v3 or later
 '''
 
-import collections
 import errno
 import hashlib
-import urllib2
 import math
-import threading
 import os
 import sys
 import string
@@ -26,6 +23,9 @@ except ImportError:
 	import cv
 
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.mavproxy_map import mp_tilepool
+from MAVProxy.modules.mavproxy_map import mp_tilecache
+from MAVProxy.modules.mavproxy_map import mp_tilestore
 
 class TileException(Exception):
 	'''tile error class'''
@@ -54,6 +54,13 @@ TILE_SERVICES = {
 
 	}
 
+# minimum time between requests to a tile service, for services which
+# ask for lighter use than the tile_delay default
+SERVICE_TILE_DELAY = {
+	"OpenStreetMap"  : 0.5,
+	"OSMARender"     : 0.5,
+	}
+
 # these are the md5sums of "unavailable" tiles
 BLANK_TILES = set(["d16657bbee25d7f15c583f5c5bf23f50",
                    "c0e76e6e90ff881da047c15dbea380c7",
@@ -159,9 +166,10 @@ class TileInfoScaled(TileInfo):
 
 class MPTile:
 	'''map tile object'''
-	def __init__(self, cache_path=None, download=True, cache_size=500,
-		     service="MicrosoftSat", tile_delay=0.3, debug=False,
-		     max_zoom=19, refresh_age=30*24*60*60):
+	def __init__(self, cache_path=None, download=True, cache_mb=100,
+		     service="MicrosoftSat", tile_delay=0.1, debug=False,
+		     max_zoom=19, refresh_age=30*24*60*60, download_threads=4,
+		     tile_store=None):
 
 		if cache_path is None:
 			try:
@@ -177,27 +185,42 @@ class MPTile:
 		self.max_zoom = max_zoom
 		self.min_zoom = 1
 		self.download = download
-		self.cache_size = cache_size
+		self.cache_mb = cache_mb
 		self.tile_delay = tile_delay
 		self.service = service
 		self.debug = debug
                 self.refresh_age = refresh_age
 
+		# tiles are kept on disk either as one file per tile or packed
+		# in an SQLite file per service
+		if tile_store is None:
+			tile_store = os.environ.get('MAP_TILE_STORE', 'files')
+		if not tile_store in ['files', 'mbtiles']:
+			raise TileException('unknown tile store %s' % tile_store)
+		self.tile_store = tile_store
+		self._stores = {}
+
 		if service not in TILE_SERVICES:
 			raise TileException('unknown tile service %s' % service)
 
-		# _download_pending is a dictionary of TileInfo objects
-		self._download_pending = {}
-		self._download_thread = None
+		# tile downloads are queued by distance from the view centre
+		self._pool = mp_tilepool.MPTilePool(self.tile_downloaded,
+						    num_threads=download_threads,
+						    tile_delay=tile_delay,
+						    service_delay=SERVICE_TILE_DELAY,
+						    debug=debug)
+		self._view_centre = None
                 self._loading = mp_icon('loading.jpg')
 		self._unavailable = mp_icon('unavailable.jpg')
-		try:
-			self._tile_cache = collections.OrderedDict()
-		except AttributeError:
-			# OrderedDicts in python 2.6 come from the ordereddict module
-			# which is a 3rd party package, not in python2.6 distribution
-			import ordereddict
-			self._tile_cache = ordereddict.OrderedDict()
+		# decoded tiles, and scaled copies of them keyed by
+		# (key, width, height), share one memory budget
+		self._tile_cache = mp_tilecache.MPTileCache(cache_mb*1024*1024, self.image_size)
+
+	def image_size(self, img):
+		'''memory used by a cached image, placeholders are shared'''
+		if img is self._unavailable or img is self._loading:
+			return 0
+		return img.width * img.height * img.nChannels
 
         def set_service(self, service):
                 '''set tile service'''
@@ -230,7 +253,62 @@ class MPTile:
 
 	def tile_to_path(self, tile):
 		'''return full path to a tile'''
-		return os.path.join(self.cache_path, self.service, tile.path())
+		return os.path.join(self.cache_path, tile.service, tile.path())
+
+	def get_store(self, service):
+		'''return the packed tile store for a service, opening it on first use'''
+		store = self._stores.get(service)
+		if store is None:
+			path = os.path.join(self.cache_path, service + '.mbtiles')
+			store = self._stores.setdefault(service, mp_tilestore.MPTileStore(path, name=service))
+		return store
+
+	def tile_cached(self, tile):
+		'''see if a tile is in the disk cache'''
+		if self.tile_store == 'mbtiles':
+			return self.get_store(tile.service).get(tile.zoom, tile.x, tile.y) is not None
+		return os.path.exists(self.tile_to_path(tile))
+
+	def tiles_for_area(self, lat1, lon1, lat2, lon2, zoom):
+		'''return a list of TileInfo objects covering a lat/lon bounding box'''
+		t1 = self.coord_to_tile(max(lat1, lat2), min(lon1, lon2), zoom)
+		t2 = self.coord_to_tile(min(lat1, lat2), max(lon1, lon2), zoom)
+		ret = []
+		for y in range(t1.y, t2.y+1):
+			for x in range(t1.x, t2.x+1):
+				ret.append(TileInfo((x,y), zoom, self.service))
+		return ret
+
+	def read_tile(self, tile):
+		'''read a tile from the disk cache, returning (img, mtime). Raises
+		IOError with errno ENOENT if the tile is not cached'''
+		if self.tile_store == 'mbtiles':
+			ret = self.get_store(tile.service).get(tile.zoom, tile.x, tile.y)
+			if ret is None:
+				raise IOError(errno.ENOENT, 'tile not cached')
+			img = decode_image(ret[0])
+			if img is None:
+				raise IOError(errno.ENOENT, 'bad tile image')
+			return (img, ret[1])
+		path = self.tile_to_path(tile)
+		img = cv.LoadImage(path)
+		return (img, os.path.getmtime(path))
+
+	def write_tile(self, tile, data):
+		'''write a downloaded tile to the disk cache'''
+		if self.tile_store == 'mbtiles':
+			self.get_store(tile.service).put(tile.zoom, tile.x, tile.y, data)
+			return
+		path = self.tile_to_path(tile)
+		mp_util.mkdir_p(os.path.dirname(path))
+		h = open(path+'.tmp','wb')
+		h.write(data)
+		h.close()
+		try:
+			os.unlink(path)
+		except Exception:
+			pass
+		os.rename(path+'.tmp', path)
 
 	def coord_to_tilepath(self, lat, lon, zoom):
 		'''return the tile ID that covers a latitude/longitude at
@@ -241,81 +319,52 @@ class MPTile:
 
 	def tiles_pending(self):
 		'''return number of tiles pending download'''
-		return len(self._download_pending)
-
-	def downloader(self):
-		'''the download thread'''
-		while self.tiles_pending() > 0:
-			time.sleep(self.tile_delay)
-
-			keys = self._download_pending.keys()[:]
+		return self._pool.pending()
 
-			# work out which one to download next, choosing by request_time
-			tile_info = self._download_pending[keys[0]]
-			for key in keys:
-				if self._download_pending[key].request_time > tile_info.request_time:
-					tile_info = self._download_pending[key]
+	def tile_pending(self, tile):
+		'''see if a tile is queued or downloading'''
+		return self._pool.is_pending(tile.key())
 
-			url = tile_info.url(self.service)
-			path = self.tile_to_path(tile_info)
-			key = tile_info.key()
+	def cancel_downloads(self):
+		'''cancel all queued downloads'''
+		self._pool.retain(set())
 
-			try:
-				if self.debug:
-					print("Downloading %s [%u left]" % (url, len(keys)))
-                                req = urllib2.Request(url)
-                                if url.find('google') != -1:
-                                        req.add_header('Referer', 'https://maps.google.com/')
-				resp = urllib2.urlopen(req)
-				headers = resp.info()
-			except urllib2.URLError as e:
-				#print('Error loading %s' % url)
-                                if not key in self._tile_cache:
-                                        self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
-				if self.debug:
-					print("Failed %s: %s" % (url, str(e)))
-				continue
-			if 'content-type' not in headers or headers['content-type'].find('image') == -1:
-                                if not key in self._tile_cache:
-                                        self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
-				if self.debug:
-					print("non-image response %s" % url)
-				continue
-			else:
-				img = resp.read()
-
-			# see if its a blank/unavailable tile
-			md5 = hashlib.md5(img).hexdigest()
-			if md5 in BLANK_TILES:
-				if self.debug:
-					print("blank tile %s" % url)
-                                if not key in self._tile_cache:
-                                        self._tile_cache[key] = self._unavailable
-				self._download_pending.pop(key)
-				continue
+	def download_priority(self, tile):
+		'''download priority for a tile, lower is sooner. Tiles nearest
+		the view centre come first, then the most recently requested'''
+		if self._view_centre is None:
+			distance = 0
+		else:
+			distance = int(tile.distance(self._view_centre[0], self._view_centre[1]))
+		return (distance, -tile.request_time)
+
+	def queue_download(self, tile):
+		'''queue a tile for download'''
+		tile.refresh_time()
+		self._pool.request(tile.key(), tile, tile.url(tile.service), tile.service,
+				   self.download_priority(tile))
+
+	def tile_downloaded(self, tile_info, img, content_type):
+		'''handle a downloaded tile, called from the download threads'''
+		key = tile_info.key()
+		if img is None:
+			self._tile_cache.setdefault(key, self._unavailable)
+			return
+		if content_type is None or content_type.find('image') == -1:
+			self._tile_cache.setdefault(key, self._unavailable)
+			if self.debug:
+				print("non-image response %s" % tile_info.url(tile_info.service))
+			return
 
-			mp_util.mkdir_p(os.path.dirname(path))
-			h = open(path+'.tmp','wb')
-			h.write(img)
-			h.close()
-                        try:
-                                os.unlink(path)
-                        except Exception:
-                                pass
-                        os.rename(path+'.tmp', path)
-			self._download_pending.pop(key)
-		self._download_thread = None
-
-	def start_download_thread(self):
-		'''start the downloader'''
-		if self._download_thread:
+		# see if its a blank/unavailable tile
+		md5 = hashlib.md5(img).hexdigest()
+		if md5 in BLANK_TILES:
+			if self.debug:
+				print("blank tile %s" % tile_info.url(tile_info.service))
+			self._tile_cache.setdefault(key, self._unavailable)
 			return
-		t = threading.Thread(target=self.downloader)
-		t.daemon = True
-		self._download_thread = t
-		t.start()
+
+		self.write_tile(tile_info, img)
 
 	def load_tile_lowres(self, tile):
 		'''load a lower resolution tile from cache to fill in a
@@ -340,18 +389,14 @@ class MPTile:
 
 			# see if its in the tile cache
 			key = tile_info.key()
-			if key in self._tile_cache:
-				img = self._tile_cache[key]
-				if img == self._unavailable:
-					continue
-			else:
-				path = self.tile_to_path(tile_info)
+			img = self._tile_cache.get(key)
+			if img is self._unavailable:
+				continue
+			if img is None:
 				try:
-					img = cv.LoadImage(path)
+					(img, mtime) = self.read_tile(tile_info)
 					# add it to the tile cache
 					self._tile_cache[key] = img
-					while len(self._tile_cache) > self.cache_size:
-						self._tile_cache.popitem(0)
 				except IOError as e:
 					continue
 
@@ -365,6 +410,8 @@ class MPTile:
                         try:
                             cv.Copy(img, img2)
                         except Exception:
+                            # the image is shared with the tile cache
+                            cv.ResetImageROI(img)
                             continue
 			cv.ResetImageROI(img)
 
@@ -380,30 +427,30 @@ class MPTile:
 
 		# see if its in the tile cache
 		key = tile.key()
-		if key in self._tile_cache:
-			img = self._tile_cache[key]
-			if img == self._unavailable:
-				img = self.load_tile_lowres(tile)
-				if img is None:
-					img = self._unavailable
-				return img
-
+		img = self._tile_cache.get(key)
+		if img is self._unavailable:
+			img = self.load_tile_lowres(tile)
+			if img is None:
+				img = self._unavailable
+			return img
+		if img is not None:
+			return img
 
-		path = self.tile_to_path(tile)
+		if (self.tile_store == 'files' and self._pool.is_pending(key) and
+		    not os.path.exists(self.tile_to_path(tile))):
+			# still downloading, no need to try loading it again
+			img = self.load_tile_lowres(tile)
+			if img is None:
+				img = self._loading
+			return img
 		try:
-			ret = cv.LoadImage(path)
+			(ret, mtime) = self.read_tile(tile)
 
                         # if it is an old tile, then try to refresh
-                        if os.path.getmtime(path) + self.refresh_age < time.time():
-                                try:
-                                        self._download_pending[key].refresh_time()
-                                except Exception:
-                                        self._download_pending[key] = tile
-                                self.start_download_thread()
+                        if mtime + self.refresh_age < time.time():
+                                self.queue_download(tile)
 			# add it to the tile cache
 			self._tile_cache[key] = ret
-			while len(self._tile_cache) > self.cache_size:
-				self._tile_cache.popitem(0)
 			return ret
 		except IOError as e:
 			# windows gives errno 0 for some versions of python, treat that as ENOENT
@@ -417,11 +464,7 @@ class MPTile:
 				img = self._unavailable
 			return img
 
-		try:
-			self._download_pending[key].refresh_time()
-		except Exception:
-			self._download_pending[key] = tile
-		self.start_download_thread()
+		self.queue_download(tile)
 
 		img = self.load_tile_lowres(tile)
 		if img is None:
@@ -433,9 +476,17 @@ class MPTile:
 		'''return a scaled tile'''
 		width = int(TILES_WIDTH / tile.scale)
 		height = int(TILES_HEIGHT / tile.scale)
+		skey = (tile.key(), width, height)
+		scaled_tile = self._tile_cache.get(skey)
+		if scaled_tile is not None:
+			return scaled_tile
 		scaled_tile = cv.CreateImage((width,height), 8, 3)
 		full_tile = self.load_tile(tile)
 		cv.Resize(full_tile, scaled_tile)
+		if self._tile_cache.peek(tile.key()) is full_tile and full_tile is not self._unavailable:
+			# only keep scaled copies of real tiles, not of placeholders
+			# which will be replaced when the download completes
+			self._tile_cache[skey] = scaled_tile
 		return scaled_tile
 
 
@@ -537,10 +588,11 @@ class MPTile:
 
 		tlist = self.area_to_tile_list(lat, lon, width, height, ground_width, zoom)
 
-		# order the display by distance from the middle, so the download happens
-		# close to the middle of the image first
+		# downloads are prioritised by distance from the middle, so
+		# the download happens close to the middle of the image first
+		(midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
+		self._view_centre = (midlat, midlon)
 		if ordered:
-			(midlat, midlon) = self.coord_from_area(width/2, height/2, lat, lon, width, ground_width)
 			tlist.sort(key=lambda d: d.distance(midlat, midlon), reverse=True)
 
 		for t in tlist:
@@ -555,10 +607,19 @@ class MPTile:
 				cv.ResetImageROI(img)
 				cv.ResetImageROI(scaled_tile)
 
+		# drop queued downloads which have scrolled out of view
+		self._pool.retain(set([t.key() for t in tlist]), self.download_priority)
+
 		# return as an RGB image
 		cv.CvtColor(img, img, cv.CV_BGR2RGB)
 		return img
 
+def decode_image(raw):
+	'''decode a JPEG or PNG image held in a string'''
+	imagefiledata = cv.CreateMatHeader(1, len(raw), cv.CV_8UC1)
+	cv.SetData(imagefiledata, raw, len(raw))
+	return cv.DecodeImage(imagefiledata, cv.CV_LOAD_IMAGE_COLOR)
+
 def mp_icon(filename):
         '''load an icon from the data directory'''
         # we have to jump through a lot of hoops to get an OpenCV image
@@ -571,10 +632,7 @@ def mp_icon(filename):
                 raw = pkg_resources.resource_stream(name, "data/%s" % filename).read()
         except Exception:
                 raw = open(os.path.join(__file__, 'data', filename)).read()
-        imagefiledata = cv.CreateMatHeader(1, len(raw), cv.CV_8UC1)
-        cv.SetData(imagefiledata, raw, len(raw))
-        img = cv.DecodeImage(imagefiledata, cv.CV_LOAD_IMAGE_COLOR)
-        return img
+        return decode_image(raw)
 
 
 if __name__ == "__main__":
@@ -588,10 +646,32 @@ if __name__ == "__main__":
 	parser.add_option("--zoom", default=None, type='int', help="zoom level")
 	parser.add_option("--max-zoom", type='int', default=19, help="maximum tile zoom")
 	parser.add_option("--delay", type='float', default=1.0, help="tile download delay")
+	parser.add_option("--threads", type='int', default=4, help="tile download threads")
 	parser.add_option("--boundary", default=None, help="region boundary")
 	parser.add_option("--debug", action='store_true', default=False, help="show debug info")
+	parser.add_option("--store", default=None, help="tile store (files or mbtiles)")
+	parser.add_option("--import-cache", action='store_true', default=False,
+			  help="import the directory cache for the service into its mbtiles store")
+	parser.add_option("--store-max-mb", type='int', default=None, help="limit the mbtiles store size")
+	parser.add_option("--vacuum", action='store_true', default=False, help="vacuum the mbtiles store")
 	(opts, args) = parser.parse_args()
 
+	if opts.import_cache or opts.store_max_mb is not None or opts.vacuum:
+		mt = MPTile(service=opts.service, tile_store='mbtiles')
+		store = mt.get_store(opts.service)
+		if opts.import_cache:
+			def progress(count):
+				print("Imported %u tiles" % count)
+			count = store.import_directory(os.path.join(mt.cache_path, opts.service), progress)
+			print("Imported %u tiles into %s" % (count, store.path))
+		if opts.store_max_mb is not None:
+			removed = store.limit_size(opts.store_max_mb*1024*1024)
+			print("Removed %u tiles" % removed)
+		if opts.vacuum:
+			store.vacuum()
+		print("%s: %u tiles %.1f MB" % (store.path, store.count(), store.data_size()/1.0e6))
+		sys.exit(0)
+
 	lat = opts.lat
 	lon = opts.lon
 	ground_width = opts.width
@@ -606,7 +686,8 @@ if __name__ == "__main__":
 		print lat, lon, ground_width
 
 	mt = MPTile(debug=opts.debug, service=opts.service,
-		    tile_delay=opts.delay, max_zoom=opts.max_zoom)
+		    tile_delay=opts.delay, max_zoom=opts.max_zoom,
+		    download_threads=opts.threads, tile_store=opts.store)
 	if opts.zoom is None:
 		zooms = range(mt.min_zoom, mt.max_zoom+1)
 	else:
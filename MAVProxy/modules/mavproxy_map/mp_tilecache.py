@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+memory bounded LRU cache of decoded map tiles
+
+entries are charged by their size in bytes rather than counted, so
+full size tiles and the smaller scaled copies made for each zoom share
+one memory budget. A hit moves the entry to the most recently used end.
+'''
+
+import collections
+import threading
+
+class MPTileCache(object):
+    '''an LRU cache with a size budget in bytes'''
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        # sizeof(value) gives the memory charged for a value
+        self.sizeof = sizeof
+        try:
+            self.entries = collections.OrderedDict()
+        except AttributeError:
+            # OrderedDicts in python 2.6 come from the ordereddict module
+            import ordereddict
+            self.entries = ordereddict.OrderedDict()
+        self.sizes = {}
+        self.used = 0
+        self.lock = threading.Lock()
+        self.counters = { 'Hits' : 0, 'Misses' : 0, 'Evictions' : 0 }
+
+    def get(self, key, default=None):
+        '''look up a key, making it the most recently used'''
+        self.lock.acquire()
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.counters['Misses'] += 1
+            self.lock.release()
+            return default
+        self.entries[key] = value
+        self.counters['Hits'] += 1
+        self.lock.release()
+        return value
+
+    def peek(self, key, default=None):
+        '''look up a key without changing its recency or the counters'''
+        return self.entries.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        self.lock.acquire()
+        if key in self.entries:
+            self.entries.pop(key)
+            self.used -= self.sizes.pop(key)
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.used += size
+        while self.used > self.max_bytes and len(self.entries) > 1:
+            (oldkey, oldvalue) = self.entries.popitem(last=False)
+            self.used -= self.sizes.pop(oldkey)
+            self.counters['Evictions'] += 1
+        self.lock.release()
+
+    def setdefault(self, key, value):
+        '''add a value if the key is not already present'''
+        if not key in self.entries:
+            self[key] = value
+
+    def set_max_bytes(self, max_bytes):
+        '''change the budget, evicting entries if needed'''
+        self.lock.acquire()
+        self.max_bytes = max_bytes
+        while self.used > self.max_bytes and len(self.entries) > 0:
+            (oldkey, oldvalue) = self.entries.popitem(last=False)
+            self.used -= self.sizes.pop(oldkey)
+            self.counters['Evictions'] += 1
+        self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "%u tiles %.1f/%.1f MB %s" % (len(self.entries), self.used/1.0e6,
+                                             self.max_bytes/1.0e6, self.counters)
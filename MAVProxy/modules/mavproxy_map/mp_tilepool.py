@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+'''
+prioritised tile download pool for mp_tile
+
+a fixed number of worker threads take tile requests from a heap
+ordered by distance from the view centre and then by how recently
+the tile was asked for. Each worker keeps a keep-alive HTTP connection
+per tile host, and requests to each tile service are rate limited.
+'''
+
+import heapq
+import httplib
+import socket
+import threading
+import time
+import urlparse
+
+class TileRequest(object):
+    '''a queued tile download'''
+    def __init__(self, key, tile, url, service, priority):
+        self.key = key
+        self.tile = tile
+        self.url = url
+        self.service = service
+        self.priority = priority
+
+class MPTilePool(object):
+    '''a pool of tile download threads'''
+    def __init__(self, handler, num_threads=4, tile_delay=0.1, service_delay={},
+                 timeout=10, debug=False):
+        # handler(tile, data, content_type) is called from the worker
+        # threads, with data None if the download failed
+        self.handler = handler
+        self.num_threads = num_threads
+        self.tile_delay = tile_delay
+        self.service_delay = service_delay
+        self.timeout = timeout
+        self.debug = debug
+        self.cond = threading.Condition()
+        # key -> TileRequest for queued tiles
+        self.queued = {}
+        self.heap = []
+        self.seq = 0
+        # keys being downloaded now
+        self.active = set()
+        # service -> earliest time of the next request
+        self.next_request = {}
+        self.threads = []
+        self.counters = { 'Downloaded' : 0, 'Failed' : 0, 'Cancelled' : 0, 'Connections' : 0 }
+
+    def pending(self):
+        '''number of tiles queued or downloading'''
+        return len(self.queued) + len(self.active)
+
+    def is_pending(self, key):
+        '''see if a tile is queued or downloading'''
+        return key in self.queued or key in self.active
+
+    def _push(self, req):
+        '''add a request to the heap, lower priority values first'''
+        self.seq += 1
+        heapq.heappush(self.heap, (req.priority, self.seq, req))
+
+    def request(self, key, tile, url, service, priority):
+        '''queue a tile download, or update the priority of a queued tile'''
+        self.cond.acquire()
+        if key in self.active:
+            self.cond.release()
+            return
+        req = self.queued.get(key)
+        if req is None or req.priority != priority:
+            # any older heap entry for the key is skipped when popped
+            req = TileRequest(key, tile, url, service, priority)
+            self.queued[key] = req
+            self._push(req)
+        self.cond.notify()
+        self.cond.release()
+        self.start_threads()
+
+    def retain(self, keys, priority=None):
+        '''cancel queued tiles not in keys, for example after the view has
+        moved. If priority is given the remaining tiles are reordered
+        using priority(tile)'''
+        self.cond.acquire()
+        for key in self.queued.keys():
+            if not key in keys:
+                self.queued.pop(key)
+                self.counters['Cancelled'] += 1
+        if priority is not None:
+            for req in self.queued.values():
+                req.priority = priority(req.tile)
+        self.heap = []
+        for req in self.queued.values():
+            self._push(req)
+        self.cond.release()
+
+    def start_threads(self):
+        '''start the worker threads if they are not already running'''
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) < self.num_threads:
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            self.threads.append(t)
+            t.start()
+
+    def _next(self):
+        '''wait for the next request, returning it and the time it may be
+        sent under the rate limit for its service'''
+        self.cond.acquire()
+        while True:
+            while len(self.heap) > 0:
+                (priority, seq, req) = heapq.heappop(self.heap)
+                if self.queued.get(req.key) is not req:
+                    # cancelled or superseded
+                    continue
+                self.queued.pop(req.key)
+                self.active.add(req.key)
+                delay = self.service_delay.get(req.service, self.tile_delay)
+                tnow = time.time()
+                tsend = max(tnow, self.next_request.get(req.service, tnow))
+                self.next_request[req.service] = tsend + delay
+                self.cond.release()
+                return (req, tsend)
+            self.cond.wait()
+
+    def _done(self, req):
+        self.cond.acquire()
+        self.active.discard(req.key)
+        self.cond.release()
+
+    def fetch(self, conns, url, headers):
+        '''fetch a URL over a kept-alive connection, returning
+        (status, content_type, data, location)'''
+        u = urlparse.urlsplit(url)
+        path = u.path
+        if u.query:
+            path += '?' + u.query
+        hostkey = (u.scheme, u.netloc)
+        # a kept-alive connection may have been closed by the server, so
+        # retry once on a fresh connection
+        for attempt in range(2):
+            conn = conns.get(hostkey)
+            if conn is None:
+                if u.scheme == 'https':
+                    conn = httplib.HTTPSConnection(u.netloc, timeout=self.timeout)
+                else:
+                    conn = httplib.HTTPConnection(u.netloc, timeout=self.timeout)
+                conns[hostkey] = conn
+                self.counters['Connections'] += 1
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                conns.pop(hostkey)
+                if attempt == 1:
+                    raise
+                continue
+            if resp.getheader('connection', '').lower() == 'close':
+                conn.close()
+                conns.pop(hostkey)
+            return (resp.status, resp.getheader('content-type', ''), data,
+                    resp.getheader('location'))
+
+    def worker(self):
+        '''a download thread'''
+        conns = {}
+        while True:
+            (req, tsend) = self._next()
+            tnow = time.time()
+            if tsend > tnow:
+                time.sleep(tsend - tnow)
+            url = req.url
+            headers = { 'Connection' : 'keep-alive' }
+            if url.find('google') != -1:
+                headers['Referer'] = 'https://maps.google.com/'
+            data = None
+            content_type = None
+            try:
+                if self.debug:
+                    print("Downloading %s [%u left]" % (url, self.pending()))
+                for redirect in range(3):
+                    (status, content_type, data, location) = self.fetch(conns, url, headers)
+                    if status in [301, 302, 303, 307] and location is not None:
+                        url = urlparse.urljoin(url, location)
+                        continue
+                    break
+                if status != 200:
+                    if self.debug:
+                        print("Failed %s: HTTP %u" % (url, status))
+                    data = None
+            except Exception as e:
+                # anything going wrong with one tile must not stop the thread
+                if self.debug:
+                    print("Failed %s: %s" % (url, str(e)))
+                data = None
+            try:
+                self.handler(req.tile, data, content_type)
+            except Exception as e:
+                if self.debug:
+                    print("Failed to store %s: %s" % (url, str(e)))
+                data = None
+            if data is None:
+                self.counters['Failed'] += 1
+            else:
+                self.counters['Downloaded'] += 1
+            self._done(req)
+
+    def __str__(self):
+        return "%u queued %u active %s" % (len(self.queued), len(self.active), self.counters)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+'''
+pre-seed the map tile cache for an area
+
+works out the tiles covering a bounding box or polygon over a range of
+zoom levels and downloads the ones not already cached, using the
+MPTile download pool. Tiles already on disk are skipped, so an
+interrupted seed resumes where it left off when run again. Checking the
+cache for a large area takes a while, so the tiles are checked and
+queued from a background thread.
+'''
+
+import threading, time
+
+from MAVProxy.modules.lib import mp_util
+
+# tiles queued for download at once
+SEED_QUEUE = 500
+
+def seed_tiles(mt, points, zoom_min, zoom_max, polygon=True):
+    '''generate the tiles covering a list of (lat,lon) points for a range of
+    zooms. If polygon is True only tiles touching the polygon formed by
+    the points are included, otherwise the whole bounding box is used'''
+    (lat, lon, dlat, dlon) = mp_util.polygon_bounds(points)
+    for zoom in range(zoom_min, zoom_max+1):
+        for tile in mt.tiles_for_area(lat, lon, lat+dlat, lon+dlon, zoom):
+            if not polygon or len(points) < 3 or tile_touches_polygon(tile, points):
+                yield tile
+
+def tile_touches_polygon(tile, points):
+    '''see if a tile overlaps a polygon, by checking the tile centre and
+    corners against the polygon and the polygon points against the tile'''
+    from MAVProxy.modules.mavproxy_map.mp_tile import TILES_WIDTH, TILES_HEIGHT
+    for ofs in [(TILES_WIDTH/2, TILES_HEIGHT/2), (0,0), (TILES_WIDTH,0),
+                (0,TILES_HEIGHT), (TILES_WIDTH,TILES_HEIGHT)]:
+        if mp_util.polygon_inside(tile.coord(ofs), points):
+            return True
+    (lat1, lon1) = tile.coord((0,0))
+    (lat2, lon2) = tile.coord((TILES_WIDTH,TILES_HEIGHT))
+    for p in points:
+        if lat2 <= p[0] <= lat1 and lon1 <= p[1] <= lon2:
+            return True
+    return False
+
+class MPTileSeeder(object):
+    '''download tiles in a background thread, tracking progress'''
+    def __init__(self, mt, tiles):
+        self.mt = mt
+        self.tiles = tiles
+        # counts of tiles checked so far, tiles already in the cache, tiles
+        # downloaded into it and downloads that failed
+        self.total = 0
+        self.cached = 0
+        self.fetched = 0
+        self.failed = 0
+        # tiles queued for download which have not been counted yet
+        self.queued = []
+        self.scanning = True
+        self.stopped = False
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.seed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check_queued(self):
+        '''count the queued tiles that have finished, as fetched if they are
+        now in the cache and failed otherwise'''
+        queued = []
+        for tile in self.queued:
+            if self.mt.tile_pending(tile):
+                queued.append(tile)
+            elif self.mt.tile_cached(tile):
+                self.fetched += 1
+            else:
+                self.failed += 1
+        self.queued = queued
+
+    def seed(self):
+        '''check the tiles against the cache and download the missing ones,
+        keeping at most SEED_QUEUE downloads queued'''
+        for tile in self.tiles:
+            if self.stopped:
+                break
+            self.total += 1
+            if self.mt.tile_cached(tile):
+                self.cached += 1
+                continue
+            while len(self.queued) >= SEED_QUEUE and not self.stopped:
+                self.check_queued()
+                if len(self.queued) >= SEED_QUEUE:
+                    time.sleep(0.5)
+            self.queued.append(tile)
+            self.mt.queue_download(tile)
+        self.scanning = False
+        while len(self.queued) > 0 and not self.stopped:
+            time.sleep(0.5)
+            self.check_queued()
+
+    def remaining(self):
+        '''number of tiles queued for download'''
+        return len(self.queued)
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def status(self):
+        '''return a progress string with an estimated time to completion'''
+        remaining = self.remaining()
+        finished = self.fetched + self.failed
+        elapsed = time.time() - self.start_time
+        ret = "Seeded %u/%u tiles (%u already cached, %u failed)" % (self.cached + self.fetched, self.total,
+                                                                    self.cached, self.failed)
+        if self.scanning and not self.stopped:
+            ret += " checking cache"
+        elif finished > 0 and remaining > 0:
+            eta = remaining * elapsed / finished
+            ret += " ETA %u:%02u" % (int(eta) // 60, int(eta) % 60)
+        return ret
+
+    def stop(self):
+        '''cancel the remaining downloads'''
+        self.stopped = True
+        self.mt.cancel_downloads()
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    from MAVProxy.modules.mavproxy_map import mp_tile
+    parser = OptionParser("mp_tileseed.py [options]")
+    parser.add_option("--lat1", type='float', default=None, help="bounding box first latitude")
+    parser.add_option("--lon1", type='float', default=None, help="bounding box first longitude")
+    parser.add_option("--lat2", type='float', default=None, help="bounding box second latitude")
+    parser.add_option("--lon2", type='float', default=None, help="bounding box second longitude")
+    parser.add_option("--polygon", default=None, help="polygon file to seed")
+    parser.add_option("--zoom-min", type='int', default=1, help="minimum zoom")
+    parser.add_option("--zoom-max", type='int', default=17, help="maximum zoom")
+    parser.add_option("--service", default="MicrosoftSat", help="tile service")
+    parser.add_option("--store", default=None, help="tile store (files or mbtiles)")
+    parser.add_option("--threads", type='int', default=4, help="tile download threads")
+    parser.add_option("--delay", type='float', default=0.1, help="tile download delay")
+    parser.add_option("--debug", action='store_true', default=False, help="show debug info")
+    (opts, args) = parser.parse_args()
+
+    if opts.polygon is not None:
+        points = mp_util.polygon_load(opts.polygon)
+    elif None in [opts.lat1, opts.lon1, opts.lat2, opts.lon2]:
+        print("Need --polygon or a bounding box")
+        raise SystemExit(1)
+    else:
+        points = [(opts.lat1, opts.lon1), (opts.lat2, opts.lon2)]
+
+    mt = mp_tile.MPTile(service=opts.service, tile_store=opts.store, tile_delay=opts.delay,
+                        download_threads=opts.threads, debug=opts.debug)
+    tiles = seed_tiles(mt, points, opts.zoom_min, opts.zoom_max,
+                       polygon=(opts.polygon is not None))
+    seeder = MPTileSeeder(mt, tiles)
+    while not seeder.done():
+        print(seeder.status())
+        time.sleep(2)
+    print(seeder.status())
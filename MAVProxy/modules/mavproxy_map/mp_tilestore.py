@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+'''
+packed on-disk tile store
+
+tiles for each service are kept in one SQLite file using the MBTiles
+layout (zoom_level, tile_column, tile_row with TMS row numbering), plus
+an mtime column used for refreshing old tiles and for size limits.
+This avoids one small file per tile in the directory cache, which makes
+cold startup slow once the cache is large.
+'''
+
+import os, sqlite3, threading, time
+
+class MPTileStore(object):
+    '''an MBTiles style SQLite tile store for one tile service'''
+    def __init__(self, path, name=None):
+        self.path = path
+        self.lock = threading.Lock()
+        # tiles are written from the download threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self.db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass
+        self.db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, '
+                        'tile_row INTEGER, tile_data BLOB, mtime REAL, '
+                        'PRIMARY KEY (zoom_level, tile_column, tile_row))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tiles_mtime ON tiles (mtime)')
+        if name is not None:
+            self.db.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)', ('name', name))
+            self.db.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)', ('format', 'jpg'))
+        self.db.commit()
+
+    def tms_row(self, zoom, y):
+        '''MBTiles rows count up from the south'''
+        return (1 << zoom) - 1 - y
+
+    def get(self, zoom, x, y):
+        '''return (data, mtime) for a tile, or None if it is not stored'''
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT tile_data, mtime FROM tiles WHERE zoom_level=? AND '
+                                  'tile_column=? AND tile_row=?',
+                                  (zoom, x, self.tms_row(zoom, y))).fetchone()
+        finally:
+            self.lock.release()
+        if row is None:
+            return None
+        return (str(row[0]), row[1])
+
+    def put(self, zoom, x, y, data, mtime=None):
+        '''store a tile, replacing any older copy in a single transaction'''
+        if mtime is None:
+            mtime = time.time()
+        self.lock.acquire()
+        try:
+            self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)',
+                            (zoom, x, self.tms_row(zoom, y), sqlite3.Binary(data), mtime))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def count(self):
+        '''number of stored tiles'''
+        self.lock.acquire()
+        try:
+            return self.db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def data_size(self):
+        '''total size of the stored tile data in bytes'''
+        self.lock.acquire()
+        try:
+            return self.db.execute('SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles').fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def import_directory(self, dirname, progress=None):
+        '''import a zoom/y/x.img directory cache, keeping file times.
+        Returns the number of tiles imported'''
+        count = 0
+        self.lock.acquire()
+        try:
+            for zdir in os.listdir(dirname):
+                if not zdir.isdigit():
+                    continue
+                zoom = int(zdir)
+                for ydir in os.listdir(os.path.join(dirname, zdir)):
+                    if not ydir.isdigit():
+                        continue
+                    y = int(ydir)
+                    ypath = os.path.join(dirname, zdir, ydir)
+                    for fname in os.listdir(ypath):
+                        if not fname.endswith('.img') or not fname[:-4].isdigit():
+                            continue
+                        x = int(fname[:-4])
+                        path = os.path.join(ypath, fname)
+                        try:
+                            data = open(path, 'rb').read()
+                            mtime = os.path.getmtime(path)
+                        except (IOError, OSError):
+                            continue
+                        self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)',
+                                        (zoom, x, self.tms_row(zoom, y), sqlite3.Binary(data), mtime))
+                        count += 1
+                        if progress is not None and count % 1000 == 0:
+                            progress(count)
+                # commit once per zoom level to keep the import fast
+                self.db.commit()
+        finally:
+            self.db.commit()
+            self.lock.release()
+        return count
+
+    def limit_size(self, max_bytes):
+        '''remove the oldest tiles until the tile data fits in max_bytes.
+        Returns the number of tiles removed'''
+        removed = 0
+        size = self.data_size()
+        if size <= max_bytes:
+            return 0
+        self.lock.acquire()
+        try:
+            rows = self.db.execute('SELECT zoom_level, tile_column, tile_row, LENGTH(tile_data) '
+                                   'FROM tiles ORDER BY mtime').fetchall()
+            for (zoom, x, row, length) in rows:
+                if size <= max_bytes:
+                    break
+                self.db.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                (zoom, x, row))
+                size -= length
+                removed += 1
+            self.db.commit()
+        finally:
+            self.lock.release()
+        return removed
+
+    def vacuum(self):
+        '''give the space of removed tiles back to the filesystem'''
+        self.lock.acquire()
+        try:
+            self.db.execute('VACUUM')
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        self.db.close()
+        self.lock.release()
@@ -13,9 +13,10 @@ import pickle
 import os.path
 import os
 import zipfile
-import array
 import math
 import multiprocessing
+import collections
+import numpy
 from MAVProxy.modules.lib import mp_util
 import tempfile
 
@@ -85,6 +86,9 @@ class SRTMDownloader():
                 r"([NS])(\d{2})([EW])(\d{3})\.hgt\.zip")
         self.filelist_file = os.path.join(self.cachedir, "filelist_python")
         self.min_filelist_len = 14500
+        # LRU of open tiles, keyed by integer (lat, lon)
+        self.tiles = collections.OrderedDict()
+        self.max_tiles = 16
 
     def loadFileList(self):
         """Load a previously created file list or create a new one if none is
@@ -207,6 +211,22 @@ class SRTMDownloader():
         """Get a SRTM tile object. This function can return either an SRTM1 or
             SRTM3 object depending on what is available, however currently it
             only returns SRTM3 objects."""
+        key = (int(lat), int(lon))
+        tile = self.tiles.pop(key, None)
+        if tile is not None:
+            # move to the most recently used end
+            self.tiles[key] = tile
+            return tile
+        tile = self.loadTile(lat, lon)
+        if tile != 0:
+            self.tiles[key] = tile
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        return tile
+
+    def loadTile(self, lat, lon):
+        """Load a SRTM tile, starting a download if it is not available.
+            Returns 0 if the tile is not available yet."""
         global childFileListDownload
         if childFileListDownload is not None and childFileListDownload.is_alive():
             '''print "Getting file list"'''
@@ -240,8 +260,6 @@ class SRTMDownloader():
         elif childTileDownload is not None and childTileDownload.is_alive():
             '''print "Still Getting Tile"'''
             return 0
-        # TODO: Currently we create a new tile object each time.
-        # Caching is required for improved performance.
         try:
             return SRTMTile(os.path.join(self.cachedir, filename), int(lat), int(lon))
         except InvalidTileError:
@@ -285,24 +303,52 @@ class SRTMTile:
         only have to look at a single tile.
         """
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        # the zip is decompressed once into a native endian .npy file
+        # next to it, which is memory mapped on later loads
+        if f.endswith('.hgt.zip'):
+            npyname = f[:-len('.hgt.zip')] + '.npy'
+        else:
+            npyname = f + '.npy'
+        data = None
+        try:
+            if os.path.getmtime(npyname) >= os.path.getmtime(f):
+                data = numpy.load(npyname, mmap_mode='r')
+        except (OSError, IOError, ValueError):
+            data = None
+        if data is None:
+            data = self.convertZip(f, npyname)
+        self.size = int(math.sqrt(len(data)))
+        # Currently only SRTM1/3 is supported
+        if self.size not in (1201, 3601) or len(data) != self.size * self.size:
+            raise InvalidTileError(lat, lon)
+        self.data = data
+
+    def convertZip(self, f, npyname):
+        """read the samples from a SRTM zip file, saving them as a .npy
+            file for memory mapping next time"""
         try:
             zipf = zipfile.ZipFile(f, 'r')
         except Exception:
-            raise InvalidTileError(lat, lon)
+            raise InvalidTileError(self.lat, self.lon)
         names = zipf.namelist()
         if len(names) != 1:
-            raise InvalidTileError(lat, lon)
-        data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+            raise InvalidTileError(self.lat, self.lon)
+        raw = zipf.read(names[0])
+        zipf.close()
+        # samples are big endian
+        data = numpy.frombuffer(raw, dtype='>i2').astype(numpy.int16)
+        tmpname = npyname + '.tmp'
+        try:
+            output = open(tmpname, 'wb')
+            numpy.save(output, data)
+            output.close()
+            os.rename(tmpname, npyname)
+            return numpy.load(npyname, mmap_mode='r')
+        except (OSError, IOError):
+            # an unwritable cache just means converting again next time
+            return data
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -344,7 +390,7 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print offset
-        value = self.data[offset]
+        value = int(self.data[offset])
         if value == -32768:
             return -1 # -32768 is a special value for areas with no data
         return value
@@ -379,6 +425,33 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value)
         return value
 
+    def getAltitudeArray(self, lats, lons):
+        """Get the altitudes of numpy arrays of lat/lon points in this tile,
+            using the same bilinear interpolation as getAltitudeFromLatLon.
+        """
+        lats = numpy.asarray(lats, dtype=float) - self.lat
+        lons = numpy.asarray(lons, dtype=float) - self.lon
+        if (lats.size and (lats.min() < 0.0 or lats.max() >= 1.0 or
+                           lons.min() < 0.0 or lons.max() >= 1.0)):
+            raise WrongTileError(self.lat, self.lon, self.lat+lats.min(), self.lon+lons.min())
+        x = lons * (self.size - 1)
+        y = lats * (self.size - 1)
+        x_int = x.astype(int)
+        y_int = y.astype(int)
+        x_frac = x - x_int
+        y_frac = y - y_int
+        offset = x_int + self.size * (self.size - y_int - 1)
+        value00 = self.data[offset].astype(float)
+        value10 = self.data[offset + 1].astype(float)
+        value01 = self.data[offset - self.size].astype(float)
+        value11 = self.data[offset - self.size + 1].astype(float)
+        for v in (value00, value10, value01, value11):
+            # -32768 is a special value for areas with no data
+            v[v == -32768] = -1
+        value1 = value10 * x_frac + value00 * (1 - x_frac)
+        value2 = value11 * x_frac + value01 * (1 - x_frac)
+        return value2 * y_frac + value1 * (1 - y_frac)
+
 class SRTMOceanTile(SRTMTile):
     '''a tile for areas of zero altitude'''
     def __init__(self, lat, lon):
@@ -388,6 +461,9 @@ class SRTMOceanTile(SRTMTile):
     def getAltitudeFromLatLon(self, lat, lon):
         return 0
 
+    def getAltitudeArray(self, lats, lons):
+        return numpy.zeros(numpy.shape(lats))
+
 
 class parseHTMLDirectoryListing(HTMLParser):
 
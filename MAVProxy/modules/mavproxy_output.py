@@ -63,6 +63,7 @@ class OutputModule(mp_module.MPModule):
             print("Failed to connect to %s" % device)
             return
         self.mpstate.mav_outputs.append(conn)
+        self.mpstate.eventloop.register(conn.fd, self.mpstate.functions.process_mavlink, conn)
         try:
             mp_util.child_fd_list_add(conn.port.fileno())
         except Exception:
@@ -84,8 +85,11 @@ class OutputModule(mp_module.MPModule):
         except Exception:
             pass
         if sysid in self.mpstate.sysid_outputs:
+            self.mpstate.eventloop.unregister(self.mpstate.sysid_outputs[sysid].fd)
+            self.mpstate.batch_io.discard(self.mpstate.sysid_outputs[sysid])
             self.mpstate.sysid_outputs[sysid].close()
         self.mpstate.sysid_outputs[sysid] = conn
+        self.mpstate.eventloop.register(conn.fd, self.mpstate.functions.process_mavlink, conn)
 
     def cmd_output_remove(self, args):
         '''remove an output'''
@@ -98,6 +102,8 @@ class OutputModule(mp_module.MPModule):
                     mp_util.child_fd_list_add(conn.port.fileno())
                 except Exception:
                     pass
+                self.mpstate.eventloop.unregister(conn.fd)
+                self.mpstate.batch_io.discard(conn)
                 conn.close()
                 self.mpstate.mav_outputs.pop(i)
                 return
@@ -273,6 +273,7 @@ class ParamModule(mp_module.MPModule):
                          ["<download|status>",
                           "<set|show|fetch|help|apropos> (PARAMETER)",
                           "<load|save|diff> (FILENAME)"])
+        self.subscribe(['PARAM_VALUE'])
         if self.continue_mode and self.logdir != None:
             parmfile = os.path.join(self.logdir, 'mav.parm')
             if os.path.exists(parmfile):
@@ -7,6 +7,7 @@ from pymavlink import mavutil
 import time, os, platform
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_transfer
 
 if mp_util.has_wxpython:
     from MAVProxy.modules.lib.mp_menu import *
@@ -14,6 +15,7 @@ if mp_util.has_wxpython:
 class RallyModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(RallyModule, self).__init__(mpstate, "rally", "rally point control", public = True)
+        self.subscribe(['COMMAND_ACK'])
         self.rallyloader = mavwp.MAVRallyLoader(self.settings.target_system, self.settings.target_component)
         self.add_command('rally', self.cmd_rally, "rally point control", ["<add|clear|land|list|move|remove|>",
                                     "<load|save> (FILENAME)"])
@@ -23,6 +25,12 @@ class RallyModule(mp_module.MPModule):
         self.abort_previous_send_time = 0
         self.abort_ack_received = True
 
+        # current rally point transfer, if any
+        self.xfer = None
+        self.xfer_op = None
+        self.xfer_success = None
+        self.xfer_failure = None
+
         self.menu_added_console = False
         self.menu_added_map = False
         if mp_util.has_wxpython:
@@ -69,6 +77,13 @@ class RallyModule(mp_module.MPModule):
                 self.abort_ack_received = True
 
 
+    def transfer_busy(self):
+        '''see if a transfer is running, which is using rallyloader'''
+        if self.xfer is not None:
+            print("Rally transfer already in progress (%s)" % self.xfer)
+            return True
+        return False
+
     def cmd_rally_add(self, args):
         '''handle rally add'''
         if len(args) < 1:
@@ -93,6 +108,8 @@ class RallyModule(mp_module.MPModule):
         if not self.have_list:
             print("Please list rally points first")
             return
+        if self.transfer_busy():
+            return
 
         if (self.rallyloader.rally_count() > 4):
             print ("Only 5 rally points possible per flight plan.")
@@ -121,6 +138,8 @@ class RallyModule(mp_module.MPModule):
         if not self.have_list:
             print("Please list rally points first")
             return
+        if self.transfer_busy():
+            return
 
         idx = int(args[0])
         if idx <= 0 or idx > self.rallyloader.rally_count():
@@ -133,9 +152,8 @@ class RallyModule(mp_module.MPModule):
             new_break_alt = int(args[2])
 
         self.rallyloader.set_alt(idx, new_alt, new_break_alt)
-        self.send_rally_point(idx-1)
-        self.fetch_rally_point(idx-1)
         self.rallyloader.reindex()
+        self.start_transfer('send', [idx-1], self.send_and_fetch_rally_point)
 
     def cmd_rally_move(self, args):
         '''handle rally move'''
@@ -145,6 +163,8 @@ class RallyModule(mp_module.MPModule):
         if not self.have_list:
             print("Please list rally points first")
             return
+        if self.transfer_busy():
+            return
 
         idx = int(args[0])
         if idx <= 0 or idx > self.rallyloader.rally_count():
@@ -164,13 +184,10 @@ class RallyModule(mp_module.MPModule):
 
         oldpos = (rpoint.lat*1e-7, rpoint.lng*1e-7)
         self.rallyloader.move(idx, latlon[0], latlon[1])
-        self.send_rally_point(idx-1)
-        p = self.fetch_rally_point(idx-1)
-        if p.lat != int(latlon[0]*1e7) or p.lng != int(latlon[1]*1e7):
-            print("Rally move failed")
-            return
         self.rallyloader.reindex()
-        print("Moved rally point from %s to %s at %fm" % (str(oldpos), str(latlon), rpoint.alt))
+        self.start_transfer('send', [idx-1], self.send_and_fetch_rally_point,
+                            success="Moved rally point from %s to %s at %fm" % (str(oldpos), str(latlon), rpoint.alt),
+                            failure="Rally move failed")
 
 
     def cmd_rally(self, args):
@@ -187,6 +204,8 @@ class RallyModule(mp_module.MPModule):
             self.cmd_rally_move(args[1:])
 
         elif args[0] == "clear":
+            if self.transfer_busy():
+                return
             self.rallyloader.clear()
             self.mav_param.mavset(self.master,'RALLY_TOTAL',0,3)
 
@@ -197,10 +216,14 @@ class RallyModule(mp_module.MPModule):
             if (len(args) < 2):
                 print("Usage: rally remove RALLYNUM")
                 return
+            if self.transfer_busy():
+                return
             self.rallyloader.remove(int(args[1]))
             self.send_rally_points()
 
         elif args[0] == "list":
+            if self.transfer_busy():
+                return
             self.list_rally_points()
             self.have_list = True
 
@@ -208,6 +231,8 @@ class RallyModule(mp_module.MPModule):
             if (len(args) < 2):
                 print("Usage: rally load filename")
                 return
+            if self.transfer_busy():
+                return
 
             try:
                 self.rallyloader.load(args[1])
@@ -273,28 +298,58 @@ class RallyModule(mp_module.MPModule):
         self.master.mav.send(p)
 
     def send_rally_points(self):
-        '''send rally points from rallyloader'''
+        '''send rally points from rallyloader, reading each one back to check it'''
         self.mav_param.mavset(self.master,'RALLY_TOTAL',self.rallyloader.rally_count(),3)
+        self.start_transfer('send', range(self.rallyloader.rally_count()), self.send_and_fetch_rally_point)
 
-        for i in range(self.rallyloader.rally_count()):
-            self.send_rally_point(i)
+    def send_and_fetch_rally_point(self, i):
+        '''send one rally point and ask for it back'''
+        self.send_rally_point(i)
+        self.fetch_rally_point(i)
 
     def fetch_rally_point(self, i):
-        '''fetch one rally point'''
+        '''request one rally point'''
         self.master.mav.rally_fetch_point_send(self.target_system,
-                                                    self.target_component, i)
-        tstart = time.time()
-        p = None
-        while time.time() - tstart < 1:
-            p = self.master.recv_match(type='RALLY_POINT', blocking=False)
-            if p is not None:
-                break
-            time.sleep(0.1)
-            continue
-        if p is None:
-            self.console.error("Failed to fetch rally point %u" % i)
-            return None
-        return p
+                                               self.target_component, i)
+
+    def start_transfer(self, op, indexes, request, success=None, failure=None):
+        '''start a windowed transfer of rally points as a task'''
+        if self.transfer_busy():
+            return
+        self.xfer_op = op
+        self.xfer_success = success
+        self.xfer_failure = failure
+        self.xfer = mp_transfer.MPPointTransfer(indexes, request)
+        if op == 'send':
+            check = self.check_rally_point
+        else:
+            check = None
+        self.start_task(self.xfer.run('RALLY_POINT', check, self.transfer_done),
+                        name='rally %s' % op)
+
+    def check_rally_point(self, m):
+        '''see if a rally point read back after sending it matches'''
+        p = self.rallyloader.rally_point(m.idx)
+        return p.lat == m.lat and p.lng == m.lng and p.alt == m.alt
+
+    def transfer_done(self, xfer):
+        '''finish a transfer which is complete or has failed'''
+        if xfer.failed is not None:
+            if self.xfer_failure is not None:
+                print(self.xfer_failure)
+            elif self.xfer_op == 'send':
+                print("Failed to send rally point %u" % xfer.failed)
+            else:
+                self.console.error("Failed to fetch rally point %u" % xfer.failed)
+        self.xfer = None
+        if xfer.failed is not None:
+            return
+        if self.xfer_success is not None:
+            print(self.xfer_success)
+        if self.xfer_op == 'list':
+            for p in xfer.point_list():
+                self.rallyloader.append_rally_point(p)
+            self.list_complete()
 
     def list_rally_points(self):
         self.rallyloader.clear()
@@ -302,12 +357,10 @@ class RallyModule(mp_module.MPModule):
         if rally_count == 0:
             print("No rally points")
             return
-        for i in range(int(rally_count)):
-            p = self.fetch_rally_point(i)
-            if p is None:
-                return
-            self.rallyloader.append_rally_point(p)
+        self.start_transfer('list', range(int(rally_count)), self.fetch_rally_point)
 
+    def list_complete(self):
+        '''show and save the rally points once all are fetched'''
         for i in range(self.rallyloader.rally_count()):
             p = self.rallyloader.rally_point(i)
             self.console.writeln("lat=%f lng=%f alt=%f break_alt=%f land_dir=%f autoland=%f" % (p.lat * 1e-7, p.lng * 1e-7, p.alt, p.break_alt, p.land_dir, int(p.flags & 2!=0) ))
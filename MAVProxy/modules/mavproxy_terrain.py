@@ -2,36 +2,62 @@
   MAVProxy terrain handling module
 """
 
+import math
 import time
 
 from MAVProxy.modules.mavproxy_map import mp_elevation
+from MAVProxy.modules.mavproxy_map import mp_terraingrid
 from MAVProxy.modules.lib import mp_util
 from MAVProxy.modules.lib import mp_module
 from MAVProxy.modules.lib import mp_settings
+from pymavlink import mavutil
+
+# bytes on the wire for one TERRAIN_DATA message
+TERRAIN_DATA_LEN = 55
 
 class TerrainModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(TerrainModule, self).__init__(mpstate, "terrain", "terrain handling", public=False)
+        self.subscribe(['TERRAIN_REQUEST', 'TERRAIN_REPORT', 'GLOBAL_POSITION_INT'])
 
         self.ElevationModel = mp_elevation.ElevationModel()
+        self.grid = mp_terraingrid.MPTerrainGrid(self.ElevationModel)
         self.current_request = None
+        self.current_block = None
         self.sent_mask = 0
         self.last_send_time = time.time()
+        self.last_block_time = 0
+        # bytes of TERRAIN_DATA we may send now, refilled at the bandwidth setting
+        self.send_budget = 0
+        self.last_budget_time = time.time()
         self.requests_received = 0
         self.blocks_sent = 0
         self.check_lat = 0
         self.check_lon = 0
+        # blocks to prepare ahead of the vehicle, in order along the route
+        self.position = None
+        self.velocity = (0, 0)
+        self.grid_spacing = None
+        self.prefetch_blocks = []
+        self.prefetch_complete = set()
+        self.prefetch_idx = 0
+        self.prefetch_update = mavutil.periodic_event(0.2)
+        self.prefetch_period = mavutil.periodic_event(10)
         self.add_command('terrain', self.cmd_terrain, "terrain control",
-                         ["<status|check>",
+                         ["<status|check|prefetch>",
                           'set (TERRAINSETTING)'])
         self.terrain_settings = mp_settings.MPSettings(
-            [ ('debug', int, 0) ]
+            [ ('debug', int, 0),
+              ('bandwidth', int, 2000),
+              ('prefetch', int, 1),
+              ('corridor', int, 3000),
+              ('lookahead', int, 120) ]
             )
         self.add_completion_function('(TERRAINSETTING)', self.terrain_settings.completion)
 
     def cmd_terrain(self, args):
         '''terrain command parser'''
-        usage = "usage: tracker <set|status|check>"
+        usage = "usage: terrain <set|status|check|prefetch>"
         if len(args) == 0:
             print(usage)
             return
@@ -39,6 +65,10 @@ class TerrainModule(mp_module.MPModule):
             print("blocks_sent: %u requests_received: %u" % (
                 self.blocks_sent,
                 self.requests_received))
+            print("grid cache: %s" % self.grid)
+            print(self.prefetch_status())
+        elif args[0] == "prefetch":
+            print(self.prefetch_status())
         elif args[0] == "set":
             self.terrain_settings.command(args[1:])
         elif args[0] == "check":
@@ -70,8 +100,13 @@ class TerrainModule(mp_module.MPModule):
         # add some status fields
         if type == 'TERRAIN_REQUEST':
             self.current_request = msg
+            self.current_block = None
             self.sent_mask = 0
             self.requests_received += 1
+            self.grid_spacing = msg.grid_spacing
+        elif type == 'GLOBAL_POSITION_INT':
+            self.position = (msg.lat*1.0e-7, msg.lon*1.0e-7)
+            self.velocity = (msg.vx*0.01, msg.vy*0.01)
         elif type == 'TERRAIN_REPORT':
             if (msg.lat == self.check_lat and
                 msg.lon == self.check_lon and
@@ -82,30 +117,11 @@ class TerrainModule(mp_module.MPModule):
 
     def send_terrain_data_bit(self, bit):
         '''send some terrain data'''
-        lat = self.current_request.lat * 1.0e-7
-        lon = self.current_request.lon * 1.0e-7
-        bit_spacing = self.current_request.grid_spacing * 4
-        (lat, lon) = mp_util.gps_offset(lat, lon,
-                                        east=bit_spacing * (bit % 8),
-                                        north=bit_spacing * (bit // 8))
-        data = []
-        for i in range(4*4):
-            y = i % 4
-            x = i // 4
-            (lat2,lon2) = mp_util.gps_offset(lat, lon,
-                                             east=self.current_request.grid_spacing * y,
-                                             north=self.current_request.grid_spacing * x)
-            alt = self.ElevationModel.GetElevation(lat2, lon2)
-            if alt is None:
-                if self.terrain_settings.debug:
-                    print("no alt ", lat2, lon2)
-                return
-            data.append(int(alt))
         self.master.mav.terrain_data_send(self.current_request.lat,
                                           self.current_request.lon,
                                           self.current_request.grid_spacing,
                                           bit,
-                                          data)
+                                          self.current_block.bit_data(bit))
         self.blocks_sent += 1
         self.last_send_time = time.time()
         self.sent_mask |= 1<<bit
@@ -120,24 +136,114 @@ class TerrainModule(mp_module.MPModule):
             print("--lat=%f --lon=%f %.1f" % (
                 lat2, lon2, self.ElevationModel.GetElevation(lat2, lon2)))
 
-
     def send_terrain_data(self):
-        '''send some terrain data'''
+        '''send as much of the requested terrain data as the bandwidth
+        budget allows'''
+        req = self.current_request
+        now = time.time()
+        if self.current_block is None or (not self.current_block.complete() and
+                                          now - self.last_block_time > 0.2):
+            # look the block up again while SRTM tiles are still loading
+            self.current_block = self.grid.get_block(req.lat, req.lon, req.grid_spacing)
+            self.last_block_time = now
+        todo = req.mask & ~self.sent_mask
+        if todo == 0:
+            # no bits to send
+            self.current_request = None
+            self.current_block = None
+            self.sent_mask = 0
+            return
+        if self.terrain_settings.debug and todo & ~self.current_block.bitmap:
+            print("no alt for bits 0x%x" % (todo & ~self.current_block.bitmap))
         for bit in range(56):
-            if self.current_request.mask & (1<<bit) and self.sent_mask & (1<<bit) == 0:
+            if self.send_budget < TERRAIN_DATA_LEN:
+                break
+            if todo & (1<<bit) and self.current_block.bitmap & (1<<bit):
                 self.send_terrain_data_bit(bit)
+                self.send_budget -= TERRAIN_DATA_LEN
+
+    def prefetch_route(self):
+        '''return the (lat,lon) points the vehicle is expected to fly
+        through: along its velocity for the lookahead time, then the rest
+        of the mission from the current waypoint'''
+        route = []
+        if self.position is not None:
+            route.append(self.position)
+            (vn, ve) = self.velocity
+            distance = math.sqrt(vn**2 + ve**2) * self.terrain_settings.lookahead
+            if distance > 0:
+                bearing = math.degrees(math.atan2(ve, vn))
+                route.append(mp_util.gps_newpos(self.position[0], self.position[1], bearing, distance))
+        try:
+            wp_module = self.module('wp')
+            wploader = wp_module.wploader
+            start = max(wp_module.last_waypoint, 1)
+        except Exception:
+            return route
+        for i in range(start, wploader.count()):
+            wp = wploader.wp(i)
+            if wp.command >= mavutil.mavlink.MAV_CMD_NAV_LAST:
+                # not a navigation command
+                continue
+            if wp.x == 0 and wp.y == 0:
+                continue
+            route.append((wp.x, wp.y))
+        return route
+
+    def prefetch_rebuild(self):
+        '''work out the blocks along the route ahead'''
+        spacing = self.grid_spacing
+        if spacing is None:
+            spacing = int(self.get_mav_param('TERRAIN_SPACING', 100))
+        if spacing <= 0:
+            return
+        route = self.prefetch_route()
+        blocks = mp_terraingrid.corridor_blocks(route, spacing, self.terrain_settings.corridor)
+        self.prefetch_blocks = [(lat, lon, spacing) for (lat, lon) in blocks]
+        self.prefetch_complete &= set(self.prefetch_blocks)
+        self.prefetch_idx = 0
+
+    def prefetch_step(self, count=2):
+        '''prepare a few blocks along the route. Looking the blocks up
+        loads their SRTM tiles and stores complete blocks in the grid cache,
+        so TERRAIN_REQUESTs for them are answered straight away'''
+        for i in range(len(self.prefetch_blocks)):
+            if count == 0:
                 return
-        # no bits to send
-        self.current_request = None
-        self.sent_mask = 0
+            key = self.prefetch_blocks[self.prefetch_idx % len(self.prefetch_blocks)]
+            self.prefetch_idx += 1
+            if key in self.prefetch_complete:
+                continue
+            if self.grid.get_block(*key).complete():
+                self.prefetch_complete.add(key)
+            count -= 1
+
+    def prefetch_status(self):
+        '''coverage of the route ahead'''
+        total = len(self.prefetch_blocks)
+        if total == 0:
+            return "Prefetch: no route"
+        done = len(self.prefetch_complete)
+        return "Prefetch: %u/%u blocks (%.1f%%) of the route ahead ready" % (done, total, (100.0*done)/total)
 
     def idle_task(self):
         '''called when idle'''
+        now = time.time()
+        if self.terrain_settings.prefetch:
+            if self.prefetch_update.trigger():
+                self.prefetch_rebuild()
+            if self.current_request is None and self.prefetch_period.trigger():
+                self.prefetch_step()
         if self.current_request is None:
+            self.send_budget = 0
+            self.last_budget_time = now
             return
-        if time.time() - self.last_send_time < 0.2:
-            # limit to 5 per second
-            return
+        # refill the budget, allowing a burst of up to a quarter second
+        bandwidth = self.terrain_settings.bandwidth
+        dt = now - self.last_budget_time
+        self.last_budget_time = now
+        self.send_budget = min(self.send_budget + dt * bandwidth,
+                               max(bandwidth * 0.25, TERRAIN_DATA_LEN))
         self.send_terrain_data()
 
 def init(mpstate):
@@ -11,6 +11,9 @@ if mp_util.has_wxpython:
 class WPModule(mp_module.MPModule):
     def __init__(self, mpstate):
         super(WPModule, self).__init__(mpstate, "wp", "waypoint handling", public = True)
+        self.subscribe(['WAYPOINT_COUNT', 'MISSION_COUNT', 'WAYPOINT', 'MISSION_ITEM',
+                        'WAYPOINT_REQUEST', 'MISSION_REQUEST', 'WAYPOINT_CURRENT',
+                        'MISSION_CURRENT', 'MISSION_ITEM_REACHED'])
         self.wp_op = None
         self.wp_requested = {}
         self.wp_received = {}
@@ -4,7 +4,7 @@ log analysis program
 Andrew Tridgell December 2014
 '''
 
-import sys, struct, time, os, datetime
+import sys, struct, time, os, datetime, shutil, atexit
 import math, re
 import Queue
 import fnmatch
@@ -13,6 +13,9 @@ from math import *
 from MAVProxy.modules.lib import rline
 from MAVProxy.modules.lib import wxconsole
 from MAVProxy.modules.lib import grapher
+from MAVProxy.modules.lib import mp_logfile
+from MAVProxy.modules.lib import mp_logcache
+from MAVProxy.modules.lib import mp_logparse
 from MAVProxy.modules.lib import mavmemlog
 from pymavlink.mavextra import *
 from MAVProxy.modules.lib.mp_menu import *
@@ -47,11 +50,13 @@ class MEState(object):
               MPSetting('linestyle', str, None, 'linestyle'),
               MPSetting('show_flightmode', bool, True, 'show flightmode'),
               MPSetting('legend', str, 'upper left', 'legend position'),
-              MPSetting('legend2', str, 'upper right', 'legend2 position')
+              MPSetting('legend2', str, 'upper right', 'legend2 position'),
+              MPSetting('logcache', int, 1024, 'log cache size (MB), 0 to disable', tab='Cache')
               ]
             )
 
         self.mlog = None
+        self.shared_log_path = None
         self.command_map = command_map
         self.completions = {
             "set"       : ["(SETTING)"],
@@ -218,8 +223,24 @@ def load_graphs():
             mestate.console.writeln("Loaded %s" % f)
     mestate.graphs = sorted(mestate.graphs, key=lambda g: g.name)
 
-def graph_process(fields, mavExpLog, mavExpFlightModeSel, mavExpSettings):
+def log_handle():
+    '''what to give a child process for the current log: the directory
+    of its shared copy, or the log itself if it isn't shared'''
+    if mestate.shared_log_path is not None:
+        return mestate.shared_log_path
+    return mestate.mlog
+
+def shared_log(handle):
+    '''map the log shared by the parent process'''
+    if not isinstance(handle, basestring):
+        return handle
+    mlog = mavmemlog.mavmemlog(None)
+    mlog.load(handle)
+    return mlog
+
+def graph_process(fields, mavExpLogHandle, mavExpFlightModeSel, mavExpSettings):
     '''process for a graph'''
+    mavExpLog = shared_log(mavExpLogHandle)
     mavExpLog.reduce_by_flightmodes(mavExpFlightModeSel)
 
     mg = grapher.MavGraph()
@@ -238,7 +259,7 @@ def graph_process(fields, mavExpLog, mavExpFlightModeSel, mavExpSettings):
 def display_graph(graphdef):
     '''display a graph'''
     mestate.console.write("Expression: %s\n" % ' '.join(graphdef.expression.split()))
-    child = multiprocessing.Process(target=graph_process, args=[graphdef.expression.split(), mestate.mlog, mestate.flightmode_selections, mestate.settings])
+    child = multiprocessing.Process(target=graph_process, args=[graphdef.expression.split(), log_handle(), mestate.flightmode_selections, mestate.settings])
     child.start()
 
 def cmd_graph(args):
@@ -262,9 +283,10 @@ def cmd_graph(args):
         mestate.last_graph = GraphDefinition('Untitled', expression, '', [expression], None)
     display_graph(mestate.last_graph)
 
-def map_process(args, MAVExpLog, MAVExpFlightModes, MAVExpSettings):
+def map_process(args, MAVExpLogHandle, MAVExpFlightModes, MAVExpSettings):
     '''process for a graph'''
     from mavflightview import mavflightview_mav, mavflightview_options
+    MAVExpLog = shared_log(MAVExpLogHandle)
     MAVExpLog.reduce_by_flightmodes(MAVExpFlightModes)
 
     options = mavflightview_options()
@@ -275,7 +297,7 @@ def map_process(args, MAVExpLog, MAVExpFlightModes, MAVExpSettings):
 
 def cmd_map(args):
     '''map command'''
-    child = multiprocessing.Process(target=map_process, args=[args, mestate.mlog, mestate.flightmode_selections, mestate.settings])
+    child = multiprocessing.Process(target=map_process, args=[args, log_handle(), mestate.flightmode_selections, mestate.settings])
     child.start()
 
 def cmd_set(args):
@@ -391,14 +413,44 @@ def cmd_loadfile(args):
         return
     loadfile(args[0])
 
+def remove_shared_log():
+    '''remove the shared copy of the last log, if there is one'''
+    if mestate.shared_log_path is not None:
+        shutil.rmtree(mestate.shared_log_path, ignore_errors=True)
+        mestate.shared_log_path = None
+
 def loadfile(args):
     '''load a log file (path given by arg)'''
     mestate.console.write("Loading %s...\n" % args)
     t0 = time.time()
-    mlog = mavutil.mavlink_connection(args, notimestamps=False,
-                                      zero_time_base=False)
-    mestate.mlog = mavmemlog.mavmemlog(mlog, progress_bar)
-    mestate.status.msgs = mlog.messages
+    cache = None
+    mlog = None
+    if mestate.settings.logcache > 0:
+        cache = mp_logcache.MPLogCache(max_size=mestate.settings.logcache*1024*1024)
+        mlog = cache.load(args)
+    if mlog is not None:
+        mestate.console.write("(cached)")
+    else:
+        # block compressed logs are decompressed to a temporary file
+        filename = mp_logfile.readable_log(args)
+        try:
+            mlog = mp_logparse.parse_log(filename, progress_bar)
+        finally:
+            if filename != args:
+                os.unlink(filename)
+        if cache is not None:
+            cache.save(args, mlog)
+    # children map the columns from a private shared copy instead of
+    # being sent the log. They don't use the cache entry, as pruning
+    # the cache could remove it under them
+    remove_shared_log()
+    try:
+        mlog = mp_logcache.share_log(mlog)
+        mestate.shared_log_path = mlog.path
+    except Exception as ex:
+        print("Unable to share log with graphs: %s" % ex)
+    mestate.status.msgs = mlog.last_messages()
+    mestate.mlog = mlog
     t1 = time.time()
     mestate.console.write("\ndone (%u messages in %.1fs)\n" % (mestate.mlog._count, t1-t0))
 
@@ -477,6 +529,7 @@ def progress_bar(pct):
 if __name__ == "__main__":
     multiprocessing.freeze_support()
     mestate = MEState()
+    atexit.register(remove_shared_log)
     setup_file_menu()
 
     mestate.rl = rline.rline("MAV> ", mestate)
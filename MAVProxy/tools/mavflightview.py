@@ -9,6 +9,7 @@ import sys, time, os
 from pymavlink import mavutil, mavwp, mavextra
 from MAVProxy.modules.mavproxy_map import mp_slipmap, mp_tile
 from MAVProxy.modules.lib import mp_util
+from MAVProxy.modules.lib import mp_logfile
 import functools
 
 try:
@@ -363,8 +364,16 @@ def mavflightview_mav(mlog, options=None, title=None):
 
 def mavflightview(filename, options):
     print("Loading %s ..." % filename)
-    mlog = mavutil.mavlink_connection(filename)
-    mavflightview_mav(mlog, options, title=filename)
+    # only the blocks of a block compressed log in the time range are read
+    logname = mp_logfile.readable_log(filename,
+                                      getattr(options, 'tstart', None),
+                                      getattr(options, 'tend', None))
+    try:
+        mlog = mavutil.mavlink_connection(logname)
+        mavflightview_mav(mlog, options, title=filename)
+    finally:
+        if logname != filename:
+            os.unlink(logname)
 
 class mavflightview_options(object):
     def __init__(self):
@@ -386,6 +395,8 @@ class mavflightview_options(object):
         self.types = None
         self.ekf_sample = 1
         self.rate = 0
+        self.tstart = None
+        self.tend = None
 
 if __name__ == "__main__":
     from optparse import OptionParser
@@ -410,6 +421,8 @@ if __name__ == "__main__":
     parser.add_option("--nkf-sample", type='int', default=1, help="sub-sampling of NKF messages")
     parser.add_option("--rate", type='int', default=0, help="maximum message rate to display (0 means all points)")
     parser.add_option("--colour-source", type="str", default="flightmode", help="expression with range 0f..255f used for point colour")
+    parser.add_option("--tstart", type='float', default=None, help="start time (seconds since 1970) for block compressed logs")
+    parser.add_option("--tend", type='float', default=None, help="end time (seconds since 1970) for block compressed logs")
 
     (opts, args) = parser.parse_args()
 